@@ -3,10 +3,14 @@ from django.contrib import admin
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.utils.html import format_html
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
 # Register your models here.
-from .models import Article
+from djangoblog.cache_dependency import instance_tags, invalidate, model_tag
+from .models import Article, Category, Tag
+from .neighbor_index import neighbor_index
+from .tag_counts import tag_counts
 
 
 class ArticleForm(forms.ModelForm):
@@ -17,20 +21,49 @@ class ArticleForm(forms.ModelForm):
         fields = '__all__'
 
 
+def get_articles_cache_tags(ids):
+    """
+    文章依赖的全部缓存标签：文章本身、分类及其父级、标签、作者和归档月份
+    """
+    tags = {model_tag(Article), model_tag(Category), model_tag(Tag)}
+    for article in Article.objects.filter(pk__in=ids).select_related('category', 'author'):
+        tags.update(instance_tags(article))
+    return tags
+
+
+def update_articles(queryset, **values):
+    """
+    批量修改文章，queryset.update 不发送信号，需要手动使修改前后依赖文章的缓存失效
+    """
+    ids = list(queryset.values_list('pk', flat=True))
+    tags = get_articles_cache_tags(ids)
+    # 修改时间是列表页卡片缓存的版本
+    Article.objects.filter(pk__in=ids).update(last_modify_time=now(), **values)
+    tags.update(get_articles_cache_tags(ids))
+    invalidate(*tags)
+
+
+def set_article_status(queryset, status):
+    update_articles(queryset, status=status)
+    # 按发布状态维护的索引需要重建
+    tag_counts.clear()
+    neighbor_index.clear()
+
+
 def makr_article_publish(modeladmin, request, queryset):
-    queryset.update(status='p')
+    set_article_status(queryset, 'p')
 
 
 def draft_article(modeladmin, request, queryset):
-    queryset.update(status='d')
+    set_article_status(queryset, 'd')
 
 
 def close_article_commentstatus(modeladmin, request, queryset):
-    queryset.update(comment_status='c')
+    update_articles(queryset, comment_status='c')
 
 
 def open_article_commentstatus(modeladmin, request, queryset):
-    queryset.update(comment_status='o')
+    update_articles(queryset, comment_status='o')
 
 
 makr_article_publish.short_description = _('Publish selected articles')
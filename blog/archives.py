@@ -0,0 +1,107 @@
+"""
+文章归档数据
+
+归档页只需要每篇文章的标题、发布时间和链接。月份列表由数据库按月分组统计，
+每个月的文章单独缓存并依赖该月的归档标签（见 ``Article.archive_cache_tag``），
+发布或修改文章只会使所在月份的缓存失效，其他月份直接从缓存批量读取。
+"""
+import logging
+import operator
+from collections import defaultdict
+from functools import reduce
+
+from django.db.models import Count, Q
+from django.db.models.functions import TruncMonth
+from django.urls import reverse
+from django.utils.timezone import is_aware, localtime
+
+from blog.models import Article
+from djangoblog.cache_dependency import model_tag, set_with_dependencies
+from djangoblog.utils import cache
+
+logger = logging.getLogger(__name__)
+
+MONTHS_KEY = 'archives_months'
+MONTH_KEY = 'archives_month_{month}'
+ARCHIVES_TIMEOUT = 60 * 60 * 10
+ARCHIVE_FIELDS = ('id', 'title', 'pub_time', 'creation_time')
+
+
+def _month_key(month):
+    if is_aware(month):
+        month = localtime(month)
+    return MONTH_KEY.format(month=month.strftime('%Y-%m'))
+
+
+def _next_month(month):
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else \
+        month.replace(month=month.month + 1)
+
+
+def get_archive_months():
+    """
+    获得有已发布文章的月份
+    :return: [(月份第一天, 文章数)]，按月份倒序
+    """
+    months = cache.get(MONTHS_KEY)
+    if months is None:
+        rows = Article.objects.filter(status='p').annotate(
+            month=TruncMonth('pub_time')).order_by().values('month').annotate(
+            count=Count('id')).values_list('month', 'count')
+        months = sorted(rows, reverse=True)
+        set_with_dependencies(MONTHS_KEY, months, ARCHIVES_TIMEOUT, [model_tag(Article)])
+    return months
+
+
+def load_month_articles(months):
+    """
+    一次查询获得多个月份的文章，只取归档页需要的字段
+    :param months: 月份第一天的列表
+    :return: {月份: [{'id', 'title', 'pub_time', 'url'}]}，每月按发布时间倒序
+    """
+    result = defaultdict(list)
+    keys = {_month_key(month): month for month in months}
+    ranges = reduce(operator.or_, [
+        Q(pub_time__gte=month, pub_time__lt=_next_month(month)) for month in months])
+    rows = Article.objects.filter(ranges, status='p').order_by(
+        '-pub_time', '-id').values(*ARCHIVE_FIELDS)
+    for row in rows.iterator():
+        month = keys.get(_month_key(row['pub_time']))
+        if month is None:
+            continue
+        creation_time = row.pop('creation_time')
+        row['url'] = reverse('blog:detailbyid', kwargs={
+            'article_id': row['id'],
+            'year': creation_time.year,
+            'month': creation_time.month,
+            'day': creation_time.day
+        })
+        result[month].append(row)
+    return result
+
+
+def get_archives():
+    """
+    获得按年、月分组的归档，未命中缓存的月份一次查询后分别缓存
+    :return: [(年, [(月, 文章列表)])]
+    """
+    months = [month for month, count in get_archive_months()]
+    if not months:
+        return []
+    cached = cache.get_many([_month_key(month) for month in months])
+    missing = [month for month in months if _month_key(month) not in cached]
+    if missing:
+        logger.info('load archive months:{count}'.format(count=len(missing)))
+        loaded = load_month_articles(missing)
+        for month in missing:
+            key = _month_key(month)
+            cached[key] = loaded.get(month, [])
+            set_with_dependencies(key, cached[key], ARCHIVES_TIMEOUT,
+                                  [Article.archive_cache_tag(month)])
+
+    archives = []
+    for month in months:
+        if not archives or archives[-1][0] != month.year:
+            archives.append((month.year, []))
+        archives[-1][1].append((month.month, cached[_month_key(month)]))
+    return archives
@@ -0,0 +1,178 @@
+"""
+缓存预热
+
+部署、清空缓存或修改配置后，第一批访问者需要重新生成首页、侧边栏、``seo_processor``、
+面包屑以及热门文章页面。这里以匿名用户身份构造请求，经过与真实请求相同的中间件和视图处理，
+所有相关缓存（包括整页缓存）都会被填充。
+
+预热的页面数量有上限：首页前 K 页、文章数最多的 N 个分类/标签/作者列表、归档、友链和热门文章，
+与分类、标签的总数无关。
+"""
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.handlers.base import BaseHandler
+from django.core.signals import request_finished
+from django.db import close_old_connections, connection
+from django.db.models import Count, Q
+from django.test import RequestFactory
+from django.urls import reverse
+
+from blog.models import Article, Category, LinkShowType, Tag
+from blog.tag_counts import tag_counts
+from djangoblog.utils import cache, get_current_site
+
+logger = logging.getLogger(__name__)
+
+# 预热请求带有该标记，不计入文章阅读数
+WARMUP_META_KEY = 'CACHE_WARMUP'
+PREWARM_SCHEDULED_KEY = 'cache_prewarm_scheduled'
+
+
+def _page_count(article_count, pages):
+    return max(1, min(pages, math.ceil(article_count / settings.PAGINATE_BY)))
+
+
+def get_top_listings(listings):
+    """
+    文章数最多的分类、标签和作者列表
+    :param listings: 最多返回的列表数
+    :return: [(文章数, url名称, 参数名, 参数值)]，按文章数倒序
+    """
+    if listings <= 0:
+        return []
+    published = Q(article__status='p')
+    candidates = []
+    categories = Category.objects.annotate(count=Count('article', filter=published)).filter(
+        count__gt=0).order_by('-count').values_list('count', 'slug')[:listings]
+    candidates.extend((count, 'blog:category_detail', 'category_name', slug) for count, slug in categories)
+
+    counts = sorted(tag_counts.get_counts().items(), key=lambda item: -item[1])[:listings]
+    tags = Tag.objects.in_bulk([tag_id for tag_id, count in counts])
+    candidates.extend((count, 'blog:tag_detail', 'tag_name', tags[tag_id].slug)
+                      for tag_id, count in counts if tag_id in tags)
+
+    authors = Article.objects.filter(type='a', status='p').values('author__username').annotate(
+        count=Count('id')).order_by('-count').values_list('count', 'author__username')[:listings]
+    candidates.extend((count, 'blog:author_detail', 'author_name', name) for count, name in authors)
+    return sorted(candidates, key=lambda item: -item[0])[:listings]
+
+
+def get_warmup_urls(top_articles=20, pages=2, listings=10):
+    """
+    获得需要预热的页面
+    :param top_articles: 阅读数最多的前 N 篇文章
+    :param pages: 首页和每个列表预热前 K 页
+    :param listings: 预热文章数最多的前 N 个分类/标签/作者列表
+    :return: url 列表
+    """
+    urls = []
+    index_count = Article.objects.filter(type='a', status='p').count()
+    for page in range(1, _page_count(index_count, pages) + 1):
+        urls.append(reverse('blog:index') if page == 1 else
+                    reverse('blog:index_page', kwargs={'page': page}))
+
+    for count, view_name, kwarg, value in get_top_listings(listings):
+        for page in range(1, _page_count(count, pages) + 1):
+            kwargs = {kwarg: value}
+            if page > 1:
+                kwargs['page'] = page
+            urls.append(reverse(view_name if page == 1 else view_name + '_page', kwargs=kwargs))
+
+    urls.append(reverse('blog:archives'))
+    urls.append(reverse('blog:links'))
+
+    most_read = Article.objects.filter(status='p').order_by('-views')[:top_articles]
+    urls.extend(article.get_absolute_url() for article in most_read)
+    return urls
+
+
+def get_warmup_host():
+    """预热请求的 Host，需要与真实请求一致才能生成相同的整页缓存 key"""
+    return settings.CACHE_PREWARM_HOST or get_current_site().domain
+
+
+def warm_sidebars():
+    """预热每种链接显示类型的侧边栏"""
+    from blog.templatetags.blog_tags import load_sidebar
+    for linktype in LinkShowType.values:
+        load_sidebar(AnonymousUser(), linktype)
+
+
+def warm_cache(top_articles=20, pages=2, concurrency=4, listings=10, host=None):
+    """
+    预热缓存
+    :param top_articles: 阅读数最多的前 N 篇文章
+    :param pages: 首页和每个列表预热前 K 页
+    :param concurrency: 同时请求的页面数
+    :param listings: 预热文章数最多的前 N 个分类/标签/作者列表
+    :param host: 请求的 Host，默认 CACHE_PREWARM_HOST 或站点域名
+    :return: (成功数, 失败数, 耗时秒数)
+    """
+    start = time.time()
+    warm_sidebars()
+    urls = get_warmup_urls(top_articles, pages, listings)
+    factory = RequestFactory(HTTP_HOST=host or get_warmup_host(), **{WARMUP_META_KEY: True})
+    # 与 WSGIHandler 相同的中间件链，请求经过整页缓存等全部中间件
+    handler = BaseHandler()
+    handler.load_middleware()
+
+    def fetch(url):
+        try:
+            response = handler.get_response(factory.get(url))
+            response.close()
+            if response.status_code != 200:
+                logger.warning('warm cache {url} status:{status}'.format(
+                    url=url, status=response.status_code))
+            return response.status_code == 200
+        except Exception as e:
+            logger.error('warm cache {url} failed:{e}'.format(url=url, e=e))
+            return False
+        finally:
+            if concurrency > 1:
+                connection.close()
+
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(fetch, urls))
+    else:
+        # 在调用方线程中请求时，与 django.test.Client 一样不让 request_finished 关闭调用方的数据库连接
+        request_finished.disconnect(close_old_connections)
+        try:
+            results = [fetch(url) for url in urls]
+        finally:
+            request_finished.connect(close_old_connections)
+    succeeded = sum(results)
+    elapsed = time.time() - start
+    logger.info('warm cache urls:{total} failed:{failed} time:{elapsed:.2f}s'.format(
+        total=len(urls), failed=len(urls) - succeeded, elapsed=elapsed))
+    return succeeded, len(urls) - succeeded, elapsed
+
+
+def schedule_prewarm():
+    """
+    缓存失效后在后台预热，``CACHE_PREWARM_DELAY`` 秒内的多次失效只预热一次
+    """
+    if not cache.add(PREWARM_SCHEDULED_KEY, 1, settings.CACHE_PREWARM_DELAY + 60):
+        return
+
+    def run():
+        try:
+            time.sleep(settings.CACHE_PREWARM_DELAY)
+            # 预热期间发生的失效需要重新调度
+            cache.delete(PREWARM_SCHEDULED_KEY)
+            warm_cache(settings.CACHE_PREWARM_TOP_ARTICLES,
+                       settings.CACHE_PREWARM_PAGES,
+                       settings.CACHE_PREWARM_CONCURRENCY,
+                       settings.CACHE_PREWARM_LISTINGS)
+        except Exception as e:
+            logger.error(e)
+        finally:
+            connection.close()
+
+    threading.Thread(target=run, daemon=True).start()
@@ -2,8 +2,9 @@ import logging
 
 from django.utils import timezone
 
+from djangoblog.cache_dependency import model_tag, set_with_dependencies
 from djangoblog.utils import cache, get_blog_setting
-from .models import Category, Article
+from .models import Category, Article, BlogSettings
 
 logger = logging.getLogger(__name__)
 
@@ -25,10 +26,10 @@ def seo_processor(requests):
             'SITE_KEYWORDS': setting.site_keywords,
             'SITE_BASE_URL': requests.scheme + '://' + requests.get_host() + '/',
             'ARTICLE_SUB_LENGTH': setting.article_sub_length,
-            'nav_category_list': Category.objects.all(),
-            'nav_pages': Article.objects.filter(
+            'nav_category_list': list(Category.objects.all()),
+            'nav_pages': list(Article.objects.filter(
                 type='p',
-                status='p'),
+                status='p').only('id', 'title', 'creation_time')),
             'OPEN_SITE_COMMENT': setting.open_site_comment,
             'BEIAN_CODE': setting.beian_code,
             'ANALYTICS_CODE': setting.analytics_code,
@@ -39,5 +40,7 @@ def seo_processor(requests):
             "GLOBAL_FOOTER": setting.global_footer,
             "COMMENT_NEED_REVIEW": setting.comment_need_review,
         }
-        cache.set(key, value, 60 * 60 * 10)
+        set_with_dependencies(
+            key, value, 60 * 60 * 10,
+            dependencies=[model_tag(BlogSettings), model_tag(Category), model_tag(Article)])
         return value
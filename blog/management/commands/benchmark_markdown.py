@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog.models import Article
+from djangoblog.utils import CommonMarkdown, code_highlighter
+
+
+class Command(BaseCommand):
+    help = 'benchmark re-rendering edited article bodies with and without the code highlight cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='number of articles in the corpus')
+        parser.add_argument('--repeat', type=int, default=3, help='edits rendered per article')
+
+    def handle(self, *args, **options):
+        bodies = list(Article.objects.order_by('-id').values_list('body', flat=True)[:options['limit']])
+        if not bodies:
+            self.stdout.write(self.style.WARNING('no articles to benchmark'))
+            return
+        repeat = options['repeat']
+        enabled = code_highlighter.enabled
+        try:
+            code_highlighter.enabled = False
+            uncached = self.run(bodies, repeat)
+            code_highlighter.enabled = True
+            # 先渲染一次原文，模拟修改已发布的文章
+            for body in bodies:
+                CommonMarkdown._convert_markdown(body)
+            cached = self.run(bodies, repeat)
+        finally:
+            code_highlighter.enabled = enabled
+        renders = len(bodies) * repeat
+        self.stdout.write('articles:%d renders:%d' % (len(bodies), renders))
+        self.stdout.write('without highlight cache: %.2fms/render' % (uncached / renders * 1000))
+        self.stdout.write('with highlight cache:    %.2fms/render' % (cached / renders * 1000))
+        self.stdout.write(self.style.SUCCESS('speedup: %.1fx' % (uncached / cached if cached else 0)))
+
+    @staticmethod
+    def run(bodies, repeat):
+        """
+        每篇文章末尾追加一段不同的文字后重新转换，直接调用转换函数，不经过整篇内容的缓存
+        :return: 总耗时秒数
+        """
+        start = time.perf_counter()
+        for i in range(repeat):
+            for body in bodies:
+                CommonMarkdown._convert_markdown('{body}\n\nedited paragraph {i}\n'.format(body=body, i=i))
+        return time.perf_counter() - start
@@ -0,0 +1,43 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+
+from djangoblog.cache_backend import CacheMetrics, SafeRedisCache
+
+
+class Command(BaseCommand):
+    help = 'show redis cache latency, error and circuit breaker metrics of all processes'
+
+    def handle(self, *args, **options):
+        backends = [caches[alias] for alias in settings.CACHES]
+        backends = [b for b in backends if isinstance(b, SafeRedisCache)]
+        if not backends:
+            self.stdout.write(self.style.WARNING('no SafeRedisCache configured'))
+            return
+        for backend in backends:
+            try:
+                published = backend.get_published_metrics()
+            except Exception as e:
+                self.stdout.write(self.style.ERROR('read metrics failed: %s' % e))
+                continue
+            for process, data in sorted(published.items()):
+                self.stdout.write(self.style.SUCCESS(
+                    '%s breaker:%s updated:%ds ago' % (
+                        process, data['breaker'], time.time() - data['time'])))
+                for operation, op in sorted(data['operations'].items()):
+                    histogram = op['histogram']
+                    avg = op['total_ms'] / op['calls'] if op['calls'] else 0
+                    self.stdout.write(
+                        '  %-12s calls:%-8d errors:%-6d short_circuited:%-6d '
+                        'avg:%.2fms p50:%sms p95:%sms p99:%sms' % (
+                            operation, op['calls'], op['errors'], op['short_circuited'], avg,
+                            self.format_percentile(histogram, 0.5),
+                            self.format_percentile(histogram, 0.95),
+                            self.format_percentile(histogram, 0.99)))
+
+    @staticmethod
+    def format_percentile(histogram, q):
+        value = CacheMetrics.percentile(histogram, q)
+        return '>%d' % CacheMetrics.BUCKETS[-1] if value is None else value
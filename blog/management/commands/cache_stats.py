@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from djangoblog.cache_stats import stats
+
+
+class Command(BaseCommand):
+    help = 'show cache hit/miss/size/compute time statistics grouped by key prefix'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='output json')
+        parser.add_argument('--reset', action='store_true', help='reset statistics')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            stats.reset()
+            self.stdout.write(self.style.SUCCESS('cache stats reset'))
+            return
+        result = stats.load()
+        if options['json']:
+            self.stdout.write(json.dumps(result, indent=2))
+            return
+        if not result:
+            self.stdout.write(self.style.WARNING('no cache stats yet'))
+            return
+        self.stdout.write('%-40s %10s %10s %8s %8s %10s %14s' % (
+            'prefix', 'hits', 'misses', 'hit%', 'sets', 'avg_size', 'avg_compute_ms'))
+        for prefix, item in sorted(result.items(), key=lambda i: -(i[1]['avg_size'] or 0) * i[1]['sets']):
+            self.stdout.write('%-40s %10d %10d %8s %8d %10s %14s' % (
+                prefix, item['hits'], item['misses'],
+                '-' if item['hit_rate'] is None else '%.1f' % (item['hit_rate'] * 100),
+                item['sets'],
+                '-' if item['avg_size'] is None else item['avg_size'],
+                '-' if item['avg_compute_ms'] is None else item['avg_compute_ms']))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from blog.models import Article
+from blog.view_counter import view_counter
+
+
+class Command(BaseCommand):
+    help = 'write buffered article views back to the database'
+
+    def handle(self, *args, **options):
+        # 计数的进程可能已经退出，检查所有文章的缓冲计数
+        article_ids = Article.objects.values_list('id', flat=True)
+        total = view_counter.flush(article_ids)
+        self.stdout.write(self.style.SUCCESS('flushed %d views' % total))
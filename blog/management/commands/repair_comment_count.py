@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from comments.models import update_comment_count
+
+
+class Command(BaseCommand):
+    help = 'recompute the denormalized comment count of all articles'
+
+    def handle(self, *args, **options):
+        total = update_comment_count()
+        self.stdout.write(self.style.SUCCESS('repaired comment count of %d articles' % total))
@@ -0,0 +1,171 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from blog.models import Article
+from comments.models import Comment
+from djangoblog.cache_dependency import invalidate, model_tag
+from djangoblog.utils import get_blog_setting
+
+# 检查点保存在文件中，进程退出或缓存清空后仍然可以继续
+CHECKPOINT_FILE = os.path.join(settings.BASE_DIR, '.rerender_content_{target}.checkpoint')
+TARGETS = {
+    'articles': Article,
+    'comments': Comment,
+}
+
+
+def init_worker():
+    # spawn 方式启动的子进程需要初始化 django，fork 方式时不做任何事
+    django.setup()
+    # 子进程不使用数据库，关闭 fork 时继承的连接，父进程的连接（可能在事务中）保持不变
+    connections.close_all()
+
+
+def render_rows(target, rows, excerpt_length):
+    """
+    在子进程中渲染一批文章或评论，不访问数据库
+    :param target: articles 或 comments
+    :param rows: [(id, body)]
+    :param excerpt_length: 列表页摘录长度
+    :return: [(id, {字段: 值})]
+    """
+    if target == 'comments':
+        return [(pk, Comment.render_body(body, use_cache=False)) for pk, body in rows]
+    return [(pk, Article.render_body(body, excerpt_length, use_cache=False)) for pk, body in rows]
+
+
+class Command(BaseCommand):
+    help = 'rerender stored article or comment html in parallel after changing markdown extensions, ' \
+           'the renderer or the comment sanitizer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=sorted(TARGETS), default='articles',
+                            help='rerender articles or backfill comments')
+        parser.add_argument('--batch-size', type=int, default=500, help='rows per batch')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='render processes, default cpu count, 0 renders in this process')
+        parser.add_argument('--start-id', type=int, default=None,
+                            help='only rerender rows with id greater than this')
+        parser.add_argument('--resume', action='store_true',
+                            help='continue after the last checkpoint of an interrupted run')
+        parser.add_argument('--checkpoint-file', default=None,
+                            help='file that records the last written id, default %s' % CHECKPOINT_FILE)
+
+    def handle(self, *args, **options):
+        target = options['target']
+        model = TARGETS[target]
+        checkpoint_file = options['checkpoint_file'] or CHECKPOINT_FILE.format(target=target)
+        start_id = options['start_id']
+        if start_id is None:
+            start_id = self.read_checkpoint(checkpoint_file) if options['resume'] else 0
+        batch_size = options['batch_size']
+        workers = options['workers']
+        excerpt_length = get_blog_setting().article_sub_length
+        render_version = model.get_render_version()
+
+        total = model.objects.filter(pk__gt=start_id).count()
+        self.stdout.write('rerender %d %s after id %d' % (total, target, start_id))
+        if not total:
+            return
+
+        start = time.perf_counter()
+        done = skipped = 0
+        batches = self.iter_batches(model, start_id, batch_size)
+        for batch, results in self.render_batches(target, batches, workers, excerpt_length):
+            batch_skipped, tags = self.write_results(model, batch, results, render_version)
+            skipped += batch_skipped
+            # 强制重新渲染时版本号不变，缓存不会自然过期，每批写回后使相关缓存失效
+            invalidate(*tags)
+            # 按顺序完成，检查点之前的行都已写回
+            self.write_checkpoint(checkpoint_file, results[-1][0])
+            done += len(results)
+            elapsed = time.perf_counter() - start
+            self.stdout.write('%d/%d checkpoint:%d %.1f rows/s' % (
+                done, total, results[-1][0], done / elapsed if elapsed else 0))
+
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS('rerendered %d %s in %.1fs, %.1f rows/s, %d changed during the run' % (
+            done - skipped, target, elapsed, done / elapsed if elapsed else 0, skipped)))
+
+    @staticmethod
+    def read_checkpoint(checkpoint_file):
+        try:
+            with open(checkpoint_file) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            raise CommandError('no checkpoint in %s, pass --start-id to choose where to continue' % checkpoint_file)
+
+    @staticmethod
+    def write_checkpoint(checkpoint_file, last_id):
+        # 先写临时文件再替换，中断时不会留下不完整的检查点
+        tmp_file = checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(str(last_id))
+        os.replace(tmp_file, checkpoint_file)
+
+    @staticmethod
+    def write_results(model, batch, results, render_version):
+        """
+        写回一批渲染结果，渲染期间正文被修改的行跳过，这些行保存时已经重新渲染
+        :param batch: 渲染时读取的 [(id, body)]
+        :return: (跳过的行数, 需要失效的缓存标签)
+        """
+        bodies = dict(batch)
+        # 评论树按文章缓存，重新渲染评论后使所属文章的缓存失效
+        article_field = 'pk' if model is Article else 'article_id'
+        with transaction.atomic():
+            rows = model.objects.select_for_update().filter(
+                pk__in=[pk for pk, values in results]).values_list('pk', 'body', article_field)
+            current = {pk: (body, article_id) for pk, body, article_id in rows}
+            objs = [model(pk=pk, render_version=render_version, **values) for pk, values in results
+                    if pk in current and current[pk][0] == bodies[pk]]
+            model.objects.bulk_update(objs, list(model.RENDERED_FIELDS))
+        tags = {model_tag(Article, current[obj.pk][1]) for obj in objs}
+        if objs:
+            tags.add(model_tag(model))
+        return len(results) - len(objs), tags
+
+    @staticmethod
+    def iter_batches(model, start_id, batch_size):
+        """
+        按id顺序分批读取正文，每批一条短查询，写回时没有未读完的游标
+        """
+        last_id = start_id
+        while True:
+            batch = list(model.objects.filter(pk__gt=last_id).order_by('pk').values_list(
+                'pk', 'body')[:batch_size].iterator())
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1][0]
+
+    @staticmethod
+    def render_batches(target, batches, workers, excerpt_length):
+        """
+        分批渲染，按提交顺序返回 (读取的行, 渲染结果)，同时最多有 workers * 2 批在处理中，内存占用与总行数无关
+        """
+        if workers == 0:
+            for batch in batches:
+                yield batch, render_rows(target, batch, excerpt_length)
+            return
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            pending = deque()
+            max_pending = workers * 2
+            for batch in batches:
+                pending.append((batch, executor.submit(render_rows, target, batch, excerpt_length)))
+                if len(pending) >= max_pending:
+                    batch, future = pending.popleft()
+                    yield batch, future.result()
+            while pending:
+                batch, future = pending.popleft()
+                yield batch, future.result()
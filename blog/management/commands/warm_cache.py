@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from blog.cache_warmer import warm_cache
+
+
+class Command(BaseCommand):
+    help = 'warm up index pages, the largest listings, sidebars and the most read articles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20,
+                            help='warm the top N articles by views')
+        parser.add_argument('--pages', type=int, default=2,
+                            help='warm the first K pages of the index and each listing')
+        parser.add_argument('--listings', type=int, default=10,
+                            help='warm the N category, tag and author listings with the most articles')
+        parser.add_argument('--host', default=None,
+                            help='Host header of the requests, must match what real visitors send')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='number of pages rendered at the same time')
+
+    def handle(self, *args, **options):
+        succeeded, failed, elapsed = warm_cache(
+            options['top'], options['pages'], options['concurrency'],
+            options['listings'], options['host'])
+        self.stdout.write(self.style.SUCCESS(
+            'warmed %d pages, %d failed, %.2fs' % (succeeded, failed, elapsed)))
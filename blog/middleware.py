@@ -1,10 +1,19 @@
+import gzip
 import logging
 import time
+from urllib.parse import urlencode
 
+from django.conf import settings
+from django.http import HttpResponse
+from django.middleware.gzip import re_accepts_gzip
+from django.urls import Resolver404, resolve
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from ipware import get_client_ip
 from user_agents import parse
 
 from blog.documents import ELASTICSEARCH_ENABLED, ElaspedTimeDocumentManager
+from djangoblog.cache_dependency import USER_PROFILE_TAG, get_generation
+from djangoblog.utils import cache, get_sha256
 
 logger = logging.getLogger(__name__)
 
@@ -40,3 +49,119 @@ class OnlineMiddleware(object):
                 logger.error("Error OnlineMiddleware: %s" % e)
 
         return response
+
+
+# 页面中任意一处内容变化都需要失效整页缓存（侧边栏包含文章、评论、标签、链接等）。
+# 用户每次登录都会保存 last_login，因此只依赖页面上显示的用户资料，见 USER_PROFILE_TAG
+PAGE_CACHE_DEPENDENCIES = [
+    'blog.article', 'blog.category', 'blog.tag', 'blog.links', 'blog.sidebar',
+    'blog.blogsettings', 'comments.comment', USER_PROFILE_TAG,
+    'oauth.oauthuser', 'oauth.oauthconfig', 'sites.site',
+]
+# 这些响应头由缓存中间件在命中时重新生成
+PAGE_CACHE_SKIP_HEADERS = {'content-length', 'content-encoding', 'set-cookie', 'vary'}
+
+
+class AnonymousPageCacheMiddleware(object):
+    """
+    匿名用户整页缓存
+    key 由 host、路径、查询参数、语言以及依赖内容的版本号组成，文章、评论、分类等变化时版本号加一，
+    所有页面一次性失效。页面以 gzip 压缩后保存，客户端支持 gzip 时直接返回压缩后的内容。
+    以下情况不使用缓存：
+        登录用户；
+        渲染时使用了 csrf token 或修改了 session/cookie 的页面；
+        设置了 ``Cache-Control: private`` 或 ``no-store`` 的响应（例如使用 ``never_cache`` 装饰的视图）；
+        带有 ``PAGE_CACHE_QUERY_PARAMS`` 以外查询参数的请求，避免随机参数占满缓存。
+    """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+        super().__init__()
+
+    def __call__(self, request):
+        match = self.get_cacheable_match(request)
+        if match is None:
+            return self.get_response(request)
+        key = self.get_cache_key(request)
+        page = cache.get(key)
+        if page is not None:
+            self.on_cache_hit(request, match)
+            return self.build_response(request, page)
+        response = self.get_response(request)
+        if self.is_response_cacheable(request, response):
+            cache.set(key, self.build_page(response), settings.PAGE_CACHE_TIMEOUT)
+        return response
+
+    @staticmethod
+    def get_cacheable_match(request):
+        if not settings.PAGE_CACHE_ENABLED or request.method not in ('GET', 'HEAD'):
+            return None
+        if settings.SESSION_COOKIE_NAME in request.COOKIES and request.user.is_authenticated:
+            return None
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        if match.view_name not in settings.PAGE_CACHE_VIEWS:
+            return None
+        if any(param not in settings.PAGE_CACHE_QUERY_PARAMS for param in request.GET):
+            return None
+        return match
+
+    @staticmethod
+    def get_cache_key(request):
+        raw = '{host}{path}?{query}#{language}'.format(
+            host=request.get_host(),
+            path=request.path,
+            query=urlencode(sorted(request.GET.items())),
+            language=getattr(request, 'LANGUAGE_CODE', settings.LANGUAGE_CODE))
+        return 'page_cache:{generation}:{hash}'.format(
+            generation=get_generation(*PAGE_CACHE_DEPENDENCIES), hash=get_sha256(raw))
+
+    @staticmethod
+    def is_response_cacheable(request, response):
+        if response.status_code != 200 or response.streaming:
+            return False
+        if response.has_header('Content-Encoding') or response.cookies:
+            return False
+        cache_control = response.get('Cache-Control', '')
+        if 'private' in cache_control or 'no-store' in cache_control:
+            return False
+        if request.META.get('CSRF_COOKIE_NEEDS_UPDATE'):
+            return False
+        session = getattr(request, 'session', None)
+        if session is not None and session.modified:
+            return False
+        return True
+
+    @staticmethod
+    def build_page(response):
+        headers = [(k, v) for k, v in response.items() if k.lower() not in PAGE_CACHE_SKIP_HEADERS]
+        return {
+            'headers': headers,
+            'content': gzip.compress(response.content, compresslevel=6),
+        }
+
+    @staticmethod
+    def build_response(request, page):
+        accepts_gzip = re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if accepts_gzip:
+            response = HttpResponse(page['content'])
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(gzip.decompress(page['content']))
+        for k, v in page['headers']:
+            response.headers[k] = v
+        etag = response.get('ETag')
+        if accepts_gzip and etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Length'] = str(len(response.content))
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return get_conditional_response(request, etag=response.get('ETag'), response=response)
+
+    @staticmethod
+    def on_cache_hit(request, match):
+        # 详情页命中缓存时视图不会执行，单独记录阅读数
+        if match.view_name == 'blog:detailbyid' and not request.META.get('CACHE_WARMUP'):
+            from blog.view_counter import view_counter
+            view_counter.record(match.kwargs['article_id'])
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.20 on 2026-10-19 03:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0006_alter_blogsettings_options'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['-article_order', '-pub_time', '-id'], name='blog_article_keyset_idx'),
+        ),
+    ]
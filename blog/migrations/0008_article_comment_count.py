@@ -0,0 +1,30 @@
+# Generated by Django 4.2.20 on 2026-10-19 04:04
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_comment_count(apps, schema_editor):
+    Article = apps.get_model('blog', 'Article')
+    Comment = apps.get_model('comments', 'Comment')
+    counts = Comment.objects.filter(article=OuterRef('pk'), is_enable=True).order_by().values(
+        'article').annotate(count=Count('pk')).values('count')
+    Article.objects.update(comment_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0007_article_keyset_index'),
+        ('comments', '0003_alter_comment_options_remove_comment_created_time_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='comment count'),
+        ),
+        migrations.RunPython(fill_comment_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.20 on 2026-10-19 04:12
+
+from django.db import migrations, models
+
+
+def fill_category_path(apps, schema_editor):
+    Category = apps.get_model('blog', 'Category')
+    parents = dict(Category.objects.values_list('pk', 'parent_category_id'))
+    paths = {}
+
+    def get_path(pk, seen=()):
+        if pk not in paths:
+            parent = parents[pk]
+            # 已有数据中出现循环时从循环处截断
+            prefix = get_path(parent, seen + (pk,)) if parent and parent not in seen else '/'
+            paths[pk] = '{prefix}{pk}/'.format(prefix=prefix, pk=pk)
+        return paths[pk]
+
+    for pk in parents:
+        Category.objects.filter(pk=pk).update(path=get_path(pk))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0008_article_comment_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255, verbose_name='path'),
+        ),
+        migrations.RunPython(fill_category_path, migrations.RunPython.noop),
+    ]
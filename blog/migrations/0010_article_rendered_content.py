@@ -0,0 +1,38 @@
+# Generated by Django 4.2.20 on 2026-10-19 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0009_category_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='body_html',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='body html'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='excerpt',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='excerpt'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='render_version',
+            field=models.CharField(blank=True, default='', editable=False, max_length=32, verbose_name='render version'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='summary',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='summary'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='toc_html',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='toc html'),
+        ),
+    ]
@@ -3,15 +3,21 @@ from abc import abstractmethod
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from django.template.defaultfilters import truncatechars_html
 from django.urls import reverse
-from django.utils.timezone import now
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+from django.utils.timezone import is_aware, localtime, now
 from django.utils.translation import gettext_lazy as _
 from mdeditor.fields import MDTextField
 from uuslug import slugify
 
-from djangoblog.utils import cache_decorator, cache
-from djangoblog.utils import get_current_site
+from djangoblog.cache_dependency import model_tag, set_with_dependencies
+from djangoblog.utils import CommonMarkdown, cache_decorator, cache
+from djangoblog.utils import get_blog_setting, get_current_site
 
 logger = logging.getLogger(__name__)
 
@@ -87,6 +93,8 @@ class Article(BaseModel):
         default='o')
     type = models.CharField(_('type'), max_length=1, choices=TYPE, default='a')
     views = models.PositiveIntegerField(_('views'), default=0)
+    # 已审核评论数，评论增删和审核时在同一事务中原子增减
+    comment_count = models.PositiveIntegerField(_('comment count'), default=0, editable=False)
     author = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         verbose_name=_('author'),
@@ -103,6 +111,16 @@ class Article(BaseModel):
         blank=False,
         null=False)
     tags = models.ManyToManyField('Tag', verbose_name=_('tag'), blank=True)
+    # 保存时渲染好的正文、目录、纯文本摘要和列表页摘录，见 render()
+    body_html = models.TextField(_('body html'), blank=True, default='', editable=False)
+    toc_html = models.TextField(_('toc html'), blank=True, default='', editable=False)
+    summary = models.TextField(_('summary'), blank=True, default='', editable=False)
+    excerpt = models.TextField(_('excerpt'), blank=True, default='', editable=False)
+    render_version = models.CharField(
+        _('render version'), max_length=32, blank=True, default='', editable=False)
+
+    RENDERED_FIELDS = ('body_html', 'toc_html', 'summary', 'excerpt', 'render_version')
+    SUMMARY_LENGTH = 200
 
     def body_to_string(self):
         return self.body
@@ -115,6 +133,10 @@ class Article(BaseModel):
         verbose_name = _('article')
         verbose_name_plural = verbose_name
         get_latest_by = 'id'
+        indexes = [
+            # 列表游标分页的排序和范围查询
+            models.Index(fields=['-article_order', '-pub_time', '-id'], name='blog_article_keyset_idx'),
+        ]
 
     def get_absolute_url(self):
         return reverse('blog:detailbyid', kwargs={
@@ -124,7 +146,8 @@ class Article(BaseModel):
             'day': self.creation_time.day
         })
 
-    @cache_decorator(60 * 60 * 10)
+    @cache_decorator(60 * 60 * 10,
+                     dependencies=lambda self: [model_tag(Article, self.pk), model_tag(Category)])
     def get_category_tree(self):
         tree = self.category.get_category_tree()
         names = list(map(lambda c: (c.name, c.get_absolute_url()), tree))
@@ -132,38 +155,165 @@ class Article(BaseModel):
         return names
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if not self._state.adding and (update_fields is None or set(update_fields) - {'views'}):
+            # 修改时间用于 sitemap 和列表页卡片片段缓存的版本
+            self.last_modify_time = now()
+            if update_fields is not None:
+                update_fields = kwargs['update_fields'] = set(update_fields) | {'last_modify_time'}
+        if (update_fields is None or 'body' in update_fields) and self.needs_render():
+            self.render()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | set(Article.RENDERED_FIELDS)
+        with transaction.atomic():
+            if update_fields is None and not self._state.adding:
+                # 评论数只由评论的增删和审核原子更新，完整保存文章时先读取数据库中的值（并锁定该行），
+                # 不写回内存中可能已过期的值；记录不存在时仍按 Django 的默认行为插入
+                comment_count = Article.objects.select_for_update().filter(pk=self.pk).values_list(
+                    'comment_count', flat=True).first()
+                if comment_count is not None:
+                    self.comment_count = comment_count
+            super().save(*args, **kwargs)
+        if 'body' in self.__dict__:
+            self._loaded_body = self.body
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录从数据库读取的正文，保存时正文没有变化就不重新渲染
+        if 'body' in instance.__dict__:
+            instance._loaded_body = instance.body
+        return instance
+
+    def needs_render(self):
+        """新建、正文修改过或渲染结果是旧版本时需要重新渲染，正文未加载时不可能被修改"""
+        if self._state.adding or self.render_version != Article.get_render_version():
+            return True
+        return 'body' in self.__dict__ and self.body != getattr(self, '_loaded_body', None)
+
+    @staticmethod
+    def get_render_version():
+        """渲染结果的版本，渲染器版本或列表页摘录长度变化时改变"""
+        return '{version}:{length}'.format(
+            version=CommonMarkdown.VERSION, length=get_blog_setting().article_sub_length)
+
+    @staticmethod
+    def render_body(body, excerpt_length, use_cache=True):
+        """
+        渲染正文 HTML、目录、纯文本摘要和列表页摘录，一次 markdown 转换，不访问数据库
+        :param body: markdown 正文
+        :param excerpt_length: 列表页摘录长度
+        :param use_cache: 是否使用 markdown 渲染缓存，批量重新渲染时强制重新转换
+        :return: {字段: 值}
+        """
+        if use_cache:
+            body_html, toc_html = CommonMarkdown.get_markdown_with_toc(body)
+        else:
+            body_html, toc_html = CommonMarkdown._convert_markdown(body)
+        return {
+            'body_html': body_html,
+            'toc_html': toc_html,
+            'summary': Truncator(strip_tags(body_html).strip()).chars(Article.SUMMARY_LENGTH),
+            'excerpt': truncatechars_html(body_html, excerpt_length),
+        }
+
+    def render(self):
+        for field, value in Article.render_body(self.body, get_blog_setting().article_sub_length).items():
+            setattr(self, field, value)
+        self.render_version = Article.get_render_version()
+
+    def ensure_rendered(self):
+        """
+        渲染结果是旧版本（升级了渲染器、修改了摘录长度或历史数据）时重新渲染并写回，
+        正常情况下只比较版本号
+        """
+        if self.render_version != Article.get_render_version():
+            self.render()
+            Article.objects.filter(pk=self.pk).update(
+                **{field: getattr(self, field) for field in Article.RENDERED_FIELDS})
+        return self
+
+    @classmethod
+    def ensure_rendered_bulk(cls, articles):
+        """
+        批量重新渲染旧版本的文章，一次查询读取这些文章的正文，一次 bulk_update 写回，
+        列表页不需要读取正文，正常情况下只比较版本号
+        :param articles: 文章列表，可以延迟加载正文
+        :return: 重新渲染的文章数
+        """
+        version = cls.get_render_version()
+        stale = [article for article in articles if article.render_version != version]
+        if not stale:
+            return 0
+        bodies = dict(cls.objects.filter(pk__in=[a.pk for a in stale]).values_list('pk', 'body'))
+        excerpt_length = get_blog_setting().article_sub_length
+        for article in stale:
+            for field, value in cls.render_body(bodies.get(article.pk, ''), excerpt_length).items():
+                setattr(article, field, value)
+            article.render_version = version
+        cls.objects.bulk_update(stale, list(cls.RENDERED_FIELDS))
+        return len(stale)
+
+    def get_cache_dependency_tags(self):
+        """
+        文章变更时需要失效的关联标签：所属分类及其父级、标签、作者
+        """
+        tags = [model_tag(Category, c.pk)
+                for c in self.category.get_category_tree()]
+        tags.extend(model_tag(Tag, pk)
+                    for pk in self.tags.values_list('pk', flat=True))
+        tags.append(Article.author_cache_tag(self.author.username))
+        tags.append(Article.archive_cache_tag(self.pub_time))
+        return tags
+
+    @staticmethod
+    def author_cache_tag(username):
+        """作者文章列表的缓存标签"""
+        return '{tag}:author:{username}'.format(tag=model_tag(Article), username=username)
+
+    @staticmethod
+    def archive_cache_tag(pub_time):
+        """归档页某个月份文章列表的缓存标签"""
+        if is_aware(pub_time):
+            pub_time = localtime(pub_time)
+        return '{tag}:archive:{month}'.format(tag=model_tag(Article), month=pub_time.strftime('%Y-%m'))
 
     def viewed(self):
-        self.views += 1
-        self.save(update_fields=['views'])
+        """记录一次阅读，阅读数先缓冲在缓存中，定期批量写回数据库，views 为包含缓冲部分的总数"""
+        from blog.view_counter import view_counter
+        self.views += view_counter.record(self.id)
 
-    def comment_list(self):
+    def comment_tree(self):
+        """已审核评论组成的评论树，按文章缓存"""
         cache_key = 'article_comments_{id}'.format(id=self.id)
         value = cache.get(cache_key)
-        if value:
+        if value is not None:
             logger.info('get article comments:{id}'.format(id=self.id))
             return value
-        else:
-            comments = self.comment_set.filter(is_enable=True).order_by('-id')
-            cache.set(cache_key, comments, 60 * 100)
-            logger.info('set article comments:{id}'.format(id=self.id))
-            return comments
+        from comments.tree import CommentTree
+        tree = CommentTree.load(self)
+        set_with_dependencies(cache_key, tree, 60 * 100,
+                              dependencies=[model_tag(Article, self.id)])
+        logger.info('set article comments:{id}'.format(id=self.id))
+        return tree
+
+    def comment_list(self):
+        """已审核的评论，按id倒序"""
+        return self.comment_tree().comments
 
     def get_admin_url(self):
         info = (self._meta.app_label, self._meta.model_name)
         return reverse('admin:%s_%s_change' % info, args=(self.pk,))
 
-    @cache_decorator(expiration=60 * 100)
     def next_article(self):
         # 下一篇
-        return Article.objects.filter(
-            id__gt=self.id, status='p').order_by('id').first()
+        from blog.neighbor_index import neighbor_index
+        return neighbor_index.next(self.id)
 
-    @cache_decorator(expiration=60 * 100)
     def prev_article(self):
         # 前一篇
-        return Article.objects.filter(id__lt=self.id, status='p').first()
+        from blog.neighbor_index import neighbor_index
+        return neighbor_index.prev(self.id)
 
 
 class Category(BaseModel):
@@ -177,6 +327,8 @@ class Category(BaseModel):
         on_delete=models.CASCADE)
     slug = models.SlugField(default='no-slug', max_length=60, blank=True)
     index = models.IntegerField(default=0, verbose_name=_('index'))
+    # 物化路径，如 /1/3/7/，由父级到自身的id组成，保存时维护
+    path = models.CharField(_('path'), max_length=255, default='', editable=False, db_index=True)
 
     class Meta:
         ordering = ['-index']
@@ -191,42 +343,71 @@ class Category(BaseModel):
     def __str__(self):
         return self.name
 
-    @cache_decorator(60 * 60 * 10)
-    def get_category_tree(self):
+    def clean(self):
+        if self.pk and self.parent_category_id and self.path and \
+                self.parent_category.path.startswith(self.path):
+            raise ValidationError(_('parent category can not be itself or its sub category'))
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.update_path()
+
+    def update_path(self):
         """
-        递归获得分类目录的父级
-        :return:
+        根据父级重新计算路径，路径变化时用一条 UPDATE 同步修改所有子孙分类的路径
         """
-        categorys = []
+        parent_path = '/'
+        if self.parent_category_id:
+            parent = Category.objects.get(pk=self.parent_category_id)
+            # bulk_create、fixtures 等方式创建的父级没有路径，先补齐
+            parent_path = parent.ensure_path()
+        old_path = Category.objects.filter(pk=self.pk).values_list('path', flat=True).get()
+        if old_path and parent_path.startswith(old_path):
+            raise ValidationError(_('parent category can not be itself or its sub category'))
+        path = '{parent}{pk}/'.format(parent=parent_path, pk=self.pk)
+        if path == old_path:
+            self.path = path
+            return
+        if old_path:
+            Category.objects.filter(path__startswith=old_path).update(
+                path=Concat(Value(path), Substr('path', len(old_path) + 1)))
+        else:
+            Category.objects.filter(pk=self.pk).update(path=path)
+        self.path = path
 
-        def parse(category):
-            categorys.append(category)
-            if category.parent_category:
-                parse(category.parent_category)
+    def ensure_path(self):
+        """
+        获得路径，没有经过 save 创建的分类（bulk_create、fixtures、直接写数据库）路径为空，
+        此时先补齐，避免空前缀匹配到所有分类
+        """
+        if not self.path:
+            self.update_path()
+        return self.path
 
-        parse(self)
-        return categorys
+    def get_ancestor_ids(self):
+        """
+        从路径中解析出父级id，从当前分类到顶级分类排列
+        """
+        return [int(pk) for pk in reversed(self.path.strip('/').split('/'))] if self.path else [self.pk]
 
-    @cache_decorator(60 * 60 * 10)
+    @cache_decorator(60 * 60 * 10, dependencies=['blog.category'])
+    def get_category_tree(self):
+        """
+        获得分类目录的父级，根据路径一次查询
+        :return: 从当前分类到顶级分类
+        """
+        ids = self.get_ancestor_ids()
+        categorys = Category.objects.in_bulk(ids)
+        return [categorys[pk] for pk in ids if pk in categorys]
+
+    @cache_decorator(60 * 60 * 10, dependencies=['blog.category'])
     def get_sub_categorys(self):
         """
-        获得当前分类目录所有子集
+        获得当前分类目录及所有子集，根据路径前缀一次查询
         :return:
         """
-        categorys = []
-        all_categorys = Category.objects.all()
-
-        def parse(category):
-            if category not in categorys:
-                categorys.append(category)
-            childs = all_categorys.filter(parent_category=category)
-            for child in childs:
-                if category not in categorys:
-                    categorys.append(child)
-                parse(child)
-
-        parse(self)
-        return categorys
+        return list(Category.objects.filter(path__startswith=self.ensure_path()).order_by('path'))
 
 
 class Tag(BaseModel):
@@ -240,9 +421,10 @@ class Tag(BaseModel):
     def get_absolute_url(self):
         return reverse('blog:tag_detail', kwargs={'tag_name': self.slug})
 
-    @cache_decorator(60 * 60 * 10)
     def get_article_count(self):
-        return Article.objects.filter(tags__name=self.name).distinct().count()
+        """已发布的文章数，从所有标签的统计中读取"""
+        from blog.tag_counts import tag_counts
+        return tag_counts.get(self.pk)
 
     class Meta:
         ordering = ['name']
@@ -358,8 +540,3 @@ class BlogSettings(models.Model):
     def clean(self):
         if BlogSettings.objects.exclude(id=self.id).count():
             raise ValidationError(_('There can only be one configuration'))
-
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        from djangoblog.utils import cache
-        cache.clear()
@@ -0,0 +1,149 @@
+"""
+已发布文章的上一篇/下一篇索引
+
+缓存中保存按id升序排列的已发布文章id，以及展示链接需要的标题和创建时间，
+文章发布、撤回、修改标题或删除的事务提交后由信号增量更新。每个进程保留一份副本，
+每次查找只读取一个很小的版本号，版本未变时直接在内存中二分查找，不需要查询数据库。
+
+重建和增量更新都持有同一把锁。重建期间其他进程的修改无法获得锁时会设置 ``DIRTY_KEY``，
+重建完成后发现该标记就作废刚写入的索引，不会把缺少这次修改的快照传播给所有进程。
+"""
+import bisect
+import logging
+import threading
+import uuid
+
+from django.db import router
+
+from djangoblog.utils import cache
+
+logger = logging.getLogger(__name__)
+
+INDEX_KEY = 'article_neighbor_index'
+VERSION_KEY = 'article_neighbor_index_version'
+LOCK_KEY = 'article_neighbor_index_lock'
+DIRTY_KEY = 'article_neighbor_index_dirty'
+LOCK_TIMEOUT = 60
+INDEX_TIMEOUT = 60 * 60 * 24
+# 与模型字段定义的顺序一致，用于 Article.from_db
+NEIGHBOR_FIELDS = ('id', 'creation_time', 'title')
+
+
+class NeighborIndex(object):
+
+    def __init__(self):
+        self._local = None
+        self._lock = threading.Lock()
+
+    def get_index(self):
+        """
+        获得当前索引，版本号与本进程副本一致时不读取完整索引
+        :return: {'version': 版本号, 'ids': [...], 'items': [(creation_time, title), ...]}
+        """
+        version = cache.get(VERSION_KEY)
+        with self._lock:
+            local = self._local
+        if local is not None and version is not None and local['version'] == version:
+            return local
+        index = cache.get(INDEX_KEY) if version is not None else None
+        if index is None or index['version'] != version:
+            index = self.build()
+        with self._lock:
+            self._local = index
+        return index
+
+    def build(self):
+        """
+        从数据库重建索引，其他进程正在重建或修改时只返回结果，不写入缓存
+        """
+        from blog.models import Article
+        locked = cache.add(LOCK_KEY, 1, LOCK_TIMEOUT)
+        try:
+            if locked:
+                cache.delete(DIRTY_KEY)
+            rows = Article.objects.filter(status='p').order_by('id').values_list(*NEIGHBOR_FIELDS)
+            index = {
+                'version': uuid.uuid4().hex,
+                'ids': [row[0] for row in rows],
+                'items': [row[1:] for row in rows],
+            }
+            if locked:
+                self._save(index)
+                if cache.get(DIRTY_KEY) is not None:
+                    # 重建期间有修改没有写入，作废刚保存的索引
+                    cache.delete(VERSION_KEY)
+        finally:
+            if locked:
+                cache.delete(LOCK_KEY)
+        logger.info('build article neighbor index:{count}'.format(count=len(index['ids'])))
+        return index
+
+    @staticmethod
+    def _save(index):
+        cache.set(INDEX_KEY, index, INDEX_TIMEOUT)
+        cache.set(VERSION_KEY, index['version'], INDEX_TIMEOUT)
+
+    def update(self, article_id, item=None):
+        """
+        文章保存或删除的事务提交后增量更新索引
+        :param article_id: 文章id
+        :param item: 已发布文章的 (创建时间, 标题)，未发布或已删除时为 None
+        """
+        if not cache.add(LOCK_KEY, 1, LOCK_TIMEOUT):
+            # 其他进程正在修改或重建，直接作废，下次查找时重建
+            self._invalidate()
+            return
+        try:
+            index = cache.get(INDEX_KEY)
+            if index is None or index['version'] != cache.get(VERSION_KEY):
+                return
+            ids, items = list(index['ids']), list(index['items'])
+            position = bisect.bisect_left(ids, article_id)
+            if position < len(ids) and ids[position] == article_id:
+                del ids[position]
+                del items[position]
+            if item is not None:
+                ids.insert(position, article_id)
+                items.insert(position, tuple(item))
+            self._save({'version': uuid.uuid4().hex, 'ids': ids, 'items': items})
+        finally:
+            cache.delete(LOCK_KEY)
+
+    @staticmethod
+    def _invalidate():
+        # 先设置标记再删除版本号，正在进行的重建结束时会看到标记
+        cache.set(DIRTY_KEY, 1, LOCK_TIMEOUT)
+        cache.delete(VERSION_KEY)
+
+    def clear(self):
+        self._invalidate()
+        cache.delete(INDEX_KEY)
+        with self._lock:
+            self._local = None
+
+    def next(self, article_id):
+        """id 比当前文章大的第一篇已发布文章"""
+        index = self.get_index()
+        position = bisect.bisect_right(index['ids'], article_id)
+        return self._get_article(index, position)
+
+    def prev(self, article_id):
+        """id 比当前文章小的最后一篇已发布文章"""
+        index = self.get_index()
+        position = bisect.bisect_left(index['ids'], article_id) - 1
+        return self._get_article(index, position)
+
+    @staticmethod
+    def _get_article(index, position):
+        """
+        根据索引中的字段构造文章，只包含 id、标题和创建时间，访问其他字段时才会查询
+        """
+        from blog.models import Article
+        if position < 0 or position >= len(index['ids']):
+            return None
+        return Article.from_db(
+            router.db_for_read(Article), NEIGHBOR_FIELDS,
+            (index['ids'][position],) + tuple(index['items'][position]))
+
+
+neighbor_index = NeighborIndex()
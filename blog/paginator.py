@@ -0,0 +1,100 @@
+"""
+文章列表的游标分页
+
+URL 仍然使用页码，但每一页按 ``(article_order, pub_time, id)`` 从上一页最后一行之后查询，
+不使用 OFFSET，深翻页和顺序抓取所有分页的爬虫都不会越来越慢。
+每一页的文章id、页末游标和列表总数都缓存在 ``cache_key`` 下，cache_key 中应包含列表的版本号，
+文章变化时整体失效。
+"""
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from djangoblog.utils import cache
+
+KEYSET_FIELDS = ('article_order', 'pub_time', 'id')
+
+
+class KeysetPaginator(Paginator):
+
+    def __init__(self, object_list, per_page, cache_key, keys=KEYSET_FIELDS,
+                 timeout=60 * 60 * 10, load_objects=None, **kwargs):
+        """
+        :param object_list: 文章queryset，按 keys 倒序排列
+        :param per_page: 每页条数
+        :param cache_key: 缓存key前缀
+        :param keys: 游标字段，最后一个字段需要唯一
+        :param timeout: 缓存过期时间
+        :param load_objects: 根据id列表按顺序加载当前页对象的函数，默认使用 in_bulk
+        """
+        super().__init__(object_list.order_by(*['-' + key for key in keys]), per_page, **kwargs)
+        self.cache_key = cache_key
+        self.keys = keys
+        self.timeout = timeout
+        self.load_objects = load_objects or self.in_bulk
+
+    @cached_property
+    def count(self):
+        key = '{key}_count'.format(key=self.cache_key)
+        count = cache.get(key)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(key, count, self.timeout)
+        return count
+
+    def page(self, number):
+        number = self.validate_number(number)
+        ids = self.get_page(number)['ids']
+        return self._get_page(self.load_objects(ids), number, self)
+
+    def in_bulk(self, ids):
+        objects = self.object_list.in_bulk(ids)
+        return [objects[i] for i in ids if i in objects]
+
+    def get_page(self, number):
+        """
+        获得某一页的文章id和页末游标
+        :param number: 页码
+        :return: {'ids': [...], 'cursor': (...)}
+        """
+        key = '{key}_p{number}'.format(key=self.cache_key, number=number)
+        page = cache.get(key)
+        if page is None:
+            cursor = self.get_cursor(number - 1) if number > 1 else None
+            rows = list(self.after(cursor).values_list(*self.keys)[:self.per_page])
+            page = {
+                'ids': [row[-1] for row in rows],
+                'cursor': rows[-1] if rows else cursor,
+            }
+            cache.set(key, page, self.timeout)
+        return page
+
+    def get_cursor(self, number):
+        """
+        获得第 number 页最后一行的游标
+        顺序翻页时直接使用上一页缓存的游标，直接跳到深页时只查询一行游标字段并缓存
+        """
+        page = cache.get('{key}_p{number}'.format(key=self.cache_key, number=number))
+        if page is not None:
+            return page['cursor']
+        key = '{key}_c{number}'.format(key=self.cache_key, number=number)
+        cursor = cache.get(key)
+        if cursor is None:
+            offset = min(number * self.per_page, self.count) - 1
+            cursor = self.object_list.values_list(*self.keys)[offset]
+            cache.set(key, cursor, self.timeout)
+        return cursor
+
+    def after(self, cursor):
+        """
+        游标之后的数据，即 (k1, k2, k3) < cursor
+        """
+        if cursor is None:
+            return self.object_list
+        condition = Q()
+        for i, key in enumerate(self.keys):
+            q = Q(**{key + '__lt': cursor[i]})
+            for prev_key, prev_value in zip(self.keys[:i], cursor[:i]):
+                q &= Q(**{prev_key: prev_value})
+            condition |= q
+        return self.object_list.filter(condition)
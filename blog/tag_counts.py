@@ -0,0 +1,100 @@
+"""
+标签的已发布文章数
+
+标签云和文章标签列表需要每个标签的文章数。这里用一条 ``GROUP BY`` 查询统计所有标签，
+结果 ``{标签id: 文章数}`` 整体缓存；文章增删标签、发布、撤回或删除时由信号增量修改，
+标签再多，渲染标签云的查询次数也是固定的。
+
+与上一篇/下一篇索引一样，重建和增量修改持有同一把锁。重建期间的修改无法获得锁时设置 ``DIRTY_KEY``，
+重建完成后发现该标记就丢弃刚写入的统计，不会用缺少这次修改的快照覆盖缓存。
+"""
+import logging
+
+from django.db.models import Count
+
+from djangoblog.utils import cache
+
+logger = logging.getLogger(__name__)
+
+TAG_COUNTS_KEY = 'tag_article_counts'
+LOCK_KEY = 'tag_article_counts_lock'
+DIRTY_KEY = 'tag_article_counts_dirty'
+LOCK_TIMEOUT = 60
+TAG_COUNTS_TIMEOUT = 60 * 60 * 10
+
+
+class TagCounts(object):
+
+    def get_counts(self):
+        """
+        获得所有标签的已发布文章数
+        :return: {标签id: 文章数}，没有文章的标签不在其中
+        """
+        counts = cache.get(TAG_COUNTS_KEY)
+        if counts is None:
+            counts = self.build()
+        return counts
+
+    def get(self, tag_id):
+        return self.get_counts().get(tag_id, 0)
+
+    def build(self):
+        """一条查询重新统计，其他进程正在重建或修改时只返回结果，不写入缓存"""
+        locked = cache.add(LOCK_KEY, 1, LOCK_TIMEOUT)
+        try:
+            if locked:
+                cache.delete(DIRTY_KEY)
+            counts = self.count_articles()
+            if locked:
+                cache.set(TAG_COUNTS_KEY, counts, TAG_COUNTS_TIMEOUT)
+                if cache.get(DIRTY_KEY) is not None:
+                    # 重建期间有修改没有写入，丢弃刚保存的统计
+                    cache.delete(TAG_COUNTS_KEY)
+        finally:
+            if locked:
+                cache.delete(LOCK_KEY)
+        logger.info('build tag article counts:{count}'.format(count=len(counts)))
+        return counts
+
+    @staticmethod
+    def count_articles():
+        from blog.models import Article
+        rows = Article.tags.through.objects.filter(article__status='p').values(
+            'tag_id').annotate(count=Count('article_id', distinct=True)).values_list('tag_id', 'count')
+        return dict(rows)
+
+    def change(self, tag_ids, delta):
+        """
+        增量修改标签的文章数
+        :param tag_ids: 标签id
+        :param delta: 每个标签的变化量
+        """
+        tag_ids = list(tag_ids)
+        if not tag_ids:
+            return
+        if not cache.add(LOCK_KEY, 1, LOCK_TIMEOUT):
+            # 其他进程正在修改或重建，直接作废，下次读取时重新统计
+            self.clear()
+            return
+        try:
+            counts = cache.get(TAG_COUNTS_KEY)
+            if counts is None:
+                return
+            for tag_id in tag_ids:
+                count = counts.get(tag_id, 0) + delta
+                if count > 0:
+                    counts[tag_id] = count
+                else:
+                    counts.pop(tag_id, None)
+            cache.set(TAG_COUNTS_KEY, counts, TAG_COUNTS_TIMEOUT)
+        finally:
+            cache.delete(LOCK_KEY)
+
+    @staticmethod
+    def clear():
+        # 先设置标记再删除，正在进行的重建结束时会看到标记
+        cache.set(DIRTY_KEY, 1, LOCK_TIMEOUT)
+        cache.delete(TAG_COUNTS_KEY)
+
+
+tag_counts = TagCounts()
@@ -6,17 +6,20 @@ import urllib
 from django import template
 from django.conf import settings
 from django.db.models import Q
-from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import stringfilter
+from django.template.loader import render_to_string
 from django.templatetags.static import static
 from django.urls import reverse
 from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
 
-from blog.models import Article, Category, Tag, Links, SideBar, LinkShowType
+from blog.models import Article, Category, Tag, Links, SideBar, LinkShowType, BlogSettings
+from blog.tag_counts import tag_counts
 from comments.models import Comment
+from djangoblog.cache_dependency import model_tag, register_dependencies, set_with_dependencies
 from djangoblog.utils import CommonMarkdown, sanitize_html
-from djangoblog.utils import cache
-from djangoblog.utils import get_current_site
+from djangoblog.utils import cache, get_sidebar_cache_key, get_stale_while_revalidate
+from djangoblog.utils import get_current_site, get_sha256
 from oauth.models import OAuthUser
 
 logger = logging.getLogger(__name__)
@@ -84,6 +87,10 @@ def truncate(content):
     return strip_tags(content)[:150]
 
 
+# 与 article_info.html 中 breadcrumb 片段缓存的时间一致
+BREADCRUMB_CACHE_TIMEOUT = 36000
+
+
 @register.inclusion_tag('blog/tags/breadcrumb.html')
 def load_breadcrumb(article):
     """
@@ -91,12 +98,18 @@ def load_breadcrumb(article):
     :param article:
     :return:
     """
+    from django.core.cache.utils import make_template_fragment_key
     names = article.get_category_tree()
     from djangoblog.utils import get_blog_setting
     blogsetting = get_blog_setting()
     site = get_current_site().domain
     names.append((blogsetting.site_name, '/'))
     names = names[::-1]
+    # 只有片段缓存未命中时才会执行到这里，登记 article_info.html 中 breadcrumb 片段的依赖
+    register_dependencies(
+        make_template_fragment_key('breadcrumb', [article.pk]),
+        [model_tag(Article, article.pk), model_tag(Category), model_tag(BlogSettings)],
+        BREADCRUMB_CACHE_TIMEOUT)
 
     return {
         'names': names,
@@ -113,10 +126,11 @@ def load_articletags(article):
     :return:
     """
     tags = article.tags.all()
+    counts = tag_counts.get_counts()
     tags_list = []
     for tag in tags:
         url = tag.get_absolute_url()
-        count = tag.get_article_count()
+        count = counts.get(tag.id, 0)
         tags_list.append((
             url, count, tag, random.choice(settings.BOOTSTRAP_COLOR_TYPES)
         ))
@@ -131,58 +145,68 @@ def load_sidebar(user, linktype):
     加载侧边栏
     :return:
     """
-    value = cache.get("sidebar" + linktype)
-    if value:
-        value['user'] = user
-        return value
-    else:
-        logger.info('load sidebar')
-        from djangoblog.utils import get_blog_setting
-        blogsetting = get_blog_setting()
-        recent_articles = Article.objects.filter(
-            status='p')[:blogsetting.sidebar_article_count]
-        sidebar_categorys = Category.objects.all()
-        extra_sidebars = SideBar.objects.filter(
-            is_enable=True).order_by('sequence')
-        most_read_articles = Article.objects.filter(status='p').order_by(
-            '-views')[:blogsetting.sidebar_article_count]
-        dates = Article.objects.datetimes('creation_time', 'month', order='DESC')
-        links = Links.objects.filter(is_enable=True).filter(
-            Q(show_type=str(linktype)) | Q(show_type=LinkShowType.A))
-        commment_list = Comment.objects.filter(is_enable=True).order_by(
-            '-id')[:blogsetting.sidebar_comment_count]
-        # 标签云 计算字体大小
-        # 根据总数计算出平均值 大小为 (数目/平均值)*步长
-        increment = 5
-        tags = Tag.objects.all()
-        sidebar_tags = None
-        if tags and len(tags) > 0:
-            s = [t for t in [(t, t.get_article_count()) for t in tags] if t[1]]
-            count = sum([t[1] for t in s])
-            dd = 1 if (count == 0 or not len(tags)) else count / len(tags)
-            import random
-            sidebar_tags = list(
-                map(lambda x: (x[0], x[1], (x[1] / dd) * increment + 10), s))
-            random.shuffle(sidebar_tags)
-
-        value = {
-            'recent_articles': recent_articles,
-            'sidebar_categorys': sidebar_categorys,
-            'most_read_articles': most_read_articles,
-            'article_dates': dates,
-            'sidebar_comments': commment_list,
-            'sidabar_links': links,
-            'show_google_adsense': blogsetting.show_google_adsense,
-            'google_adsense_codes': blogsetting.google_adsense_codes,
-            'open_site_comment': blogsetting.open_site_comment,
-            'show_gongan_code': blogsetting.show_gongan_code,
-            'sidebar_tags': sidebar_tags,
-            'extra_sidebars': extra_sidebars
-        }
-        cache.set("sidebar" + linktype, value, 60 * 60 * 60 * 3)
-        logger.info('set sidebar cache.key:{key}'.format(key="sidebar" + linktype))
-        value['user'] = user
-        return value
+    value = get_stale_while_revalidate(
+        get_sidebar_cache_key(linktype),
+        lambda: build_sidebar(linktype),
+        60 * 60 * 60 * 3,
+        dependencies=[model_tag(m) for m in (
+            Article, Category, Tag, Links, SideBar, Comment, BlogSettings)])
+    return dict(value, user=user)
+
+
+def build_sidebar(linktype):
+    """
+    生成侧边栏数据
+    """
+    logger.info('load sidebar')
+    from djangoblog.utils import get_blog_setting
+    blogsetting = get_blog_setting()
+    recent_articles = Article.objects.filter(
+        status='p')[:blogsetting.sidebar_article_count]
+    sidebar_categorys = Category.objects.all()
+    extra_sidebars = SideBar.objects.filter(
+        is_enable=True).order_by('sequence')
+    most_read_articles = Article.objects.filter(status='p').order_by(
+        '-views')[:blogsetting.sidebar_article_count]
+    dates = Article.objects.datetimes('creation_time', 'month', order='DESC')
+    links = Links.objects.filter(is_enable=True).filter(
+        Q(show_type=str(linktype)) | Q(show_type=LinkShowType.A))
+    # 侧边栏整体缓存，评论只取模板用到的字段
+    commment_list = Comment.objects.filter(is_enable=True).select_related(
+        'author', 'article').only(
+        'author__username', 'article__title', 'article__creation_time').order_by(
+        '-id')[:blogsetting.sidebar_comment_count]
+    # 标签云 计算字体大小
+    # 根据总数计算出平均值 大小为 (数目/平均值)*步长
+    increment = 5
+    tags = Tag.objects.all()
+    sidebar_tags = None
+    if tags and len(tags) > 0:
+        counts = tag_counts.get_counts()
+        s = [t for t in [(t, counts.get(t.id, 0)) for t in tags] if t[1]]
+        count = sum([t[1] for t in s])
+        dd = 1 if (count == 0 or not len(tags)) else count / len(tags)
+        import random
+        sidebar_tags = list(
+            map(lambda x: (x[0], x[1], (x[1] / dd) * increment + 10), s))
+        random.shuffle(sidebar_tags)
+
+    value = {
+        'recent_articles': recent_articles,
+        'sidebar_categorys': sidebar_categorys,
+        'most_read_articles': most_read_articles,
+        'article_dates': dates,
+        'sidebar_comments': commment_list,
+        'sidabar_links': links,
+        'show_google_adsense': blogsetting.show_google_adsense,
+        'google_adsense_codes': blogsetting.google_adsense_codes,
+        'open_site_comment': blogsetting.open_site_comment,
+        'show_gongan_code': blogsetting.show_gongan_code,
+        'sidebar_tags': sidebar_tags,
+        'extra_sidebars': extra_sidebars
+    }
+    logger.info('set sidebar cache.key:{key}'.format(key=get_sidebar_cache_key(linktype)))
+    return value
 
 
 @register.inclusion_tag('blog/tags/article_meta_info.html')
@@ -200,6 +224,12 @@ def load_article_metas(article, user):
 
 @register.inclusion_tag('blog/tags/article_pagination.html')
 def load_pagination_info(page_obj, page_type, tag_name):
+    """
+    分页链接
+    :param page_obj: 当前页
+    :param page_type: 页面类型
+    :param tag_name: 分类和标签页为url中的slug，作者页为作者名
+    """
     previous_url = ''
     next_url = ''
     if page_type == '':
@@ -212,21 +242,20 @@ def load_pagination_info(page_obj, page_type, tag_name):
                 'blog:index_page', kwargs={
                     'page': previous_number})
     if page_type == '分类标签归档':
-        tag = get_object_or_404(Tag, name=tag_name)
         if page_obj.has_next():
             next_number = page_obj.next_page_number()
             next_url = reverse(
                 'blog:tag_detail_page',
                 kwargs={
                     'page': next_number,
-                    'tag_name': tag.slug})
+                    'tag_name': tag_name})
         if page_obj.has_previous():
             previous_number = page_obj.previous_page_number()
             previous_url = reverse(
                 'blog:tag_detail_page',
                 kwargs={
                     'page': previous_number,
-                    'tag_name': tag.slug})
+                    'tag_name': tag_name})
     if page_type == '作者文章归档':
         if page_obj.has_next():
             next_number = page_obj.next_page_number()
@@ -244,21 +273,20 @@ def load_pagination_info(page_obj, page_type, tag_name):
                     'author_name': tag_name})
 
     if page_type == '分类目录归档':
-        category = get_object_or_404(Category, name=tag_name)
         if page_obj.has_next():
             next_number = page_obj.next_page_number()
             next_url = reverse(
                 'blog:category_detail_page',
                 kwargs={
                     'page': next_number,
-                    'category_name': category.slug})
+                    'category_name': tag_name})
         if page_obj.has_previous():
             previous_number = page_obj.previous_page_number()
             previous_url = reverse(
                 'blog:category_detail_page',
                 kwargs={
                     'page': previous_number,
-                    'category_name': category.slug})
+                    'category_name': tag_name})
 
     return {
         'previous_url': previous_url,
@@ -267,6 +295,45 @@ def load_pagination_info(page_obj, page_type, tag_name):
     }
 
 
+ARTICLE_CARD_TIMEOUT = 60 * 60 * 10
+
+
+def get_article_card_key(article, user, open_site_comment, language):
+    """
+    列表页文章卡片的缓存key，由卡片中展示的所有内容的版本组成，
+    摘录本身也参与计算，渲染版本不变的强制重新渲染同样生成新的key，
+    分类、作者和标签都已随文章一起取出，计算时不需要额外查询
+    """
+    version = (
+        article.last_modify_time.isoformat(), article.views, article.comment_count,
+        article.render_version, article.excerpt, language, bool(user and user.is_superuser), open_site_comment,
+        article.category.slug, article.category.name, article.author.username,
+        [(tag.slug, tag.name) for tag in article.tags.all()])
+    return 'article_card:{pk}:{digest}'.format(pk=article.pk, digest=get_sha256(repr(version))[:32])
+
+
+@register.simple_tag
+def load_article_cards(article_list, user):
+    """
+    列表页的文章卡片，用一次 get_many 取出所有卡片片段，只渲染未命中的卡片
+    :param article_list: 当前页的文章
+    :param user: 当前用户
+    """
+    from djangoblog.utils import get_blog_setting
+    open_site_comment = get_blog_setting().open_site_comment
+    language = get_language()
+    keys = [get_article_card_key(article, user, open_site_comment, language) for article in article_list]
+    cards = cache.get_many(keys)
+    missing = {}
+    for key, article in zip(keys, article_list):
+        if key not in cards:
+            missing[key] = cards[key] = render_to_string(
+                'blog/tags/article_info.html', load_article_detail(article, True, user))
+    if missing:
+        cache.set_many(missing, ARTICLE_CARD_TIMEOUT)
+    return mark_safe(''.join(cards[key] for key in keys))
+
+
 @register.inclusion_tag('blog/tags/article_info.html')
 def load_article_detail(article, isindex, user):
     """
@@ -307,7 +374,8 @@ def gravatar_url(email, size=40):
 
         url = "https://www.gravatar.com/avatar/%s?%s" % (hashlib.md5(
             email.lower()).hexdigest(), urllib.parse.urlencode({'d': default, 's': str(size)}))
-        cache.set(cachekey, url, 60 * 60 * 10)
+        set_with_dependencies(cachekey, url, 60 * 60 * 10,
+                              dependencies=[model_tag(OAuthUser)])
         logger.info('set gravatar cache.key:{key}'.format(key=cachekey))
         return url
 
@@ -332,6 +400,17 @@ def query(qs, **kwargs):
     return qs.filter(**kwargs)
 
 
+@register.simple_tag
+def child_categorys(categorys, parent):
+    """
+    从已加载的分类中筛选子分类，导航栏每个节点不再单独查询
+    :param categorys: 全部分类
+    :param parent: 父分类，为空时返回一级分类
+    """
+    parent_id = parent.pk if parent else None
+    return [c for c in categorys if c.parent_category_id == parent_id]
+
+
 @register.filter
 def addstr(arg1, arg2):
     """concatenate arg1 & arg2"""
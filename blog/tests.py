@@ -1,11 +1,14 @@
 import os
+from io import StringIO
 
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management import call_command
 from django.core.paginator import Paginator
 from django.templatetags.static import static
-from django.test import Client, RequestFactory, TestCase
+from django.db import connection
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
@@ -13,6 +16,7 @@ from accounts.models import BlogUser
 from blog.forms import BlogSearchForm
 from blog.models import Article, Category, Tag, SideBar, Links
 from blog.templatetags.blog_tags import load_pagination_info, load_articletags
+from blog.view_counter import view_counter
 from djangoblog.utils import get_current_site, get_sha256
 from oauth.models import OAuthUser, OAuthConfig
 
@@ -182,6 +186,606 @@ class ArticleTest(TestCase):
         save_user_avatar(
             'https://www.python.org/static/img/python-logo.png')
 
+    def test_category_path(self):
+        from django.core.exceptions import ValidationError
+        user = BlogUser.objects.create_user(username='categorypath', email='categorypath@test.com')
+        root = Category.objects.create(name='path root')
+        child = Category.objects.create(name='path child', parent_category=root)
+        leaf = Category.objects.create(name='path leaf', parent_category=child)
+        self.assertEqual(leaf.path, '/%d/%d/%d/' % (root.pk, child.pk, leaf.pk))
+        with self.assertNumQueries(1):
+            self.assertEqual(leaf.get_category_tree(), [leaf, child, root])
+        article = Article.objects.create(
+            title='category path', body='body', author=user, category=leaf, status='p', type='a')
+
+        self.assertEqual(root.get_sub_categorys(), [root, child, leaf])
+        rsp = self.client.get(root.get_absolute_url())
+        self.assertContains(rsp, article.title)
+
+        # 移动分类时子孙分类的路径一起更新
+        other = Category.objects.create(name='path other')
+        child.parent_category = other
+        child.save()
+        leaf.refresh_from_db()
+        self.assertEqual(leaf.path, '/%d/%d/%d/' % (other.pk, child.pk, leaf.pk))
+        self.assertEqual(Article.objects.filter(category__path__startswith=root.path).count(), 0)
+        self.assertEqual(Article.objects.filter(category__path__startswith=other.path).count(), 1)
+
+        other.parent_category = leaf
+        with self.assertRaises(ValidationError):
+            other.save()
+        other.refresh_from_db()
+        self.assertIsNone(other.parent_category_id)
+
+        # bulk_create 创建的分类没有路径，使用前补齐，不会匹配到所有分类
+        parent, sub = Category.objects.bulk_create([
+            Category(name='path bulk parent', slug='path-bulk-parent'),
+            Category(name='path bulk sub', slug='path-bulk-sub')])
+        Category.objects.filter(pk=sub.pk).update(parent_category=parent)
+        sub = Category.objects.get(pk=sub.pk)
+        self.assertEqual(sub.get_sub_categorys(), [sub])
+        self.assertEqual(sub.path, '/%d/%d/' % (parent.pk, sub.pk))
+        self.assertEqual(Category.objects.get(pk=parent.pk).path, '/%d/' % parent.pk)
+        with self.settings(PAGE_CACHE_ENABLED=False):
+            rsp = self.client.get(sub.get_absolute_url())
+        self.assertEqual(list(rsp.context['article_list']), [])
+
+    def test_article_list_keyset_pagination(self):
+        from blog.paginator import KeysetPaginator
+        from djangoblog.cache_dependency import get_generation
+        from djangoblog.utils import cache
+        user = BlogUser.objects.create_user(username='listcache', email='listcache@test.com')
+        category = Category.objects.create(name='listcache')
+        articles = [Article.objects.create(
+            title='listcache %d' % i, body='body', author=user, category=category,
+            status='p', type='a') for i in range(12)]
+        articles[5].article_order = 1
+        articles[5].save()
+        with self.settings(PAGE_CACHE_ENABLED=False):
+            rsp = self.client.get(reverse('blog:index_page', kwargs={'page': 2}))
+        self.assertEqual(rsp.context['article_list'], [articles[1], articles[0]])
+        key = 'index_g{generation}'.format(generation=get_generation('blog.article'))
+        self.assertEqual(cache.get(key + '_p2')['ids'], [articles[1].pk, articles[0].pk])
+        self.assertEqual(cache.get(key + '_count'), 12)
+
+        # 顺序翻页使用上一页的游标，不使用 OFFSET
+        expected = [articles[5]] + [a for a in reversed(articles) if a != articles[5]]
+        paginator = KeysetPaginator(Article.objects.all(), 5, 'keyset_test_sequential')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual([list(paginator.page(i)) for i in (1, 2, 3)],
+                             [expected[:5], expected[5:10], expected[10:]])
+        self.assertFalse([q for q in queries if 'OFFSET' in q['sql']])
+        # 直接跳到后面的页只查询一行游标
+        paginator = KeysetPaginator(Article.objects.all(), 5, 'keyset_test_jump')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(list(paginator.page(3)), expected[10:])
+        self.assertEqual(len([q for q in queries if 'LIMIT 1 OFFSET 9' in q['sql']]), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(paginator.page(3)), expected[10:])
+
+    def assertQueryBudget(self, url, budget):
+        """
+        渲染页面的查询次数不能超过预算
+        侧边栏等公共缓存先预热，统计的是每次请求都会执行的查询
+        """
+        with self.settings(PAGE_CACHE_ENABLED=False):
+            self.client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                rsp = self.client.get(url)
+        self.assertEqual(rsp.status_code, 200)
+        self.assertLessEqual(
+            len(queries), budget,
+            '\n'.join(q['sql'] for q in queries.captured_queries))
+        return len(queries)
+
+    def create_list_articles(self, count, prefix):
+        from comments.models import Comment, update_comment_count
+        user = BlogUser.objects.create_user(
+            username=prefix, email='%s@test.com' % prefix, password=prefix)
+        category = Category.objects.create(name=prefix)
+        tags = [Tag.objects.create(name='%s tag %d' % (prefix, i)) for i in range(3)]
+        comments = []
+        for i in range(count):
+            article = Article.objects.create(
+                title='%s %d' % (prefix, i), body='body', author=user, category=category,
+                status='p', type='a')
+            article.tags.add(*tags)
+            comments.append(Comment(body='comment', author=user, article=article, is_enable=True))
+        # bulk_create 不发送评论通知邮件，也不更新评论数
+        Comment.objects.bulk_create(comments)
+        update_comment_count()
+        return category, tags[0]
+
+    def test_article_list_query_budget(self):
+        category, tag = self.create_list_articles(2, 'budget')
+        urls = [reverse('blog:index'), category.get_absolute_url(), tag.get_absolute_url(),
+                reverse('blog:author_detail', kwargs={'author_name': 'budget'})]
+        small = [self.assertQueryBudget(url, 3) for url in urls]
+        self.create_list_articles(settings.PAGINATE_BY, 'budgetmore')
+        # 每页文章数增加后查询次数不变
+        large = [self.assertQueryBudget(url, 3) for url in urls[:1]]
+        self.assertEqual(small[:1], large)
+        rsp = self.client.get(reverse('blog:index'))
+        self.assertEqual(rsp.context['article_list'][0].comment_count, 1)
+
+    def test_warm_cache(self):
+        from blog.cache_warmer import get_warmup_urls
+        from djangoblog.utils import cache
+        user = BlogUser.objects.create_user(username='warmcache', email='warmcache@test.com')
+        category = Category.objects.create(name='warmcache')
+        tag = Tag.objects.create(name='warmcache')
+        for i in range(12):
+            article = Article.objects.create(
+                title='warmcache %d' % i, body='body', author=user, category=category,
+                status='p', type='a', views=i)
+            article.tags.add(tag)
+        urls = get_warmup_urls(top_articles=3, pages=5)
+        self.assertIn(reverse('blog:index_page', kwargs={'page': 2}), urls)
+        self.assertNotIn(reverse('blog:index_page', kwargs={'page': 3}), urls)
+        self.assertIn(reverse('blog:tag_detail_page', kwargs={'tag_name': tag.slug, 'page': 2}), urls)
+        self.assertIn(article.get_absolute_url(), urls)
+        # 分类/标签/作者列表的数量有上限，按文章数选择
+        Tag.objects.create(name='warmcache empty')
+        listing_urls = [url for url in get_warmup_urls(top_articles=0, pages=1, listings=2)
+                        if url.startswith(('/category/', '/tag/', '/author/'))]
+        self.assertEqual(len(listing_urls), 2)
+
+        cache.clear()
+        out = StringIO()
+        from unittest import mock
+        from django.db import connection
+        # 预热不关闭调用方（这里是测试事务）的数据库连接
+        with mock.patch.object(connection, 'close_if_unusable_or_obsolete') as close:
+            call_command('warm_cache', '--top', '3', '--concurrency', '1', stdout=out)
+        self.assertFalse(close.called)
+        self.assertIn('0 failed', out.getvalue())
+        self.assertIsNotNone(cache.get('sidebarp_fresh'))
+        self.assertIsNotNone(cache.get('seo_processor'))
+        # 请求经过整页缓存中间件，使用与访问者相同的 Host 生成 key
+        from blog.cache_warmer import get_warmup_host
+        from blog.middleware import AnonymousPageCacheMiddleware
+        request = self.factory.get(reverse('blog:index'), HTTP_HOST=get_warmup_host())
+        self.assertIsNotNone(cache.get(AnonymousPageCacheMiddleware.get_cache_key(request)))
+        article.refresh_from_db()
+        self.assertEqual(article.views, 11)
+
+    def test_neighbor_index(self):
+        import djangoblog.blog_signals  # noqa: F401
+        from blog.neighbor_index import neighbor_index
+        neighbor_index.clear()
+        user = BlogUser.objects.create_user(username='neighbor', email='neighbor@test.com')
+        category = Category.objects.create(name='neighbor')
+        first, second, third = [Article.objects.create(
+            title='neighbor %d' % i, body='body', author=user, category=category,
+            status='p', type='a') for i in range(3)]
+        self.assertEqual(second.next_article(), third)
+        self.assertEqual(second.prev_article(), first)
+        with self.assertNumQueries(0):
+            self.assertEqual(third.prev_article().title, second.title)
+            self.assertEqual(third.prev_article().get_absolute_url(), second.get_absolute_url())
+
+        # 撤回、重新发布和删除的事务提交后增量更新
+        with self.captureOnCommitCallbacks(execute=True):
+            second.status = 'd'
+            second.save()
+        self.assertEqual(first.next_article(), third)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.status = 'p'
+            second.title = 'neighbor renamed'
+            second.save()
+        self.assertEqual(third.prev_article().title, 'neighbor renamed')
+        with self.captureOnCommitCallbacks(execute=True):
+            third.delete()
+        self.assertIsNone(second.next_article())
+
+        # 重建期间发生的修改使重建的结果作废
+        from unittest import mock
+        from blog import neighbor_index as module
+        neighbor_index.clear()
+        save = neighbor_index._save
+
+        def save_after_concurrent_update(index):
+            # 查询完成、写入缓存之前，另一个进程提交了修改
+            neighbor_index.update(first.id)
+            save(index)
+
+        with mock.patch.object(neighbor_index, '_save', side_effect=save_after_concurrent_update):
+            neighbor_index.build()
+        self.assertIsNone(module.cache.get(module.VERSION_KEY))
+
+        # 版本失效后从数据库重建
+        from djangoblog.utils import cache
+        cache.delete('article_neighbor_index_version')
+        self.assertEqual(first.next_article(), second)
+        neighbor_index.clear()
+
+    def test_tag_counts(self):
+        import djangoblog.blog_signals  # noqa: F401
+        from blog.tag_counts import tag_counts
+        tag_counts.clear()
+        user = BlogUser.objects.create_user(username='tagcounts', email='tagcounts@test.com')
+        category = Category.objects.create(name='tagcounts')
+        tags = [Tag.objects.create(name='tagcounts %d' % i) for i in range(3)]
+        first, second = [Article.objects.create(
+            title='tagcounts %d' % i, body='body', author=user, category=category,
+            status='p', type='a') for i in range(2)]
+        with self.assertNumQueries(1):
+            self.assertEqual(tag_counts.get(tags[0].pk), 0)
+
+        def assert_counts(expected):
+            self.assertEqual([tag_counts.get(tag.pk) for tag in tags], expected)
+            # 增量结果与重新统计一致
+            self.assertEqual(tag_counts.get_counts(), tag_counts.build())
+
+        # 标签数在事务提交后修改
+        with self.captureOnCommitCallbacks(execute=True):
+            first.tags.add(*tags)
+            second.tags.add(tags[0])
+        assert_counts([2, 1, 1])
+        with self.captureOnCommitCallbacks(execute=True):
+            second.status = 'd'
+            second.save()
+        assert_counts([1, 1, 1])
+        with self.captureOnCommitCallbacks(execute=True):
+            second.tags.add(tags[1])
+            second.status = 'p'
+            second.save()
+        assert_counts([2, 2, 1])
+        with self.captureOnCommitCallbacks(execute=True):
+            first.tags.remove(tags[2], Tag.objects.create(name='tagcounts other'))
+        assert_counts([2, 2, 0])
+        with self.captureOnCommitCallbacks(execute=True):
+            first.tags.clear()
+        assert_counts([1, 1, 0])
+        # 回滚的修改不影响计数
+        from django.db import transaction
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    second.status = 'd'
+                    second.save()
+                    raise ValueError
+            except ValueError:
+                second.status = 'p'
+        assert_counts([1, 1, 0])
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        assert_counts([0, 0, 0])
+
+        # 重建期间的修改使重建结果作废，不会用旧的统计覆盖缓存
+        from unittest import mock
+        from blog.tag_counts import TAG_COUNTS_KEY, TagCounts
+        from djangoblog.utils import cache
+        count_articles = TagCounts.count_articles
+
+        def change_while_counting():
+            counts = count_articles()
+            tag_counts.change([tags[0].pk], 1)
+            return counts
+
+        with mock.patch.object(TagCounts, 'count_articles', side_effect=change_while_counting):
+            tag_counts.build()
+        self.assertIsNone(cache.get(TAG_COUNTS_KEY))
+        tag_counts.clear()
+
+    def test_admin_bulk_actions_invalidate_cache(self):
+        from blog.admin import draft_article, close_article_commentstatus
+        from djangoblog.cache_dependency import get_generation, model_tag
+        user = BlogUser.objects.create_user(username='bulkadmin', email='bulkadmin@test.com')
+        category = Category.objects.create(name='bulkadmin')
+        article = Article.objects.create(
+            title='bulkadmin', body='body', author=user, category=category, status='p', type='a')
+        tag = Tag.objects.create(name='bulkadmin')
+        article.tags.add(tag)
+        queryset = Article.objects.filter(pk=article.pk)
+        # 标签、作者和归档月份的列表同样失效
+        tags = [model_tag(Article), model_tag(Category), model_tag(Tag), model_tag(Tag, tag.pk),
+                Article.author_cache_tag(user.username), Article.archive_cache_tag(article.pub_time)]
+        generations = [get_generation(t) for t in tags]
+        modify_time = Article.objects.get(pk=article.pk).last_modify_time
+        close_article_commentstatus(None, None, queryset)
+        for t, generation in zip(tags, generations):
+            self.assertNotEqual(get_generation(t), generation, t)
+        self.assertGreater(Article.objects.get(pk=article.pk).last_modify_time, modify_time)
+        generations = [get_generation(t) for t in tags]
+        draft_article(None, None, queryset)
+        for t, generation in zip(tags, generations):
+            self.assertNotEqual(get_generation(t), generation, t)
+        self.assertEqual(Article.objects.get(pk=article.pk).status, 'd')
+
+    def test_render_at_save(self):
+        from unittest import mock
+        from djangoblog.utils import CommonMarkdown
+        user = BlogUser.objects.create_user(username='rendered', email='rendered@test.com')
+        category = Category.objects.create(name='rendered')
+        article = Article.objects.create(
+            title='rendered', body='# heading\n\nrendered **body** ' + 'x' * 400, author=user,
+            category=category, status='p', type='a', show_toc=True)
+        self.assertIn('<strong>body</strong>', article.body_html)
+        self.assertIn('heading', article.toc_html)
+        self.assertTrue(article.summary.startswith('heading'))
+        self.assertEqual(article.render_version, Article.get_render_version())
+
+        with mock.patch.object(CommonMarkdown, '_convert_markdown',
+                               wraps=CommonMarkdown._convert_markdown) as convert:
+            with self.settings(PAGE_CACHE_ENABLED=False):
+                rsp = self.client.get(article.get_absolute_url())
+                self.assertContains(rsp, '<strong>body</strong>')
+                self.client.get(reverse('blog:index'))
+            self.assertEqual(convert.call_count, 0)
+
+            # 渲染器版本变化后读取时重新渲染一次并写回
+            with mock.patch.object(CommonMarkdown, 'VERSION', CommonMarkdown.VERSION + 1):
+                article = Article.objects.get(pk=article.pk).ensure_rendered()
+                Article.objects.get(pk=article.pk).ensure_rendered()
+                self.assertEqual(Article.objects.get(pk=article.pk).render_version,
+                                 Article.get_render_version())
+            self.assertEqual(convert.call_count, 1)
+
+        article.body = 'changed body'
+        article.save(update_fields=['body'])
+        self.assertEqual(Article.objects.get(pk=article.pk).body_html, '<p>changed body</p>')
+
+        # 正文没有变化时保存不重新渲染
+        with mock.patch.object(CommonMarkdown, 'get_markdown_with_toc') as render:
+            article = Article.objects.get(pk=article.pk)
+            article.title = 'rendered title'
+            article.save()
+            Article.objects.defer('body').get(pk=article.pk).save()
+            self.assertEqual(render.call_count, 0)
+
+        # 列表页批量补齐旧版本：一次查询正文，一次写回
+        from blog.views import ArticleListView
+        others = [Article.objects.create(
+            title='rendered %d' % i, body='rendered list %d' % i, author=user,
+            category=category, status='p', type='a') for i in range(3)]
+        ids = [article.pk] + [a.pk for a in others]
+        with mock.patch.object(CommonMarkdown, 'VERSION', CommonMarkdown.VERSION + 1):
+            with CaptureQueriesContext(connection) as queries:
+                cards = ArticleListView.get_article_cards(ids)
+            self.assertEqual([a.render_version for a in cards], [Article.get_render_version()] * 4)
+            self.assertEqual(len([q for q in queries.captured_queries
+                                  if q['sql'].startswith('UPDATE')]), 1)
+            self.assertEqual(cards[1].excerpt, '<p>rendered list 0</p>')
+            # 补齐后只有文章和标签两条查询
+            with self.assertNumQueries(2):
+                ArticleListView.get_article_cards(ids)
+
+    def test_article_cards_cache(self):
+        from unittest import mock
+        from django.utils.translation import get_language
+        from blog.templatetags import blog_tags
+        from djangoblog.utils import cache, get_blog_setting
+        user = BlogUser.objects.create_user(username='cards', email='cards@test.com')
+        category = Category.objects.create(name='cards')
+        for i in range(3):
+            Article.objects.create(
+                title='cards %d' % i, body='cards body %d' % i, author=user,
+                category=category, status='p', type='a')
+
+        def load_cards():
+            articles = list(Article.objects.filter(category=category).select_related(
+                'author', 'category').prefetch_related('tags').order_by('-id'))
+            keys = [blog_tags.get_article_card_key(
+                article, user, get_blog_setting().open_site_comment, get_language()) for article in articles]
+            with mock.patch.object(blog_tags, 'render_to_string',
+                                   wraps=blog_tags.render_to_string) as render:
+                html = blog_tags.load_article_cards(articles, user)
+            return articles, keys, html, render.call_count
+
+        cache.delete_many(load_cards()[1])
+        articles, keys, html, rendered = load_cards()
+        self.assertEqual(rendered, 3)
+        self.assertIn('cards body 2', html)
+        self.assertLess(html.index('cards 2'), html.index('cards 0'))
+        # 第二次只有一次 get_many，不再渲染
+        self.assertEqual(load_cards()[2:], (html, 0))
+
+        # 浏览量或内容变化后只重新渲染变化的卡片
+        article = articles[0]
+        article.title = 'cards changed'
+        article.save()
+        Article.objects.filter(pk=articles[1].pk).update(views=10)
+        new_keys, html, rendered = load_cards()[1:]
+        self.assertEqual(rendered, 2)
+        self.assertEqual(new_keys[2], keys[2])
+        self.assertNotEqual(new_keys[0], keys[0])
+        self.assertIn('cards changed', html)
+        self.assertGreater(Article.objects.get(pk=article.pk).last_modify_time, article.creation_time)
+        cache.delete_many(keys + new_keys)
+
+    def test_benchmark_markdown(self):
+        user = BlogUser.objects.create_user(username='benchmark', email='benchmark@test.com')
+        category = Category.objects.create(name='benchmark')
+        Article.objects.create(
+            title='benchmark', body='text\n\n```python\nimport os\n```\n', author=user,
+            category=category, status='p', type='a')
+        out = StringIO()
+        call_command('benchmark_markdown', '--limit', '1', '--repeat', '2', stdout=out)
+        self.assertIn('articles:1 renders:2', out.getvalue())
+        self.assertIn('speedup', out.getvalue())
+
+    def test_rerender_content(self):
+        user = BlogUser.objects.create_user(username='rerender', email='rerender@test.com')
+        category = Category.objects.create(name='rerender')
+        articles = [Article.objects.create(
+            title='rerender %d' % i, body='rerender **%d**' % i, author=user, category=category,
+            status='p', type='a') for i in range(5)]
+        Article.objects.filter(pk__in=[a.pk for a in articles]).update(body_html='', render_version='')
+        import tempfile
+        from unittest import mock
+        from blog.management.commands import rerender_content
+        checkpoint_file = os.path.join(tempfile.mkdtemp(), 'rerender.checkpoint')
+        out = StringIO()
+        # 渲染子进程不关闭父进程（这里是测试事务）的数据库连接
+        with mock.patch.object(connection, 'close') as close:
+            call_command('rerender_content', '--batch-size', '2', '--workers', '1',
+                         '--start-id', str(articles[1].pk), '--checkpoint-file', checkpoint_file, stdout=out)
+        self.assertFalse(close.called)
+        self.assertIn('rerendered 3 articles', out.getvalue())
+        rendered = Article.objects.filter(pk__in=[a.pk for a in articles]).order_by('pk')
+        self.assertEqual([a.body_html for a in rendered][:2], ['', ''])
+        self.assertEqual(rendered[4].body_html, '<p>rerender <strong>4</strong></p>')
+        self.assertEqual(rendered[4].render_version, Article.get_render_version())
+        self.assertFalse(os.path.exists(checkpoint_file))
+
+        # 没有检查点时 --resume 报错，不会从头开始
+        from django.core.management.base import CommandError
+        with self.assertRaises(CommandError):
+            call_command('rerender_content', '--resume', '--checkpoint-file', checkpoint_file)
+
+        # 从中断时的检查点继续
+        with open(checkpoint_file, 'w') as f:
+            f.write(str(articles[3].pk))
+        out = StringIO()
+        call_command('rerender_content', '--workers', '0', '--resume',
+                     '--checkpoint-file', checkpoint_file, stdout=out)
+        self.assertIn('rerender 1 articles after id %d' % articles[3].pk, out.getvalue())
+        self.assertFalse(os.path.exists(checkpoint_file))
+
+        # 渲染期间被修改的文章不写回旧正文的渲染结果
+        render_rows = rerender_content.render_rows
+
+        def edit_while_rendering(target, rows, excerpt_length):
+            results = render_rows(target, rows, excerpt_length)
+            article = Article.objects.get(pk=articles[4].pk)
+            article.body = 'edited while rendering'
+            article.save()
+            return results
+
+        out = StringIO()
+        with mock.patch.object(rerender_content, 'render_rows', side_effect=edit_while_rendering):
+            call_command('rerender_content', '--workers', '0', '--start-id', str(articles[3].pk),
+                         '--checkpoint-file', checkpoint_file, stdout=out)
+        self.assertIn('1 changed during the run', out.getvalue())
+        self.assertEqual(Article.objects.get(pk=articles[4].pk).body_html, '<p>edited while rendering</p>')
+
+        # 渲染版本不变的强制重新渲染也更新缓存的整页和列表页卡片
+        import djangoblog.blog_signals  # noqa: F401
+        article = articles[2]
+        Article.objects.filter(pk=article.pk).update(body_html='<p>stale html</p>', excerpt='<p>stale html</p>')
+        self.assertContains(self.client.get(article.get_absolute_url()), 'stale html')
+        with self.settings(PAGE_CACHE_ENABLED=False):
+            self.assertContains(self.client.get(reverse('blog:index')), 'stale html')
+        call_command('rerender_content', '--workers', '0', '--start-id', str(article.pk - 1),
+                     '--checkpoint-file', checkpoint_file, stdout=StringIO())
+        with self.settings(PAGE_CACHE_ENABLED=False):
+            self.assertNotContains(self.client.get(reverse('blog:index')), 'stale html')
+        self.assertNotContains(self.client.get(article.get_absolute_url()), 'stale html')
+
+    def test_view_counter(self):
+        from djangoblog.utils import cache
+        user = BlogUser.objects.create_user(username='viewcounter', email='viewcounter@test.com')
+        category = Category.objects.create(name='viewcounter')
+        first, second = [Article.objects.create(
+            title='viewcounter %d' % i, body='body', author=user, category=category,
+            status='p', type='a', views=10) for i in range(2)]
+        # 清理之前测试中相同id文章残留的计数
+        cache.delete_many(['article_views:%d' % first.pk, 'article_views:%d' % second.pk])
+        with self.settings(VIEW_COUNT_BUFFERED=True):
+            for _ in range(3):
+                first.refresh_from_db()
+                with self.assertNumQueries(0):
+                    first.viewed()
+            view_counter.record(second.pk)
+            self.assertEqual(first.views, 13)
+            with self.settings(PAGE_CACHE_ENABLED=False):
+                rsp = self.client.get(first.get_absolute_url())
+            self.assertContains(rsp, '14 views')
+            with self.assertNumQueries(1):
+                self.assertEqual(view_counter.flush([first.pk, second.pk]), 5)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.views, second.views), (14, 11))
+        self.assertEqual(view_counter.flush([first.pk, second.pk]), 0)
+
+        # 默认的 LocMemCache 不跨进程共享，直接写数据库
+        with self.assertNumQueries(1):
+            first.viewed()
+        self.assertEqual(first.views, 15)
+        self.assertEqual(cache.get('article_views:%d' % first.pk), 0)
+        first.refresh_from_db()
+        self.assertEqual(first.views, 15)
+
+    def test_archives(self):
+        import datetime
+        import djangoblog.blog_signals  # noqa: F401
+        from blog.archives import get_archives
+        from djangoblog.utils import cache
+        user = BlogUser.objects.create_user(username='archives', email='archives@test.com')
+        category = Category.objects.create(name='archives')
+        old, current = [Article.objects.create(
+            title='archives %d' % month, body='body', author=user, category=category,
+            status='p', type='a', pub_time=datetime.datetime(2001, month, 3)) for month in (1, 2)]
+        archives = dict(get_archives())
+        self.assertEqual([month for month, articles in archives[2001]], [2, 1])
+        self.assertEqual(dict(archives[2001])[1][0]['url'], old.get_absolute_url())
+        self.assertIsNotNone(cache.get('archives_month_2001-01'))
+
+        # 新文章只使所在月份的缓存失效
+        Article.objects.create(
+            title='archives new', body='body', author=user, category=category,
+            status='p', type='a', pub_time=datetime.datetime(2001, 2, 5))
+        self.assertIsNotNone(cache.get('archives_month_2001-01'))
+        self.assertIsNone(cache.get('archives_month_2001-02'))
+        with self.assertNumQueries(2):
+            archives = dict(get_archives())
+        self.assertEqual([a['title'] for a in dict(archives[2001])[2]], ['archives new', current.title])
+        rsp = self.client.get(reverse('blog:archives'))
+        self.assertContains(rsp, 'archives new')
+        cache.delete_many(['archives_months', 'archives_month_2001-01', 'archives_month_2001-02'])
+
+    @override_settings(VIEW_COUNT_BUFFERED=True)
+    def test_page_cache(self):
+        import gzip
+        import djangoblog.blog_signals  # noqa 注册信号
+        user = BlogUser.objects.create_user(
+            username='pagecache', email='pagecache@test.com', password='pagecache')
+        category = Category.objects.create(name='pagecache')
+        article = Article.objects.create(
+            title='pagecache title', body='body', author=user, category=category,
+            status='p', type='a')
+        rsp = self.client.get(article.get_absolute_url())
+        self.assertContains(rsp, 'pagecache title')
+        with self.assertNumQueries(0):
+            rsp = self.client.get(article.get_absolute_url(), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(rsp['Content-Encoding'], 'gzip')
+        self.assertIn(b'pagecache title', gzip.decompress(rsp.content))
+        view_counter.flush([article.pk])
+        article.refresh_from_db()
+        self.assertEqual(article.views, 2)
+
+        article.title = 'pagecache changed'
+        article.save()
+        rsp = self.client.get(article.get_absolute_url())
+        self.assertContains(rsp, 'pagecache changed')
+
+        # 登录用户以及包含 csrf token 的页面不使用缓存
+        self.client.login(username='pagecache', password='pagecache')
+        rsp = self.client.get(article.get_absolute_url())
+        self.assertContains(rsp, 'csrfmiddlewaretoken')
+        self.client.logout()
+        rsp = self.client.get(article.get_absolute_url())
+        self.assertNotContains(rsp, 'csrfmiddlewaretoken')
+
+        # 登录更新 last_login 不失效整页缓存，修改页面上显示的用户资料时失效
+        from blog.middleware import AnonymousPageCacheMiddleware as middleware
+        request = self.factory.get(article.get_absolute_url())
+        key = middleware.get_cache_key(request)
+        user.last_login = timezone.now()
+        user.save()
+        self.assertEqual(middleware.get_cache_key(request), key)
+        user.nickname = 'pagecache nickname'
+        user.save()
+        self.assertNotEqual(middleware.get_cache_key(request), key)
+
+        # 只缓存白名单中的查询参数，参数顺序不影响 key
+        self.assertIsNone(middleware.get_cacheable_match(self.factory.get('/', {'x': 'random'})))
+        self.assertIsNotNone(middleware.get_cacheable_match(self.factory.get('/', {'page': 2})))
+        self.assertEqual(
+            middleware.get_cache_key(self.factory.get('/?page=2&comment_page=1')),
+            middleware.get_cache_key(self.factory.get('/?comment_page=1&page=2')))
+
     def test_errorpage(self):
         rsp = self.client.get('/eee')
         self.assertEqual(rsp.status_code, 404)
@@ -1,5 +1,4 @@
 from django.urls import path
-from django.views.decorators.cache import cache_page
 
 from . import views
 
@@ -43,9 +42,7 @@ urlpatterns = [
         name='tag_detail_page'),
     path(
         'archives.html',
-        cache_page(
-            60 * 60)(
-            views.ArchivesView.as_view()),
+        views.ArchivesView.as_view(),
         name='archives'),
     path(
         'links.html',
@@ -0,0 +1,142 @@
+"""
+文章阅读数缓冲计数
+
+每次阅读只在缓存中原子加一（redis 的 ``INCR``），
+每隔 ``VIEW_COUNT_FLUSH_INTERVAL`` 秒把累计的增量用一条 ``UPDATE ... CASE`` 批量写回数据库，
+避免热门文章每次阅读都更新同一行，以及并发阅读时用内存中的旧值互相覆盖。
+
+缓冲要求各进程共用同一个缓存（redis 或 memcached）：LocMemCache 等进程内缓存中每个 worker
+各有一份计数，``flush_view_counts`` 命令所在的进程也读不到，这时直接 ``F('views') + 1`` 写数据库。
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.core.cache.backends.redis import RedisCache
+from django.db.models import Case, F, PositiveIntegerField, Value, When
+
+from djangoblog.cache_backend import TwoTierCache
+from djangoblog.utils import cache
+
+logger = logging.getLogger(__name__)
+
+VIEW_COUNT_KEY = 'article_views:{id}'
+FLUSH_LOCK_KEY = 'article_views_flush_lock'
+FLUSH_BATCH_SIZE = 500
+
+
+def _count_key(article_id):
+    return VIEW_COUNT_KEY.format(id=article_id)
+
+
+def is_buffered():
+    """
+    阅读数是否缓冲在缓存中，``VIEW_COUNT_BUFFERED`` 为 None 时按缓存后端是否跨进程共享判断
+    """
+    if settings.VIEW_COUNT_BUFFERED is not None:
+        return settings.VIEW_COUNT_BUFFERED
+    backend = caches['default']
+    if isinstance(backend, TwoTierCache):
+        backend = backend.l2
+    return isinstance(backend, (RedisCache, BaseMemcachedCache))
+
+
+class ViewCounter(object):
+
+    def __init__(self):
+        # 本进程计过数、尚未写回的文章id
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def record(self, article_id):
+        """
+        记录一次阅读
+        :param article_id: 文章id
+        :return: 尚未写回数据库的阅读数（包含本次），直接写了数据库时为1
+        """
+        if not is_buffered():
+            return self._record_directly(article_id)
+        key = _count_key(article_id)
+        pending = self._incr(key, 1)
+        if pending is None and cache.add(key, 1, None):
+            pending = 1
+        if pending is None:
+            pending = self._incr(key, 1)
+        if pending is None:
+            # 缓存不可用时直接写数据库
+            return self._record_directly(article_id)
+        with self._lock:
+            self._dirty.add(article_id)
+            should_flush = time.monotonic() - self._last_flush >= settings.VIEW_COUNT_FLUSH_INTERVAL
+        if should_flush:
+            self.flush()
+        return pending
+
+    @staticmethod
+    def _record_directly(article_id):
+        from blog.models import Article
+        Article.objects.filter(pk=article_id).update(views=F('views') + 1)
+        return 1
+
+    @staticmethod
+    def _incr(key, delta):
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            # key 不存在（SafeRedisCache 此时返回 None）
+            return None
+
+    def flush(self, article_ids=None):
+        """
+        把缓冲的阅读数写回数据库
+        :param article_ids: 需要写回的文章id，为空时写回本进程计过数的文章
+        :return: 写回的阅读数
+        """
+        with self._lock:
+            if article_ids is None:
+                article_ids, self._dirty = self._dirty, set()
+            self._last_flush = time.monotonic()
+        article_ids = list(article_ids)
+        if not article_ids:
+            return 0
+        # 同一时间只有一个进程写回，读取计数和扣减之间不会被其他进程重复扣减
+        if not cache.add(FLUSH_LOCK_KEY, 1, 60):
+            with self._lock:
+                self._dirty.update(article_ids)
+            return 0
+        total = 0
+        try:
+            for i in range(0, len(article_ids), FLUSH_BATCH_SIZE):
+                total += self._flush_batch(article_ids[i:i + FLUSH_BATCH_SIZE])
+        finally:
+            cache.delete(FLUSH_LOCK_KEY)
+        if total:
+            logger.info('flush article views:{total}'.format(total=total))
+        return total
+
+    def _flush_batch(self, article_ids):
+        from blog.models import Article
+        keys = {_count_key(article_id): article_id for article_id in article_ids}
+        counts = {keys[key]: count for key, count in cache.get_many(list(keys)).items() if count}
+        if not counts:
+            return 0
+        # 先扣减再写库，期间新增的阅读数保留在缓存中，页面上最多短暂少显示一点
+        for article_id, count in counts.items():
+            cache.decr(_count_key(article_id), count)
+        try:
+            Article.objects.filter(pk__in=counts.keys()).update(views=F('views') + Case(
+                *[When(pk=article_id, then=Value(count)) for article_id, count in counts.items()],
+                default=Value(0),
+                output_field=PositiveIntegerField()))
+        except Exception:
+            for article_id, count in counts.items():
+                cache.incr(_count_key(article_id), count)
+            raise
+        return sum(counts.values())
+
+
+view_counter = ViewCounter()
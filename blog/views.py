@@ -4,19 +4,24 @@ import uuid
 
 from django.conf import settings
 from django.core.paginator import Paginator
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render
 from django.templatetags.static import static
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 from haystack.views import SearchView
 
+from blog.archives import get_archives
 from blog.models import Article, Category, LinkShowType, Links, Tag
+from blog.paginator import KeysetPaginator
 from comments.forms import CommentForm
+from djangoblog.cache_dependency import get_generation, model_tag
+from djangoblog.cache_stats import stats as cache_stats
 from djangoblog.utils import cache, get_blog_setting, get_sha256
 
 logger = logging.getLogger(__name__)
@@ -57,30 +62,49 @@ class ArticleListView(ListView):
         """
         raise NotImplementedError()
 
-    def get_queryset_from_cache(self, cache_key):
-        '''
-        缓存页面数据
-        :param cache_key: 缓存key
-        :return:
-        '''
-        value = cache.get(cache_key)
-        if value:
-            logger.info('get view cache.key:{key}'.format(key=cache_key))
-            return value
-        else:
-            article_list = self.get_queryset_data()
-            cache.set(cache_key, article_list)
-            logger.info('set view cache.key:{key}'.format(key=cache_key))
-            return article_list
+    def get_queryset_cache_namespaces(self):
+        """
+        queryset缓存所属的命名空间，缓存key中拼接命名空间的版本号，
+        命名空间对应的对象变更时版本号加一，列表的所有分页一起失效
+        """
+        return [model_tag(Article)]
+
+    def get_listing_cache_key(self):
+        """
+        列表的缓存key，拼接了命名空间的版本号
+        """
+        key = self.get_queryset_cache_key()
+        generation = get_generation(*self.get_queryset_cache_namespaces())
+        return '{key}_g{generation}'.format(key=key, generation=generation)
 
     def get_queryset(self):
         '''
-        重写默认，从缓存获取数据
+        重写默认，返回未执行的queryset，由游标分页按页查询并缓存
         :return:
         '''
-        key = self.get_queryset_cache_key()
-        value = self.get_queryset_from_cache(key)
-        return value
+        return self.get_queryset_data()
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        """游标分页，分页按固定条数切分，不支持 orphans"""
+        return KeysetPaginator(
+            queryset, per_page, self.get_listing_cache_key(),
+            load_objects=self.get_article_cards,
+            allow_empty_first_page=allow_empty_first_page, **kwargs)
+
+    @staticmethod
+    def get_article_cards(article_ids):
+        """
+        列表页展示的文章，作者和分类在同一条查询中取出，标签批量预取，
+        查询次数与每页文章数无关
+        :param article_ids: 文章id列表
+        :return: 按id顺序排列的文章列表
+        """
+        articles = Article.objects.select_related('author', 'category').prefetch_related(
+            'tags').defer('body', 'body_html', 'toc_html').in_bulk(article_ids)
+        articles = [articles[i] for i in article_ids if i in articles]
+        # 渲染器升级后的旧版本文章批量补齐，不逐篇查询
+        Article.ensure_rendered_bulk(articles)
+        return articles
 
     def get_context_data(self, **kwargs):
         kwargs['linktype'] = self.link_type
@@ -99,7 +123,7 @@ class IndexView(ArticleListView):
         return article_list
 
     def get_queryset_cache_key(self):
-        cache_key = 'index_{page}'.format(page=self.page_number)
+        cache_key = 'index'
         return cache_key
 
 
@@ -112,19 +136,23 @@ class ArticleDetailView(DetailView):
     pk_url_kwarg = 'article_id'
     context_object_name = "article"
 
+    def get_queryset(self):
+        return Article.objects.select_related('author', 'category')
+
     def get_object(self, queryset=None):
-        obj = super(ArticleDetailView, self).get_object()
-        obj.viewed()
+        obj = super(ArticleDetailView, self).get_object().ensure_rendered()
+        if not self.request.META.get('CACHE_WARMUP'):
+            obj.viewed()
         self.object = obj
         return obj
 
     def get_context_data(self, **kwargs):
         comment_form = CommentForm()
 
-        article_comments = self.object.comment_list()
-        parent_comments = article_comments.filter(parent_comment=None)
+        # 评论树整体缓存，顶级评论分页和子评论都在内存中完成
+        article_comments = self.object.comment_tree()
         blog_setting = get_blog_setting()
-        paginator = Paginator(parent_comments, blog_setting.article_comment_count)
+        paginator = Paginator(article_comments.roots, blog_setting.article_comment_count)
         page = self.request.GET.get('comment_page', '1')
         if not page.isnumeric():
             page = 1
@@ -148,8 +176,7 @@ class ArticleDetailView(DetailView):
         kwargs['form'] = comment_form
         kwargs['article_comments'] = article_comments
         kwargs['p_comments'] = p_comments
-        kwargs['comment_count'] = len(
-            article_comments) if article_comments else 0
+        kwargs['comment_count'] = self.object.comment_count
 
         kwargs['next_article'] = self.object.next_article
         kwargs['prev_article'] = self.object.prev_article
@@ -163,27 +190,27 @@ class CategoryDetailView(ArticleListView):
     '''
     page_type = "分类目录归档"
 
-    def get_queryset_data(self):
-        slug = self.kwargs['category_name']
-        category = get_object_or_404(Category, slug=slug)
+    @cached_property
+    def category(self):
+        return get_object_or_404(Category, slug=self.kwargs['category_name'])
 
-        categoryname = category.name
-        self.categoryname = categoryname
-        categorynames = list(
-            map(lambda c: c.name, category.get_sub_categorys()))
+    def get_queryset_data(self):
+        category = self.category
+        self.categoryname = category.name
+        # 分类及其所有子分类的文章，按路径前缀一次关联查询
         article_list = Article.objects.filter(
-            category__name__in=categorynames, status='p')
+            category__path__startswith=category.ensure_path(), status='p')
         return article_list
 
     def get_queryset_cache_key(self):
-        slug = self.kwargs['category_name']
-        category = get_object_or_404(Category, slug=slug)
-        categoryname = category.name
+        categoryname = self.category.name
         self.categoryname = categoryname
-        cache_key = 'category_list_{categoryname}_{page}'.format(
-            categoryname=categoryname, page=self.page_number)
+        cache_key = 'category_list_{categoryname}'.format(categoryname=categoryname)
         return cache_key
 
+    def get_queryset_cache_namespaces(self):
+        return [model_tag(Category), model_tag(Category, self.category.pk)]
+
     def get_context_data(self, **kwargs):
 
         categoryname = self.categoryname
@@ -193,6 +220,7 @@ class CategoryDetailView(ArticleListView):
             pass
         kwargs['page_type'] = CategoryDetailView.page_type
         kwargs['tag_name'] = categoryname
+        kwargs['page_slug'] = self.kwargs['category_name']
         return super(CategoryDetailView, self).get_context_data(**kwargs)
 
 
@@ -205,8 +233,7 @@ class AuthorDetailView(ArticleListView):
     def get_queryset_cache_key(self):
         from uuslug import slugify
         author_name = slugify(self.kwargs['author_name'])
-        cache_key = 'author_{author_name}_{page}'.format(
-            author_name=author_name, page=self.page_number)
+        cache_key = 'author_{author_name}'.format(author_name=author_name)
         return cache_key
 
     def get_queryset_data(self):
@@ -215,10 +242,14 @@ class AuthorDetailView(ArticleListView):
             author__username=author_name, type='a', status='p')
         return article_list
 
+    def get_queryset_cache_namespaces(self):
+        return [Article.author_cache_tag(self.kwargs['author_name'])]
+
     def get_context_data(self, **kwargs):
         author_name = self.kwargs['author_name']
         kwargs['page_type'] = AuthorDetailView.page_type
         kwargs['tag_name'] = author_name
+        kwargs['page_slug'] = author_name
         return super(AuthorDetailView, self).get_context_data(**kwargs)
 
 
@@ -228,29 +259,32 @@ class TagDetailView(ArticleListView):
     '''
     page_type = '分类标签归档'
 
+    @cached_property
+    def tag(self):
+        return get_object_or_404(Tag, slug=self.kwargs['tag_name'])
+
     def get_queryset_data(self):
-        slug = self.kwargs['tag_name']
-        tag = get_object_or_404(Tag, slug=slug)
-        tag_name = tag.name
+        tag_name = self.tag.name
         self.name = tag_name
         article_list = Article.objects.filter(
             tags__name=tag_name, type='a', status='p')
         return article_list
 
     def get_queryset_cache_key(self):
-        slug = self.kwargs['tag_name']
-        tag = get_object_or_404(Tag, slug=slug)
-        tag_name = tag.name
+        tag_name = self.tag.name
         self.name = tag_name
-        cache_key = 'tag_{tag_name}_{page}'.format(
-            tag_name=tag_name, page=self.page_number)
+        cache_key = 'tag_{tag_name}'.format(tag_name=tag_name)
         return cache_key
 
+    def get_queryset_cache_namespaces(self):
+        return [model_tag(Tag, self.tag.pk)]
+
     def get_context_data(self, **kwargs):
         # tag_name = self.kwargs['tag_name']
         tag_name = self.name
         kwargs['page_type'] = TagDetailView.page_type
         kwargs['tag_name'] = tag_name
+        kwargs['page_slug'] = self.kwargs['tag_name']
         return super(TagDetailView, self).get_context_data(**kwargs)
 
 
@@ -262,13 +296,11 @@ class ArchivesView(ArticleListView):
     paginate_by = None
     page_kwarg = None
     template_name = 'blog/article_archives.html'
+    context_object_name = 'archives'
 
-    def get_queryset_data(self):
-        return Article.objects.filter(status='p').all()
-
-    def get_queryset_cache_key(self):
-        cache_key = 'archives'
-        return cache_key
+    def get_queryset(self):
+        # 按年、月分组的归档，每个月的文章单独缓存
+        return get_archives()
 
 
 class LinkListView(ListView):
@@ -373,3 +405,9 @@ def permission_denied_view(
 def clean_cache_view(request):
     cache.clear()
     return HttpResponse('ok')
+
+
+def cache_stats_view(request):
+    """按 key 前缀汇总的缓存统计，仅管理员可访问（注册在后台）"""
+    cache_stats.flush()
+    return JsonResponse(cache_stats.load())
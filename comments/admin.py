@@ -1,15 +1,36 @@
 from django.contrib import admin
+from django.db import transaction
 from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
+from blog.models import Article
+from comments.models import Comment, update_comment_count
+from djangoblog.cache_dependency import invalidate, model_tag
+from djangoblog.utils import delete_sidebar_cache
+
+
+def invalidate_comment_caches(article_ids):
+    """使文章的评论树、整页缓存和侧边栏的最新评论失效"""
+    invalidate(model_tag(Comment), *[model_tag(Article, pk) for pk in article_ids])
+    delete_sidebar_cache()
+
+
+def set_commentstatus(queryset, is_enable):
+    with transaction.atomic():
+        article_ids = set(queryset.values_list('article_id', flat=True))
+        queryset.update(is_enable=is_enable)
+        update_comment_count(article_ids)
+        # queryset.update 不发送信号，提交后手动使缓存失效
+        transaction.on_commit(lambda: invalidate_comment_caches(article_ids))
+
 
 def disable_commentstatus(modeladmin, request, queryset):
-    queryset.update(is_enable=False)
+    set_commentstatus(queryset, False)
 
 
 def enable_commentstatus(modeladmin, request, queryset):
-    queryset.update(is_enable=True)
+    set_commentstatus(queryset, True)
 
 
 disable_commentstatus.short_description = _('Disable comments')
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.20 on 2026-10-19 04:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0003_alter_comment_options_remove_comment_created_time_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='body_html',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='body html'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='render_version',
+            field=models.CharField(blank=True, default='', editable=False, max_length=32, verbose_name='render version'),
+        ),
+    ]
@@ -1,9 +1,16 @@
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils.html import escape
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
 from blog.models import Article
+from djangoblog.cache_dependency import model_tag
+from djangoblog.utils import CommonMarkdown, SANITIZER_VERSION, sanitize_html
 
 
 # Create your models here.
@@ -28,6 +35,14 @@ class Comment(models.Model):
         on_delete=models.CASCADE)
     is_enable = models.BooleanField(_('enable'),
                                     default=False, blank=False, null=False)
+    # 保存时生成的已过滤 HTML，显示评论时直接输出
+    body_html = models.TextField(_('body html'), blank=True, default='', editable=False)
+    render_version = models.CharField(
+        _('render version'), max_length=32, blank=True, default='', editable=False)
+
+    RENDERED_FIELDS = ('body_html', 'render_version')
+    # 评论模板用到的作者字段，缓存评论时只加载这些，避免把密码哈希等整行用户数据写进缓存
+    AUTHOR_FIELDS = ('author__username', 'author__email', 'author__is_superuser')
 
     class Meta:
         ordering = ['-id']
@@ -37,3 +52,97 @@ class Comment(models.Model):
 
     def __str__(self):
         return self.body
+
+    @staticmethod
+    def get_render_version():
+        """渲染结果的版本，markdown 渲染器或 HTML 过滤规则变化时改变"""
+        return '{version}:{sanitizer}'.format(version=CommonMarkdown.VERSION, sanitizer=SANITIZER_VERSION)
+
+    @staticmethod
+    def render_body(body, use_cache=True):
+        """
+        转义正文后转换 markdown，再过滤不允许的标签，不访问数据库
+        :param body: 评论正文
+        :param use_cache: 是否使用 markdown 渲染缓存，批量重新渲染时强制重新转换
+        :return: {字段: 值}
+        """
+        body = escape(body)
+        if use_cache:
+            body_html = CommonMarkdown.get_markdown(body)
+        else:
+            body_html = CommonMarkdown._convert_markdown(body)[0]
+        return {'body_html': sanitize_html(body_html)}
+
+    def render(self):
+        self.body_html = Comment.render_body(self.body)['body_html']
+        self.render_version = Comment.get_render_version()
+
+    @classmethod
+    def ensure_rendered(cls, comments):
+        """
+        重新渲染旧版本（升级了渲染器、修改了过滤规则或历史数据）的评论并批量写回
+        :param comments: 评论列表
+        :return: 重新渲染的评论数
+        """
+        version = cls.get_render_version()
+        stale = [comment for comment in comments if comment.render_version != version]
+        for comment in stale:
+            comment.render()
+        if stale:
+            cls.objects.bulk_update(stale, cls.RENDERED_FIELDS)
+        return len(stale)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'body' in update_fields:
+            self.render()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | set(Comment.RENDERED_FIELDS)
+        with transaction.atomic():
+            previous = None
+            if not self._state.adding:
+                previous = Comment.objects.select_for_update().filter(pk=self.pk).values_list(
+                    'is_enable', 'article_id').first()
+            super().save(*args, **kwargs)
+            # 审核状态或所属文章变化时，在同一事务中更新文章的评论数
+            if previous != (self.is_enable, self.article_id):
+                if previous and previous[0]:
+                    change_comment_count(previous[1], -1)
+                if self.is_enable:
+                    change_comment_count(self.article_id, 1)
+
+    def get_cache_dependency_tags(self):
+        return [model_tag(Article, self.article_id)]
+
+
+def change_comment_count(article_id, delta):
+    """
+    原子增减文章的评论数
+    :param article_id: 文章id
+    :param delta: 变化量
+    """
+    articles = Article.objects.filter(pk=article_id)
+    if delta < 0:
+        articles = articles.filter(comment_count__gte=-delta)
+    articles.update(comment_count=F('comment_count') + delta)
+
+
+def update_comment_count(article_ids=None):
+    """
+    用一条 UPDATE 重新统计文章的评论数，用于批量审核和修复
+    :param article_ids: 文章id，为空时统计所有文章
+    :return: 更新的文章数
+    """
+    counts = Comment.objects.filter(article=OuterRef('pk'), is_enable=True).order_by().values(
+        'article').annotate(count=Count('pk')).values('count')
+    articles = Article.objects.all()
+    if article_ids is not None:
+        articles = articles.filter(pk__in=article_ids)
+    return articles.update(comment_count=Coalesce(Subquery(counts), 0))
+
+
+@receiver(post_delete, sender=Comment)
+def comment_post_delete_callback(sender, instance, **kwargs):
+    # 删除在事务中进行，级联删除的子评论也会逐条触发
+    if instance.is_enable:
+        change_comment_count(instance.article_id, -1)
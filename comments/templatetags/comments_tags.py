@@ -1,23 +1,28 @@
 from django import template
 
+from comments.tree import CommentTree
+
 register = template.Library()
 
 
+def _as_tree(commentlist):
+    return commentlist if isinstance(commentlist, CommentTree) else CommentTree(commentlist)
+
+
 @register.simple_tag
 def parse_commenttree(commentlist, comment):
-    """获得当前评论子评论的列表
+    """获得当前评论所有子孙评论的列表
         用法: {% parse_commenttree article_comments comment as childcomments %}
     """
-    datas = []
+    return _as_tree(commentlist).get_descendants(comment)
 
-    def parse(c):
-        childs = commentlist.filter(parent_comment=c, is_enable=True)
-        for child in childs:
-            datas.append(child)
-            parse(child)
 
-    parse(comment)
-    return datas
+@register.simple_tag
+def child_comments(commentlist, comment):
+    """获得直接回复当前评论的子评论
+        用法: {% child_comments article_comments comment as childcomments %}
+    """
+    return _as_tree(commentlist).get_children(comment)
 
 
 @register.inclusion_tag('comments/tags/comment_item.html')
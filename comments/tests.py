@@ -107,3 +107,134 @@ class CommentsTest(TransactionTestCase):
 
         from comments.utils import send_comment_email
         send_comment_email(comment)
+
+    def test_comment_count(self):
+        category = Category.objects.create(name="categorycount")
+        article = Article.objects.create(
+            title="comment count", body="comment count", author=self.user, category=category)
+
+        def comment_count():
+            return Article.objects.get(pk=article.pk).comment_count
+
+        comment = Comment.objects.create(body="count1", author=self.user, article=article)
+        self.assertEqual(comment_count(), 0)
+        comment.is_enable = True
+        comment.save()
+        comment.save()
+        self.assertEqual(comment_count(), 1)
+        child = Comment.objects.create(body="count2", author=self.user, article=article,
+                                       parent_comment=comment, is_enable=True)
+        self.assertEqual(comment_count(), 2)
+
+        # 保存文章不会覆盖评论数
+        article.title = "comment count changed"
+        article.save()
+        self.assertEqual(comment_count(), 2)
+        self.assertEqual(article.comment_count, 2)
+        # 记录不存在时仍按 Django 的默认行为插入
+        other = Article.objects.create(
+            title="comment count other", body="other", author=self.user, category=category)
+        Article.objects.filter(pk=other.pk).delete()
+        other.save()
+        self.assertTrue(Article.objects.filter(pk=other.pk).exists())
+
+        from comments.admin import disable_commentstatus, enable_commentstatus
+        disable_commentstatus(None, None, Comment.objects.filter(pk=child.pk))
+        self.assertEqual(comment_count(), 1)
+        enable_commentstatus(None, None, Comment.objects.filter(pk=child.pk))
+        self.assertEqual(comment_count(), 2)
+
+        # 删除父评论时级联删除子评论
+        Comment.objects.get(pk=comment.pk).delete()
+        self.assertEqual(comment_count(), 0)
+
+        Comment.objects.create(body="count3", author=self.user, article=article, is_enable=True)
+        Article.objects.filter(pk=article.pk).update(comment_count=10)
+        from django.core.management import call_command
+        call_command('repair_comment_count')
+        self.assertEqual(comment_count(), 1)
+
+    def test_comment_tree(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from comments.tree import CommentTree
+        category = Category.objects.create(name="categorytree")
+        article = Article.objects.create(
+            title="comment tree", body="comment tree", author=self.user, category=category)
+        root = Comment.objects.create(body="root", author=self.user, article=article, is_enable=True)
+        child = Comment.objects.create(body="child", author=self.user, article=article,
+                                       parent_comment=root, is_enable=True)
+        grandchild = Comment.objects.create(body="grandchild", author=self.user, article=article,
+                                            parent_comment=child, is_enable=True)
+        hidden = Comment.objects.create(body="hidden", author=self.user, article=article,
+                                        parent_comment=root)
+        Comment.objects.create(body="hidden child", author=self.user, article=article,
+                               parent_comment=hidden, is_enable=True)
+
+        with self.assertNumQueries(1):
+            tree = CommentTree.load(article)
+            self.assertEqual(tree.roots, [root])
+            self.assertEqual(tree.get_children(root), [child])
+            self.assertEqual(tree.get_descendants(root), [child, grandchild])
+            self.assertEqual(tree.get_children(child)[0].parent_comment.author.username,
+                             self.user.username)
+        # 缓存的评论树不带作者的密码哈希
+        self.assertIn('password', tree.roots[0].author.get_deferred_fields())
+
+        url = article.get_absolute_url()
+        with self.settings(PAGE_CACHE_ENABLED=False):
+            self.client.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                rsp = self.client.get(url)
+        self.assertContains(rsp, 'grandchild')
+        self.assertNotContains(rsp, 'hidden child')
+        self.assertFalse([q for q in queries.captured_queries if 'comments_comment' in q['sql']])
+
+        # 后台批量审核后评论树、整页缓存和侧边栏立即更新
+        from comments.admin import enable_commentstatus
+        from djangoblog.utils import cache, get_sidebar_cache_key
+        self.client.get(url)
+        self.assertIsNotNone(cache.get(get_sidebar_cache_key('p') + '_fresh'))
+        enable_commentstatus(None, None, Comment.objects.filter(pk=hidden.pk))
+        self.assertIn(hidden, article.comment_tree().get_children(root))
+        self.assertIsNone(cache.get(get_sidebar_cache_key('p') + '_fresh'))
+        self.assertContains(self.client.get(url), 'hidden child')
+
+    def test_comment_body_html(self):
+        import os
+        import tempfile
+        from io import StringIO
+        from unittest import mock
+        from django.core.management import call_command
+        from djangoblog import utils
+        from comments.tree import CommentTree
+        category = Category.objects.create(name="categoryhtml")
+        article = Article.objects.create(
+            title="comment html", body="comment html", author=self.user, category=category)
+        comment = Comment.objects.create(body="**bold** <script>alert(1)</script>", author=self.user,
+                                         article=article, is_enable=True)
+        self.assertIn('<strong>bold</strong>', comment.body_html)
+        self.assertIn('&lt;script&gt;', comment.body_html)
+        self.assertEqual(comment.render_version, Comment.get_render_version())
+        comment.body = 'edited'
+        comment.save(update_fields=['body'])
+        self.assertEqual(Comment.objects.get(pk=comment.pk).body_html, '<p>edited</p>')
+
+        # 显示评论时不再转换和过滤
+        with mock.patch.object(utils.CommonMarkdown, '_convert_markdown') as convert:
+            CommentTree.load(article)
+            self.assertEqual(convert.call_count, 0)
+
+        # 过滤规则升级后，加载评论树时补齐旧版本，批量命令重新生成全部评论
+        with mock.patch('comments.models.SANITIZER_VERSION', utils.SANITIZER_VERSION + 1):
+            version = Comment.get_render_version()
+            tree = CommentTree.load(article)
+            self.assertEqual(tree.comments[0].render_version, version)
+            Comment.objects.filter(pk=comment.pk).update(body_html='', render_version='')
+            out = StringIO()
+            call_command('rerender_content', '--target', 'comments', '--workers', '0',
+                         '--start-id', str(comment.pk - 1), '--checkpoint-file',
+                         os.path.join(tempfile.mkdtemp(), 'rerender.checkpoint'), stdout=out)
+            self.assertIn('rerendered 1 comments', out.getvalue())
+            comment = Comment.objects.get(pk=comment.pk)
+            self.assertEqual((comment.body_html, comment.render_version), ('<p>edited</p>', version))
@@ -0,0 +1,65 @@
+"""
+文章评论树
+
+一次查询取出文章所有已审核的评论和作者（只取模板用到的作者字段），在内存中按 ``parent_comment_id`` 一遍建立父子关系。
+评论的过滤后 HTML 在保存时生成（见 ``Comment.body_html``），渲染评论时不再转换 markdown。
+整棵树按文章缓存，详情页对顶级评论的分页和每条评论的子评论都只是列表切片，不再逐条查询。
+"""
+from collections import defaultdict
+
+
+class CommentTree(object):
+
+    def __init__(self, comments):
+        """
+        :param comments: 文章已审核的评论，按id倒序
+        """
+        self.comments = list(comments)
+        self.roots = []
+        self.children = defaultdict(list)
+        comments_by_id = {comment.id: comment for comment in self.comments}
+        for comment in self.comments:
+            if comment.parent_comment_id is None:
+                self.roots.append(comment)
+                continue
+            parent = comments_by_id.get(comment.parent_comment_id)
+            # 父评论未审核时子评论不显示
+            if parent is not None:
+                comment.parent_comment = parent
+                self.children[parent.id].append(comment)
+
+    @classmethod
+    def load(cls, article):
+        """
+        一次查询加载文章的评论树
+        :param article: 文章
+        """
+        from comments.models import Comment
+        fields = [field.name for field in Comment._meta.concrete_fields]
+        comments = list(Comment.objects.filter(article=article, is_enable=True).select_related(
+            'author').only(*fields, *Comment.AUTHOR_FIELDS).order_by('-id'))
+        # 评论的 HTML 在保存时生成，这里只补齐旧版本的，缓存的评论树中都是最新的 HTML
+        Comment.ensure_rendered(comments)
+        return cls(comments)
+
+    def __len__(self):
+        return len(self.comments)
+
+    def __iter__(self):
+        return iter(self.comments)
+
+    def get_children(self, comment):
+        """直接回复该评论的子评论"""
+        return self.children.get(comment.id, [])
+
+    def get_descendants(self, comment):
+        """
+        该评论下的所有子孙评论，深度优先排列
+        """
+        result = []
+        stack = list(reversed(self.get_children(comment)))
+        while stack:
+            child = stack.pop()
+            result.append(child)
+            stack.extend(reversed(self.get_children(child)))
+        return result
@@ -29,15 +29,15 @@ class DjangoBlogAdminSite(AdminSite):
     def has_permission(self, request):
         return request.user.is_superuser
 
-    # def get_urls(self):
-    #     urls = super().get_urls()
-    #     from django.urls import path
-    #     from blog.views import refresh_memcache
-    #
-    #     my_urls = [
-    #         path('refresh/', self.admin_view(refresh_memcache), name="refresh"),
-    #     ]
-    #     return urls + my_urls
+    def get_urls(self):
+        urls = super().get_urls()
+        from django.urls import path
+        from blog.views import cache_stats_view
+
+        my_urls = [
+            path('cache_stats/', self.admin_view(cache_stats_view), name="cache_stats"),
+        ]
+        return my_urls + urls
 
 
 admin_site = DjangoBlogAdminSite(name='admin')
@@ -6,13 +6,20 @@ from django.conf import settings
 from django.contrib.admin.models import LogEntry
 from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.core.mail import EmailMultiAlternatives
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 
+from blog.models import Article
+from blog.neighbor_index import neighbor_index
+from blog.tag_counts import tag_counts
 from comments.models import Comment
 from comments.utils import send_comment_email
+from accounts.models import BlogUser
+from djangoblog.cache_dependency import USER_PROFILE_FIELDS, USER_PROFILE_TAG
+from djangoblog.cache_dependency import instance_tags, invalidate, model_tag
 from djangoblog.spider_notify import SpiderNotify
-from djangoblog.utils import cache, expire_view_cache, delete_sidebar_cache, delete_view_cache
+from djangoblog.utils import expire_view_cache, delete_sidebar_cache, delete_view_cache
 from djangoblog.utils import get_current_site
 from oauth.models import OAuthUser
 
@@ -64,6 +71,46 @@ def oauth_user_login_signal_handler(sender, **kwargs):
     delete_sidebar_cache()
 
 
+def is_update_views(update_fields):
+    return update_fields is not None and set(update_fields) == {'views'}
+
+
+def invalidate_tags(*tags):
+    invalidate(*tags)
+    if settings.CACHE_PREWARM_AFTER_INVALIDATION:
+        from blog.cache_warmer import schedule_prewarm
+        schedule_prewarm()
+
+
+@receiver(pre_save)
+def model_pre_save_callback(sender, instance, raw, update_fields, **kwargs):
+    """记录保存前的关联对象，例如文章修改分类后，原分类的缓存也需要失效"""
+    if raw or instance.pk is None or not hasattr(instance, 'get_cache_dependency_tags'):
+        return
+    if is_update_views(update_fields):
+        return
+    previous = sender.objects.filter(pk=instance.pk).first()
+    if previous:
+        instance._previous_cache_dependency_tags = previous.get_cache_dependency_tags()
+        if isinstance(instance, Article):
+            instance._previous_status = previous.status
+
+
+@receiver(pre_save, sender=BlogUser)
+def user_pre_save_callback(sender, instance, raw, **kwargs):
+    """记录页面上显示的用户资料是否变化，登录时只更新 last_login 不需要失效整页缓存"""
+    if raw or instance.pk is None:
+        return
+    previous = sender.objects.filter(pk=instance.pk).values_list(*USER_PROFILE_FIELDS).first()
+    instance._profile_changed = previous != tuple(getattr(instance, f) for f in USER_PROFILE_FIELDS)
+
+
+@receiver(post_save, sender=BlogUser)
+def user_post_save_callback(sender, instance, raw, **kwargs):
+    if getattr(instance, '_profile_changed', False):
+        invalidate_tags(USER_PROFILE_TAG)
+
+
 @receiver(post_save)
 def model_post_save_callback(
         sender,
@@ -73,19 +120,15 @@ def model_post_save_callback(
         using,
         update_fields,
         **kwargs):
-    clearcache = False
     if isinstance(instance, LogEntry):
         return
     if 'get_full_url' in dir(instance):
-        is_update_views = update_fields == {'views'}
-        if not settings.TESTING and not is_update_views:
+        if not settings.TESTING and not is_update_views(update_fields):
             try:
                 notify_url = instance.get_full_url()
                 SpiderNotify.baidu_notify([notify_url])
             except Exception as ex:
                 logger.error("notify sipder", ex)
-        if not is_update_views:
-            clearcache = True
 
     if isinstance(instance, Comment):
         if instance.is_enable:
@@ -99,18 +142,94 @@ def model_post_save_callback(
                 servername=site,
                 serverport=80,
                 key_prefix='blogdetail')
-            if cache.get('seo_processor'):
-                cache.delete('seo_processor')
-            comment_cache_key = 'article_comments_{id}'.format(
-                id=instance.article.id)
-            cache.delete(comment_cache_key)
-            delete_sidebar_cache()
             delete_view_cache('article_comments', [str(instance.article.pk)])
 
             _thread.start_new_thread(send_comment_email, (instance,))
 
-    if clearcache:
-        cache.clear()
+    # 只更新阅读数时不失效缓存，否则每次阅读都会清空列表页和整页缓存
+    if not is_update_views(update_fields):
+        invalidate_tags(*instance_tags(instance))
+        if isinstance(instance, Article):
+            update_neighbor_index(instance)
+            update_tag_counts_on_status(instance)
+
+
+def update_neighbor_index(article, deleted=False):
+    """事务提交后再修改上一篇/下一篇索引，回滚的修改不会出现在索引中"""
+    item = (article.creation_time, article.title) if not deleted and article.status == 'p' else None
+    article_id = article.id
+    transaction.on_commit(lambda: neighbor_index.update(article_id, item))
+
+
+def update_tag_counts_on_status(article):
+    """
+    文章发布或撤回时修改其标签的文章数，新建的文章此时还没有标签。
+    在事务提交后修改，回滚时不会留下错误的计数
+    """
+    previous = getattr(article, '_previous_status', None)
+    if previous is None or previous == article.status or 'p' not in (previous, article.status):
+        return
+    change_tag_counts(article.tags.values_list('id', flat=True), 1 if article.status == 'p' else -1)
+
+
+def change_tag_counts(tag_ids, delta):
+    """事务提交后再修改共享的标签文章数，回滚时不会留下错误的计数"""
+    tag_ids = list(tag_ids)
+    if tag_ids:
+        transaction.on_commit(lambda: tag_counts.change(tag_ids, delta))
+
+
+@receiver(pre_delete)
+def model_pre_delete_callback(sender, instance, **kwargs):
+    if isinstance(instance, LogEntry):
+        return
+    # 删除后关联关系已不存在，提前计算需要失效的标签
+    instance._deleted_cache_dependency_tags = instance_tags(instance)
+    if isinstance(instance, Article) and instance.status == 'p':
+        instance._deleted_tag_ids = list(instance.tags.values_list('id', flat=True))
+
+
+@receiver(post_delete)
+def model_post_delete_callback(sender, instance, **kwargs):
+    tags = getattr(instance, '_deleted_cache_dependency_tags', None)
+    if tags:
+        invalidate_tags(*tags)
+    if isinstance(instance, Article):
+        update_neighbor_index(instance, deleted=True)
+        change_tag_counts(getattr(instance, '_deleted_tag_ids', ()), -1)
+
+
+@receiver(m2m_changed)
+def model_m2m_changed_callback(sender, instance, action, model, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove'):
+        invalidate_tags(*instance_tags(instance),
+                        *[model_tag(model, pk) for pk in pk_set])
+    elif action == 'pre_clear':
+        invalidate_tags(*instance_tags(instance))
+
+
+@receiver(m2m_changed, sender=Article.tags.through)
+def article_tags_changed_callback(sender, instance, action, reverse, pk_set, **kwargs):
+    """已发布文章增删标签时增量修改标签的文章数"""
+    if reverse:
+        # 从标签一侧修改时直接重新统计
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            transaction.on_commit(tag_counts.clear)
+        return
+    if instance.status != 'p':
+        return
+    if action == 'post_add':
+        change_tag_counts(pk_set, 1)
+    elif action == 'pre_remove':
+        # pk_set 中可能有本来就没有关联的标签
+        instance._removed_tag_ids = list(
+            instance.tags.filter(pk__in=pk_set).values_list('id', flat=True))
+    elif action == 'post_remove':
+        change_tag_counts(getattr(instance, '_removed_tag_ids', ()), -1)
+    elif action == 'pre_clear':
+        instance._removed_tag_ids = list(instance.tags.values_list('id', flat=True))
+    elif action == 'post_clear':
+        change_tag_counts(getattr(instance, '_removed_tag_ids', ()), -1)
 
 
 @receiver(user_logged_in)
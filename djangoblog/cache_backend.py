@@ -12,71 +12,497 @@ Redis 运行一段时间后偶尔报错：You can't write against a read only re
 这个修复方案不保证解决问题
 """
 
+import json
 import logging
+import os
+import pickle
+import socket
+import threading
+import time
+from collections import OrderedDict
 
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
 from django.core.cache.backends.redis import RedisCache
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
 
 logger = logging.getLogger(__name__)
 
 
+class CircuitBreaker:
+    """熔断器：连续失败 threshold 次后打开，cooldown 秒内直接跳过 Redis，
+    之后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开。"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Redis cache circuit breaker opened after %d failures", self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class CacheMetrics:
+    """按操作统计调用次数、错误数、熔断跳过次数和耗时直方图（毫秒）"""
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = {}
+
+    def _operation(self, operation):
+        return self.operations.setdefault(operation, {
+            'calls': 0,
+            'errors': 0,
+            'short_circuited': 0,
+            'total_ms': 0.0,
+            'histogram': [0] * (len(self.BUCKETS) + 1),
+        })
+
+    def observe(self, operation, seconds, error=False):
+        elapsed_ms = seconds * 1000
+        index = len(self.BUCKETS)
+        for i, bound in enumerate(self.BUCKETS):
+            if elapsed_ms <= bound:
+                index = i
+                break
+        with self._lock:
+            data = self._operation(operation)
+            data['calls'] += 1
+            data['total_ms'] += elapsed_ms
+            data['histogram'][index] += 1
+            if error:
+                data['errors'] += 1
+
+    def short_circuit(self, operation):
+        with self._lock:
+            self._operation(operation)['short_circuited'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {op: dict(data, histogram=list(data['histogram']))
+                    for op, data in self.operations.items()}
+
+    @classmethod
+    def percentile(cls, histogram, q):
+        """根据直方图估算分位数，返回所在桶的上界（毫秒），超过最大桶返回 None"""
+        total = sum(histogram)
+        if not total:
+            return 0
+        threshold = total * q
+        cumulative = 0
+        for i, count in enumerate(histogram):
+            cumulative += count
+            if cumulative >= threshold:
+                return cls.BUCKETS[i] if i < len(cls.BUCKETS) else None
+        return None
+
+
 class SafeRedisCache(RedisCache):
     """Redis 缓存后端，捕获连接/只读等异常，降级为缓存未命中。
 
     当 Redis 出现 ReadOnlyError、ConnectionError 等故障时，
     不会抛出异常导致页面 500，而是静默降级（跳过缓存）。
+    连续失败后熔断一段时间，期间不再连接 Redis，避免每次调用都等待超时。
+    每个操作的耗时和错误数定期写入 Redis，通过 ``manage.py cache_metrics`` 查看。
+
+    OPTIONS 中可以配置：
+        CIRCUIT_BREAKER_THRESHOLD  连续失败多少次后熔断，默认 5
+        CIRCUIT_BREAKER_COOLDOWN   熔断秒数，默认 30
+        METRICS_INTERVAL           指标写入 Redis 的间隔秒数，默认 60
     """
+    METRICS_KEY = 'djangoblog:cache_metrics'
+    _breakers = {}
+    _metrics = {}
 
-    def get(self, key, default=None, version=None):
+    def __init__(self, server, params):
+        params = dict(params)
+        options = dict(params.get('OPTIONS', {}))
+        threshold = options.pop('CIRCUIT_BREAKER_THRESHOLD', 5)
+        cooldown = options.pop('CIRCUIT_BREAKER_COOLDOWN', 30)
+        self.metrics_interval = options.pop('METRICS_INTERVAL', 60)
+        params['OPTIONS'] = options
+        super().__init__(server, params)
+        # django 的缓存实例是每个线程一个，熔断器和指标按进程共享
+        self.breaker = self._breakers.setdefault(server, CircuitBreaker(threshold, cooldown))
+        self.metrics = self._metrics.setdefault(server, CacheMetrics())
+        self._metrics_published_at = time.monotonic()
+
+    def _call(self, operation, default, func, *args, **kwargs):
+        if not self.breaker.allow():
+            self.metrics.short_circuit(operation)
+            return default
+        start = time.perf_counter()
         try:
-            return super().get(key, default, version)
+            result = func(*args, **kwargs)
+        except ValueError:
+            # incr 不存在的 key 等正常情况，不算 Redis 故障
+            self.metrics.observe(operation, time.perf_counter() - start)
+            self.breaker.record_success()
+            return default
         except Exception:
-            logger.warning("Redis cache get failed for key: %s", key)
+            self.metrics.observe(operation, time.perf_counter() - start, error=True)
+            self.breaker.record_failure()
+            logger.warning("Redis cache %s failed", operation)
             return default
+        self.metrics.observe(operation, time.perf_counter() - start)
+        self.breaker.record_success()
+        self._publish_metrics()
+        return result
 
-    def set(self, *args, **kwargs):
+    def _publish_metrics(self):
+        now = time.monotonic()
+        if now - self._metrics_published_at < self.metrics_interval:
+            return
+        self._metrics_published_at = now
         try:
-            return super().set(*args, **kwargs)
+            self._cache.get_client(write=True).hset(
+                self.METRICS_KEY,
+                '{host}:{pid}'.format(host=socket.gethostname(), pid=os.getpid()),
+                json.dumps({
+                    'time': time.time(),
+                    'breaker': self.breaker.state,
+                    'operations': self.metrics.snapshot(),
+                }))
         except Exception:
-            logger.warning("Redis cache set failed")
+            logger.warning("Redis cache metrics publish failed")
+
+    def get_published_metrics(self):
+        """读取所有进程写入的指标"""
+        values = self._cache.get_client().hgetall(self.METRICS_KEY)
+        return {k.decode('utf-8'): json.loads(v) for k, v in values.items()}
+
+    def get(self, key, default=None, version=None):
+        return self._call('get', default, super().get, key, default, version)
+
+    def set(self, *args, **kwargs):
+        return self._call('set', None, super().set, *args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        return self._call('add', False, super().add, *args, **kwargs)
+
+    def touch(self, *args, **kwargs):
+        return self._call('touch', False, super().touch, *args, **kwargs)
 
     def delete(self, *args, **kwargs):
-        try:
-            return super().delete(*args, **kwargs)
-        except Exception:
-            logger.warning("Redis cache delete failed")
+        return self._call('delete', False, super().delete, *args, **kwargs)
 
     def clear(self):
-        try:
-            return super().clear()
-        except Exception:
-            logger.warning("Redis cache clear failed")
+        return self._call('clear', None, super().clear)
 
     def has_key(self, *args, **kwargs):
-        try:
-            return super().has_key(*args, **kwargs)
-        except Exception:
-            return False
+        return self._call('has_key', False, super().has_key, *args, **kwargs)
 
     def get_many(self, *args, **kwargs):
-        try:
-            return super().get_many(*args, **kwargs)
-        except Exception:
-            return {}
+        return self._call('get_many', {}, super().get_many, *args, **kwargs)
 
     def set_many(self, *args, **kwargs):
-        try:
-            return super().set_many(*args, **kwargs)
-        except Exception:
-            return []
+        return self._call('set_many', [], super().set_many, *args, **kwargs)
 
     def delete_many(self, *args, **kwargs):
-        try:
-            return super().delete_many(*args, **kwargs)
-        except Exception:
-            pass
+        return self._call('delete_many', None, super().delete_many, *args, **kwargs)
 
     def incr(self, key, delta=1, version=None):
+        return self._call('incr', None, super().incr, key, delta, version)
+
+
+_MISSING = object()
+
+
+class LocalLRUCache:
+    """进程内 LRU 缓存，限制条数和过期时间，值以 pickle 保存，避免调用方修改返回值污染缓存"""
+
+    def __init__(self, max_entries=1000, timeout=60):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return _MISSING
+            pickled, expire_at = item
+            if expire_at < time.monotonic():
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+        return pickle.loads(pickled)
+
+    def set(self, key, value):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._data[key] = (pickled, time.monotonic() + self.timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LocalInvalidationChannel:
+    """进程内的失效广播，用于测试或单进程部署"""
+    _subscribers = []
+
+    def __init__(self, cache):
+        pass
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def publish(self, key):
+        for callback in list(self._subscribers):
+            callback(key)
+
+
+class RedisInvalidationChannel:
+    """通过 Redis pub/sub 把失效消息广播给所有 gunicorn worker 和节点"""
+    channel_name = 'djangoblog:cache_invalidation'
+
+    def __init__(self, cache):
+        self._client = cache._cache.get_client(write=True)
+
+    def subscribe(self, callback):
+        def handler(message):
+            callback(message['data'].decode('utf-8'))
+
+        def exception_handler(ex, pubsub, thread):
+            # 断线期间可能丢失失效消息，清空本地缓存
+            logger.warning("Redis cache invalidation channel failed: %s", ex)
+            callback(TwoTierCache.CLEAR_ALL)
+            time.sleep(1)
+
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel_name: handler})
+        pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=exception_handler)
+
+    def publish(self, key):
         try:
-            return super().incr(key, delta, version)
+            self._client.publish(self.channel_name, key)
         except Exception:
-            return None
+            logger.warning("Redis cache invalidation publish failed for key: %s", key)
+
+
+class TwoTierCache(BaseCache):
+    """两级缓存：进程内 LRU（L1）+ 配置的缓存后端（L2，一般是 Redis）
+
+    只有以 L1_PREFIXES 开头的小而热的 key（站点配置、seo_processor 等）进入 L1，
+    这些 key 被修改或删除时通过 CHANNEL 广播失效消息，各进程删除本地副本，
+    L1 的过期时间兜底广播丢失的情况。其余 key 直接透传给 L2。
+
+    配置示例::
+
+        CACHES = {
+            'default': {
+                'BACKEND': 'djangoblog.cache_backend.TwoTierCache',
+                'LOCATION': 'redis',  # L2 缓存的别名
+                'OPTIONS': {'L1_MAX_ENTRIES': 1000, 'L1_TIMEOUT': 60},
+            },
+            'redis': {...},
+        }
+    """
+    CLEAR_ALL = '*'
+    DEFAULT_L1_PREFIXES = (
+        'get_blog_setting',
+        'seo_processor',
+        'cache_decorator:get_current_site',
+    )
+    # 订阅失败后多久重试
+    CHANNEL_RETRY_INTERVAL = 30
+    _local_caches = {}
+    _channels = {}
+    _channel_retry_at = {}
+    _channels_lock = threading.Lock()
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._l2_alias = location
+        self._l1_prefixes = tuple(options.get('L1_PREFIXES', self.DEFAULT_L1_PREFIXES))
+        self._local = self._local_caches.setdefault(location, LocalLRUCache(
+            max_entries=options.get('L1_MAX_ENTRIES', 1000),
+            timeout=options.get('L1_TIMEOUT', 60)))
+        self._channel_class = options.get('CHANNEL')
+
+    @cached_property
+    def l2(self):
+        return caches[self._l2_alias]
+
+    def _get_channel(self):
+        """
+        获得失效广播通道，每个进程（fork 出的 worker）各自订阅一次
+        :return: 通道，订阅失败（如 Redis 不可用）时返回 None，
+                 此时 L1 只靠过期时间失效，CHANNEL_RETRY_INTERVAL 秒后再重试订阅
+        """
+        channel_key = (self._l2_alias, os.getpid())
+        channel = self._channels.get(channel_key)
+        if channel is not None or time.monotonic() < self._channel_retry_at.get(channel_key, 0):
+            return channel
+        with self._channels_lock:
+            channel = self._channels.get(channel_key)
+            if channel is not None or time.monotonic() < self._channel_retry_at.get(channel_key, 0):
+                return channel
+            if self._channel_class:
+                channel_class = import_string(self._channel_class)
+            elif isinstance(self.l2, RedisCache):
+                channel_class = RedisInvalidationChannel
+            else:
+                channel_class = LocalInvalidationChannel
+            try:
+                channel = channel_class(self.l2)
+                channel.subscribe(self._on_invalidate)
+            except Exception as e:
+                logger.error("Cache invalidation channel subscribe failed: %s", e)
+                self._channel_retry_at[channel_key] = time.monotonic() + self.CHANNEL_RETRY_INTERVAL
+                return None
+            self._channels[channel_key] = channel
+            # 订阅之前写入的 L1 可能错过了失效消息
+            self._local.clear()
+        return channel
+
+    def _publish(self, key):
+        channel = self._get_channel()
+        if channel is not None:
+            channel.publish(key)
+
+    def _on_invalidate(self, key):
+        if key == self.CLEAR_ALL:
+            self._local.clear()
+        else:
+            self._local.delete(key)
+
+    def _is_local(self, key):
+        return key.startswith(self._l1_prefixes)
+
+    def _local_key(self, key, version):
+        return '{version}:{key}'.format(version=self.version if version is None else version, key=key)
+
+    def _invalidate(self, key, version):
+        if self._is_local(key):
+            local_key = self._local_key(key, version)
+            self._local.delete(local_key)
+            self._publish(local_key)
+
+    def get(self, key, default=None, version=None):
+        if not self._is_local(key):
+            return self.l2.get(key, default, version)
+        local_key = self._local_key(key, version)
+        value = self._local.get(local_key)
+        if value is not _MISSING:
+            return value
+        # 先订阅再读取 L2，避免订阅前的失效消息丢失
+        self._get_channel()
+        value = self.l2.get(key, _MISSING, version)
+        if value is _MISSING:
+            return default
+        self._local.set(local_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        result = {}
+        remote_keys = []
+        for key in keys:
+            value = self._local.get(self._local_key(key, version)) if self._is_local(key) else _MISSING
+            if value is _MISSING:
+                remote_keys.append(key)
+            else:
+                result[key] = value
+        if remote_keys:
+            if any(self._is_local(key) for key in remote_keys):
+                # 先订阅再读取 L2，避免订阅前的失效消息丢失
+                self._get_channel()
+            remote = self.l2.get_many(remote_keys, version)
+            for key, value in remote.items():
+                if self._is_local(key):
+                    self._local.set(self._local_key(key, version), value)
+            result.update(remote)
+        return result
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        result = self.l2.set(key, value, timeout, version)
+        self._invalidate(key, version)
+        return result
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        result = self.l2.add(key, value, timeout, version)
+        if result:
+            self._invalidate(key, version)
+        return result
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.l2.touch(key, timeout, version)
+
+    def delete(self, key, version=None):
+        result = self.l2.delete(key, version)
+        self._invalidate(key, version)
+        return result
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        result = self.l2.set_many(data, timeout, version)
+        for key in data:
+            self._invalidate(key, version)
+        return result
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        result = self.l2.delete_many(keys, version)
+        for key in keys:
+            self._invalidate(key, version)
+        return result
+
+    def has_key(self, key, version=None):
+        return self.l2.has_key(key, version)
+
+    def incr(self, key, delta=1, version=None):
+        result = self.l2.incr(key, delta, version)
+        self._invalidate(key, version)
+        return result
+
+    def clear(self):
+        result = self.l2.clear()
+        self._local.clear()
+        self._publish(self.CLEAR_ALL)
+        return result
+
+    def close(self, **kwargs):
+        self.l2.close(**kwargs)
@@ -0,0 +1,193 @@
+"""
+基于依赖标签的缓存失效
+
+每个缓存值在写入时登记它所依赖的对象标签（如 ``blog.article``、``blog.category:3``），
+对象保存或删除时只清理依赖该对象的 key，而不是 ``cache.clear()`` 清空整个 Redis。
+
+标签格式：
+    ``<app_label>.<model_name>``        该模型的任意对象（列表、计数类缓存依赖它）
+    ``<app_label>.<model_name>:<pk>``   某个具体对象
+
+标签同时也是版本号命名空间：key 中拼接命名空间当前版本号（见 ``get_generation``），
+标签失效时版本号加一，该命名空间下的所有 key（例如列表的所有分页）一次性失效，无需登记和扫描 key。
+
+登记只追加不修改：每次登记用 ``incr`` 取得标签下的序号，key 单独写入 ``<标签>#<序号>``，
+过期时间与 key 相同。``blog.category`` 这类被大量 key 依赖的标签，登记的开销也与已登记的数量无关，
+不需要加锁读写整个登记表。失效时先把 ``<标签>#floor`` 移到当前序号，再读取并删除之前的登记；
+登记后发现序号已经不大于 floor 的 key 可能错过了这次失效，由登记方自己删除。
+"""
+import logging
+import time
+
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_KEY_PREFIX = 'cache_dependency:'
+GENERATION_KEY_PREFIX = 'cache_generation:'
+# 用户名、昵称或邮箱变化时失效，页面上只显示这些用户资料
+USER_PROFILE_TAG = 'accounts.bloguser:profile'
+USER_PROFILE_FIELDS = ('username', 'nickname', 'email')
+# 失效时每次读取的登记条数
+INVALIDATE_BATCH_SIZE = 1000
+
+
+def model_tag(model, pk=None):
+    """
+    获得模型（或模型实例）对应的依赖标签
+    :param model: 模型类或实例
+    :param pk: 对象主键，为空时表示整个模型
+    :return: 标签字符串
+    """
+    tag = model._meta.label_lower
+    if pk is not None:
+        tag = '{tag}:{pk}'.format(tag=tag, pk=pk)
+    return tag
+
+
+def instance_tags(instance):
+    """
+    获得对象变更时需要失效的全部标签
+    """
+    tags = {model_tag(instance), model_tag(instance, instance.pk)}
+    get_extra_tags = getattr(instance, 'get_cache_dependency_tags', None)
+    if get_extra_tags:
+        tags.update(get_extra_tags())
+    tags.update(getattr(instance, '_previous_cache_dependency_tags', ()))
+    return tags
+
+
+def _registry_key(tag, suffix):
+    return '{prefix}{tag}#{suffix}'.format(prefix=REGISTRY_KEY_PREFIX, tag=tag, suffix=suffix)
+
+
+def _generation_key(tag):
+    return GENERATION_KEY_PREFIX + tag
+
+
+def get_generation(*tags):
+    """
+    获得命名空间当前的版本号，多个命名空间的版本号用 . 拼接
+    :param tags: 命名空间标签
+    :return: 版本号字符串，拼接到缓存key中
+    """
+    generation_keys = [_generation_key(tag) for tag in tags]
+    generations = cache.get_many(generation_keys)
+    for generation_key in generation_keys:
+        if generation_key not in generations:
+            # 用当前时间初始化，避免版本号key被淘汰后从旧值重新开始，读到旧版本的数据
+            value = int(time.time() * 1000)
+            cache.add(generation_key, value, None)
+            generations[generation_key] = cache.get(generation_key, value)
+    return '.'.join(str(generations[k]) for k in generation_keys)
+
+
+def _bump_generations(tags):
+    generation_keys = [_generation_key(tag) for tag in tags]
+    # 只有被使用过的命名空间才有版本号，没有的不需要处理
+    for generation_key in cache.get_many(generation_keys):
+        try:
+            cache.incr(generation_key)
+        except ValueError:
+            pass
+
+
+def _next_index(tag):
+    """
+    取得标签下一个登记序号，计数器不存在（首次登记或被淘汰）时从 floor 开始
+    :return: 序号，缓存不可用时为 None
+    """
+    seq_key = _registry_key(tag, 'seq')
+    for _ in range(2):
+        try:
+            index = cache.incr(seq_key)
+        except ValueError:
+            # key 不存在（SafeRedisCache 此时返回 None）
+            index = None
+        if index is not None:
+            return index
+        cache.add(seq_key, cache.get(_registry_key(tag, 'floor')) or 0, None)
+    return None
+
+
+def _register(tag, key, timeout):
+    """
+    登记 key 依赖的标签
+    :return: 是否登记成功，错过了同时进行的失效也视为失败
+    """
+    index = _next_index(tag)
+    if index is None:
+        return False
+    entry_key = _registry_key(tag, index)
+    cache.set(entry_key, key, timeout)
+    if index <= (cache.get(_registry_key(tag, 'floor')) or 0):
+        cache.delete(entry_key)
+        return False
+    return True
+
+
+def register_dependencies(key, dependencies, timeout=DEFAULT_TIMEOUT):
+    """
+    登记缓存key依赖的标签
+    :param key: 缓存key
+    :param dependencies: 标签列表
+    :param timeout: key 的过期时间，登记与 key 同时过期
+    """
+    for tag in set(dependencies):
+        if not _register(tag, key, timeout):
+            # 没有登记的 key 失效时不会被清理，不能保留
+            logger.warning('register cache dependency failed.key:{key} tag:{tag}'.format(key=key, tag=tag))
+            cache.delete(key)
+            return
+
+
+def _pop_registered(tag):
+    """
+    取出并删除标签下的全部登记
+    :return: 依赖该标签的 key
+    """
+    index = cache.get(_registry_key(tag, 'seq'))
+    if index is None:
+        return set()
+    floor_key = _registry_key(tag, 'floor')
+    floor = cache.get(floor_key) or 0
+    if index <= floor:
+        return set()
+    # 先移动 floor 再读取，之后完成的登记会自己发现错过了失效
+    cache.set(floor_key, index, None)
+    keys = set()
+    for start in range(floor + 1, index + 1, INVALIDATE_BATCH_SIZE):
+        entry_keys = [_registry_key(tag, i) for i in range(start, min(start + INVALIDATE_BATCH_SIZE, index + 1))]
+        keys.update(cache.get_many(entry_keys).values())
+        cache.delete_many(entry_keys)
+    return keys
+
+
+def set_with_dependencies(key, value, timeout=DEFAULT_TIMEOUT, dependencies=()):
+    """
+    写入缓存并登记依赖
+    """
+    cache.set(key, value, timeout)
+    register_dependencies(key, dependencies, timeout)
+
+
+def invalidate(*tags):
+    """
+    清理依赖这些标签的全部缓存key，并使这些命名空间的版本号失效
+    """
+    tags = set(tags)
+    if not tags:
+        return
+    _bump_generations(tags)
+    keys = set()
+    for tag in tags:
+        keys.update(_pop_registered(tag))
+    if keys:
+        logger.info('invalidate cache tags:{tags} keys:{count}'.format(
+            tags=','.join(sorted(tags)), count=len(keys)))
+        cache.delete_many(list(keys))
+
+
+def invalidate_instance(instance):
+    invalidate(*instance_tags(instance))
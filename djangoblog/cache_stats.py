@@ -0,0 +1,205 @@
+"""
+缓存使用统计
+
+``djangoblog.utils.cache`` 是对 ``django.core.cache.cache`` 的一层包装，按 key 的逻辑前缀
+（如 ``sidebar*``、``index_*``、``cache_decorator:get_current_site``）统计命中、未命中、写入次数、
+写入值序列化后的大小，以及未命中后到写回缓存之间的计算耗时。
+测量大小需要再序列化一次写入的值，只按 ``CACHE_STATS_SIZE_SAMPLE_RATE`` 抽样测量，平均大小按抽样计算。
+
+统计先累计在进程内，每隔 ``CACHE_STATS_FLUSH_INTERVAL`` 秒通过 ``cache.incr`` 合并到缓存中，
+多个进程的数据汇总在一起，可以通过 ``python manage.py cache_stats`` 或后台的 JSON 接口查看。
+"""
+import logging
+import pickle
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY_PREFIX = 'cache_stats:'
+STATS_PREFIXES_KEY = STATS_KEY_PREFIX + 'prefixes'
+FIELDS = ('hits', 'misses', 'sets', 'sized_sets', 'set_bytes', 'computes', 'compute_us')
+
+# key 到逻辑前缀的映射，按顺序匹配
+KEY_PREFIX_RULES = [
+    (re.compile(r'^(cache_decorator:[^:]+)'), r'\1'),
+    (re.compile(r'^page_cache:'), 'page_cache:*'),
+    (re.compile(r'^sidebar'), 'sidebar*'),
+    (re.compile(r'^gravatat/'), 'gravatat/*'),
+    (re.compile(r'^article_comments_'), 'article_comments_*'),
+    (re.compile(r'^category_list_'), 'category_list_*'),
+    (re.compile(r'^(index|author|tag|archives)_'), r'\1_*'),
+]
+# 其他 key 取第一个数字、冒号或斜杠之前的部分
+FALLBACK_PREFIX = re.compile(r'^[^\d:/]*')
+
+
+def get_key_prefix(key):
+    """
+    获得 key 对应的逻辑前缀
+    :param key: 缓存key
+    :return: 前缀
+    """
+    for pattern, prefix in KEY_PREFIX_RULES:
+        match = pattern.match(key)
+        if match:
+            return match.expand(prefix)
+    prefix = FALLBACK_PREFIX.match(key).group(0)
+    return prefix if prefix == key else prefix + '*'
+
+
+def _stats_key(prefix, field):
+    return '{prefix}{field}:{key}'.format(prefix=STATS_KEY_PREFIX, field=field, key=prefix)
+
+
+class CacheStats(object):
+    """进程内累计统计，定期合并到缓存"""
+
+    def __init__(self):
+        self._pending = defaultdict(Counter)
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def record(self, key, **counts):
+        prefix = get_key_prefix(key)
+        with self._lock:
+            self._pending[prefix].update(counts)
+            should_flush = time.monotonic() - self._last_flush >= settings.CACHE_STATS_FLUSH_INTERVAL
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(Counter)
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            increments = {_stats_key(prefix, field): value
+                          for prefix, counts in pending.items()
+                          for field, value in counts.items() if value}
+            existing = django_cache.get_many(list(increments.keys()) + [STATS_PREFIXES_KEY])
+            prefixes = existing.pop(STATS_PREFIXES_KEY, None) or set()
+            if not prefixes.issuperset(pending):
+                django_cache.set(STATS_PREFIXES_KEY, prefixes | set(pending), None)
+            for key, value in increments.items():
+                if key not in existing:
+                    django_cache.add(key, 0, None)
+                django_cache.incr(key, value)
+        except Exception as e:
+            logger.error('flush cache stats failed:%s' % e)
+
+    @staticmethod
+    def load():
+        """
+        读取所有进程汇总后的统计
+        :return: {前缀: 统计}
+        """
+        prefixes = sorted(django_cache.get(STATS_PREFIXES_KEY) or ())
+        keys = [_stats_key(prefix, field) for prefix in prefixes for field in FIELDS]
+        values = django_cache.get_many(keys)
+        result = {}
+        for prefix in prefixes:
+            item = {field: values.get(_stats_key(prefix, field), 0) for field in FIELDS}
+            lookups = item['hits'] + item['misses']
+            item['hit_rate'] = round(item['hits'] / lookups, 4) if lookups else None
+            item['avg_size'] = item['set_bytes'] // item['sized_sets'] if item['sized_sets'] else None
+            item['avg_compute_ms'] = round(
+                item['compute_us'] / item['computes'] / 1000, 2) if item['computes'] else None
+            result[prefix] = item
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._pending = defaultdict(Counter)
+        prefixes = django_cache.get(STATS_PREFIXES_KEY) or ()
+        django_cache.delete_many(
+            [_stats_key(prefix, field) for prefix in prefixes for field in FIELDS] +
+            [STATS_PREFIXES_KEY])
+
+
+stats = CacheStats()
+
+_MISSING = object()
+
+
+class InstrumentedCache(object):
+    """
+    记录统计的缓存包装，接口与 ``django.core.cache.cache`` 相同
+    未命中的 key 在同一线程中被写回时，两者之间的耗时记为计算耗时；
+    ``add`` 多用于锁和标记，不计入写入统计
+    """
+    MAX_PENDING_MISSES = 100
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    @property
+    def _misses(self):
+        misses = getattr(self._local, 'misses', None)
+        if misses is None or len(misses) > self.MAX_PENDING_MISSES:
+            misses = self._local.misses = {}
+        return misses
+
+    def _record_get(self, key, hit):
+        if not settings.CACHE_STATS_ENABLED:
+            return
+        if hit:
+            stats.record(key, hits=1)
+        else:
+            stats.record(key, misses=1)
+            self._misses[key] = time.perf_counter()
+
+    def _record_set(self, key, value):
+        if not settings.CACHE_STATS_ENABLED:
+            return
+        counts = {'sets': 1}
+        sample_rate = settings.CACHE_STATS_SIZE_SAMPLE_RATE
+        if sample_rate and random.randrange(sample_rate) == 0:
+            try:
+                counts['set_bytes'] = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                counts['sized_sets'] = 1
+            except Exception:
+                pass
+        start = self._misses.pop(key, None)
+        if start is not None:
+            counts['computes'] = 1
+            counts['compute_us'] = int((time.perf_counter() - start) * 1000000)
+        stats.record(key, **counts)
+
+    def get(self, key, default=None, version=None):
+        value = self._cache.get(key, _MISSING, version)
+        self._record_get(key, value is not _MISSING)
+        return default if value is _MISSING else value
+
+    def get_many(self, keys, version=None):
+        values = self._cache.get_many(keys, version)
+        for key in keys:
+            self._record_get(key, key in values)
+        return values
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._record_set(key, value)
+        return self._cache.set(key, value, timeout, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        for key, value in data.items():
+            self._record_set(key, value)
+        return self._cache.set_many(data, timeout, version)
+
+
+cache = InstrumentedCache(django_cache)
@@ -4,7 +4,6 @@ from django.utils import timezone
 from django.utils.feedgenerator import Rss201rev2Feed
 
 from blog.models import Article
-from djangoblog.utils import CommonMarkdown
 
 
 class DjangoBlogFeed(Feed):
@@ -27,7 +26,7 @@ class DjangoBlogFeed(Feed):
         return item.title
 
     def item_description(self, item):
-        return CommonMarkdown.get_markdown(item.body)
+        return item.ensure_rendered().body_html
 
     def feed_copyright(self):
         now = timezone.now()
@@ -75,6 +75,7 @@ MIDDLEWARE = [
     # 'django.middleware.cache.FetchFromCacheMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'blog.middleware.AnonymousPageCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.http.ConditionalGetMiddleware',
@@ -208,6 +209,49 @@ if os.environ.get("DJANGO_REDIS_URL"):
             'LOCATION': f'redis://{os.environ.get("DJANGO_REDIS_URL")}',
         }
     }
+    # 进程内 LRU 作为一级缓存，减少 get_blog_setting 等热点 key 的 Redis 请求
+    if env_to_bool('DJANGO_CACHE_L1', False):
+        CACHES['redis'] = CACHES['default']
+        CACHES['default'] = {
+            'BACKEND': 'djangoblog.cache_backend.TwoTierCache',
+            'LOCATION': 'redis',
+            'OPTIONS': {
+                'L1_MAX_ENTRIES': int(os.environ.get('DJANGO_CACHE_L1_MAX_ENTRIES') or 1000),
+                'L1_TIMEOUT': int(os.environ.get('DJANGO_CACHE_L1_TIMEOUT') or 60),
+            },
+        }
+
+# 按 key 前缀统计缓存命中率、大小和计算耗时
+CACHE_STATS_ENABLED = env_to_bool('DJANGO_CACHE_STATS', True)
+CACHE_STATS_FLUSH_INTERVAL = 60
+# 每 N 次写入测量一次值的大小（需要额外序列化一次），0 表示不测量
+CACHE_STATS_SIZE_SAMPLE_RATE = int(os.environ.get('DJANGO_CACHE_STATS_SIZE_SAMPLE_RATE') or 100)
+# 缓存失效后在后台预热首页、列表页、侧边栏和热门文章
+CACHE_PREWARM_AFTER_INVALIDATION = env_to_bool('DJANGO_CACHE_PREWARM', False)
+CACHE_PREWARM_DELAY = 5
+CACHE_PREWARM_TOP_ARTICLES = 20
+CACHE_PREWARM_PAGES = 2
+CACHE_PREWARM_CONCURRENCY = 2
+# 只预热文章数最多的 N 个分类/标签/作者列表
+CACHE_PREWARM_LISTINGS = 10
+# 预热请求的 Host，需要与访问者请求的 Host 一致，默认使用站点域名
+CACHE_PREWARM_HOST = os.environ.get('DJANGO_CACHE_PREWARM_HOST') or None
+# 文章阅读数在缓存中累计，每隔多少秒批量写回数据库
+VIEW_COUNT_FLUSH_INTERVAL = 30
+# 是否在缓存中累计阅读数，None 表示只在使用 redis/memcached 等跨进程共享的缓存时累计
+VIEW_COUNT_BUFFERED = None
+# 匿名访问整页缓存，内容变更时失效
+PAGE_CACHE_ENABLED = env_to_bool('DJANGO_PAGE_CACHE', True)
+PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+PAGE_CACHE_VIEWS = [
+    'blog:index', 'blog:index_page', 'blog:detailbyid',
+    'blog:category_detail', 'blog:category_detail_page',
+    'blog:author_detail', 'blog:author_detail_page',
+    'blog:tag_detail', 'blog:tag_detail_page',
+    'blog:archives', 'blog:links',
+]
+# 只缓存带这些查询参数的请求，其他查询参数的请求不使用整页缓存
+PAGE_CACHE_QUERY_PARAMS = ['page', 'comment_page']
 
 SITE_ID = 1
 BAIDU_NOTIFY_URL = os.environ.get('DJANGO_BAIDU_NOTIFY_URL') \
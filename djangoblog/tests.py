@@ -3,6 +3,17 @@ from django.test import TestCase
 from djangoblog.utils import *
 
 
+class FailingChannel:
+    subscribes = 0
+
+    def __init__(self, cache):
+        pass
+
+    def subscribe(self, callback):
+        FailingChannel.subscribes += 1
+        raise ConnectionError('redis is down')
+
+
 class DjangoBlogTest(TestCase):
     def setUp(self):
         pass
@@ -30,3 +41,254 @@ class DjangoBlogTest(TestCase):
         }
         data = parse_dict_to_url(d)
         self.assertIsNotNone(data)
+
+    def test_markdown_render_cache(self):
+        from unittest import mock
+        content = '# markdown cache %s\n\n**body**' % uuid.uuid4().hex
+        with mock.patch.object(CommonMarkdown, '_convert_markdown',
+                               wraps=CommonMarkdown._convert_markdown) as convert:
+            body, toc = CommonMarkdown.get_markdown_with_toc(content)
+            self.assertEqual(CommonMarkdown.get_markdown(content), body)
+            self.assertEqual(convert.call_count, 1)
+            # 进程内缓存淘汰后从共享缓存读取
+            CommonMarkdown.local_cache.clear()
+            self.assertEqual(CommonMarkdown.get_markdown_with_toc(content), (body, toc))
+            self.assertEqual(convert.call_count, 1)
+        self.assertIn('<strong>body</strong>', body)
+        self.assertIn('markdown cache', toc)
+        # 同一线程复用 Markdown 实例，上一次转换的目录不会残留
+        md = CommonMarkdown._get_instance()
+        CommonMarkdown._convert_markdown('# first')
+        self.assertNotIn('first', CommonMarkdown._convert_markdown('no heading')[1])
+        self.assertIs(CommonMarkdown._get_instance(), md)
+
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+
+    def test_code_highlight_cache(self):
+        from unittest import mock
+        import markdown
+        import pygments
+        from markdown.extensions import codehilite
+        code = '```python\nimport os\nprint("%s")\n```\n' % uuid.uuid4().hex
+        indented = '    :::python\n    print("%s")\n' % uuid.uuid4().hex
+        with mock.patch.object(codehilite, 'highlight', wraps=pygments.highlight) as highlight:
+            first = CommonMarkdown._convert_markdown('first paragraph\n\n' + code)[0]
+            # 只修改了文字，代码块直接使用缓存
+            second = CommonMarkdown._convert_markdown('second paragraph\n\n' + code)[0]
+            self.assertEqual(highlight.call_count, 1)
+            # 不同语言的同一段代码分别缓存
+            CommonMarkdown._convert_markdown(code.replace('python', 'text'))
+            self.assertEqual(highlight.call_count, 2)
+            # 缩进代码块同样缓存
+            CommonMarkdown._convert_markdown('first\n\n' + indented)
+            CommonMarkdown._convert_markdown('second\n\n' + indented)
+            self.assertEqual(highlight.call_count, 3)
+            # 不影响进程中其他 Markdown 实例
+            markdown.Markdown(extensions=['extra', 'codehilite']).convert(code)
+            self.assertEqual(highlight.call_count, 4)
+        self.assertIn('<span class="kn">import</span>', first)
+        self.assertEqual(first.split('\n', 1)[1], second.split('\n', 1)[1])
+
+    def test_cache_decorator(self):
+        calls = []
+
+        @cache_decorator(60)
+        def get_site_domain(site):
+            calls.append(site.pk)
+            return None
+
+        site = Site.objects.get_current()
+        self.assertIsNone(get_site_domain(site))
+        self.assertIsNone(get_site_domain(Site.objects.get(pk=site.pk)))
+        self.assertEqual(calls, [site.pk])
+        self.assertEqual(get_site_domain.cache_stats['misses'], 1)
+        self.assertEqual(get_site_domain.cache_stats['hits'], 1)
+        self.assertEqual(
+            make_cache_decorator_key(get_site_domain, 1, (site,), {}),
+            make_cache_decorator_key(get_site_domain, 1, (Site(pk=site.pk),), {}))
+
+    def test_two_tier_cache(self):
+        from djangoblog.cache_backend import TwoTierCache
+        params = {'OPTIONS': {'L1_PREFIXES': ['hot_'], 'L1_TIMEOUT': 60}}
+        cache_a = TwoTierCache('default', params)
+        cache_b = TwoTierCache('default', params)
+        cache_a.set('hot_key', 1)
+        cache_a.set('cold_key', 1)
+        self.assertEqual(cache_a.get('hot_key'), 1)
+        cache.set('hot_key', 2)
+        cache.set('cold_key', 2)
+        # L1 命中，不读 L2
+        self.assertEqual(cache_a.get('hot_key'), 1)
+        self.assertEqual(cache_a.get('cold_key'), 2)
+        # 其他进程/实例修改后广播失效
+        cache_b.set('hot_key', 3)
+        self.assertEqual(cache_a.get('hot_key'), 3)
+        self.assertEqual(cache_a.get_many(['hot_key', 'cold_key']), {'hot_key': 3, 'cold_key': 2})
+        cache_b.delete('hot_key')
+        self.assertIsNone(cache_a.get('hot_key'))
+
+        # 订阅失败时不影响读写，L1 只靠过期时间失效，之后重试订阅
+        from unittest import mock
+        failing = TwoTierCache('default', {'OPTIONS': {
+            'L1_PREFIXES': ['hot_'], 'CHANNEL': 'djangoblog.tests.FailingChannel'}})
+        with mock.patch.dict(TwoTierCache._channels, clear=True), \
+                mock.patch.dict(TwoTierCache._channel_retry_at, clear=True):
+            FailingChannel.subscribes = 0
+            failing.set('hot_key', 4)
+            self.assertEqual(failing.get('hot_key'), 4)
+            self.assertEqual(failing.get_many(['hot_key']), {'hot_key': 4})
+            self.assertEqual(FailingChannel.subscribes, 1)
+            TwoTierCache._channel_retry_at.clear()
+            self.assertEqual(failing.get_many(['hot_other']), {})
+            self.assertEqual(FailingChannel.subscribes, 2)
+        cache.delete('hot_key')
+
+    def test_stale_while_revalidate(self):
+        cache.delete_many(['swr', 'swr_fresh', 'swr_stale'])
+        values = iter([1, 2, 3])
+        self.assertEqual(get_stale_while_revalidate('swr', lambda: next(values)), 1)
+        self.assertEqual(get_stale_while_revalidate('swr', lambda: next(values)), 1)
+        cache.delete('swr_fresh')
+        # 测试环境下后台重新生成同步执行，当前请求仍然拿到旧数据
+        self.assertEqual(get_stale_while_revalidate('swr', lambda: next(values)), 1)
+        self.assertEqual(get_stale_while_revalidate('swr', lambda: next(values)), 2)
+        cache.delete('swr_fresh')
+        cache.set('swr_stale', 0)
+        # 超过最长过期时间，同步生成
+        self.assertEqual(get_stale_while_revalidate('swr', lambda: next(values)), 3)
+
+    def test_safe_redis_cache_circuit_breaker(self):
+        from djangoblog.cache_backend import CacheMetrics, CircuitBreaker, SafeRedisCache
+        redis_cache = SafeRedisCache('redis://127.0.0.1:1/0', {'OPTIONS': {
+            'CIRCUIT_BREAKER_THRESHOLD': 2, 'CIRCUIT_BREAKER_COOLDOWN': 60}})
+        self.assertEqual(redis_cache.get('key', 'default'), 'default')
+        self.assertIsNone(redis_cache.set('key', 1))
+        self.assertEqual(redis_cache.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(redis_cache.get_many(['key']), {})
+        metrics = redis_cache.metrics.snapshot()
+        self.assertEqual(metrics['get']['errors'], 1)
+        self.assertEqual(metrics['get_many']['short_circuited'], 1)
+        self.assertEqual(CacheMetrics.percentile([0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0], 0.5), 2)
+
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_cache_stats(self):
+        from accounts.models import BlogUser
+        from djangoblog.cache_stats import get_key_prefix, stats
+        self.assertEqual(get_key_prefix('sidebari_fresh'), 'sidebar*')
+        self.assertEqual(get_key_prefix('index_2_g1.2'), 'index_*')
+        self.assertEqual(get_key_prefix('gravatat/a@b.com'), 'gravatat/*')
+        self.assertEqual(get_key_prefix('seo_processor'), 'seo_processor')
+        self.assertEqual(get_key_prefix(make_cache_decorator_key(get_current_site, 1, (), {})),
+                         'cache_decorator:get_current_site')
+
+        stats.reset()
+        cache.get('article_comments_stats')
+        with self.settings(CACHE_STATS_SIZE_SAMPLE_RATE=1):
+            cache.set('article_comments_stats', [1, 2, 3])
+        cache.get('article_comments_stats')
+        cache.delete('article_comments_stats')
+        stats.flush()
+        item = stats.load()['article_comments_*']
+        self.assertEqual((item['hits'], item['misses'], item['sets'], item['computes']), (1, 1, 1, 1))
+        self.assertGreater(item['avg_size'], 0)
+
+        user = BlogUser.objects.create_superuser(
+            email='stats@test.com', username='stats', password='stats')
+        rsp = self.client.get('/admin/cache_stats/')
+        self.assertEqual(rsp.status_code, 302)
+        self.client.force_login(user)
+        rsp = self.client.get('/admin/cache_stats/')
+        self.assertEqual(rsp.json()['article_comments_*']['hits'], 1)
+
+    def test_cache_dependency(self):
+        from djangoblog.cache_dependency import invalidate, model_tag, set_with_dependencies
+        set_with_dependencies('dependency_a', 'a', dependencies=['blog.article', 'blog.article:1'])
+        set_with_dependencies('dependency_b', 'b', dependencies=['blog.category'])
+        invalidate('blog.article:2')
+        self.assertEqual(cache.get('dependency_a'), 'a')
+        invalidate(model_tag(Site, 1), 'blog.article:1')
+        self.assertIsNone(cache.get('dependency_a'))
+        self.assertEqual(cache.get('dependency_b'), 'b')
+
+        # 登记只追加，每条登记与 key 同时过期，失效时逐条取出并删除
+        from unittest import mock
+        from djangoblog import cache_dependency
+        set_with_dependencies('dependency_c', 'c', 10, dependencies=['test.registry'])
+        set_with_dependencies('dependency_d', 'd', 10, dependencies=['test.registry'])
+        seq = cache.get('cache_dependency:test.registry#seq')
+        self.assertEqual(cache.get('cache_dependency:test.registry#%d' % seq), 'dependency_d')
+        with mock.patch.object(cache_dependency, 'INVALIDATE_BATCH_SIZE', 1):
+            invalidate('test.registry')
+        self.assertIsNone(cache.get('dependency_c'))
+        self.assertIsNone(cache.get('dependency_d'))
+        self.assertIsNone(cache.get('cache_dependency:test.registry#%d' % seq))
+        self.assertEqual(cache.get('cache_dependency:test.registry#floor'), seq)
+        # 登记期间发生了失效（floor 已经越过本次序号）时不保留错过失效的 key
+        next_index = cache_dependency._next_index
+
+        def invalidate_while_registering(tag):
+            index = next_index(tag)
+            cache.set('cache_dependency:test.registry#floor', index)
+            return index
+
+        with mock.patch.object(cache_dependency, '_next_index', side_effect=invalidate_while_registering):
+            set_with_dependencies('dependency_e', 'e', 10, dependencies=['test.registry'])
+        self.assertIsNone(cache.get('dependency_e'))
+        # 计数器被淘汰后从 floor 继续，不会被当作错过失效
+        cache.delete('cache_dependency:test.registry#seq')
+        set_with_dependencies('dependency_f', 'f', 10, dependencies=['test.registry'])
+        self.assertEqual(cache.get('dependency_f'), 'f')
+        cache.delete('dependency_b')
+        invalidate('test.registry', 'blog.category')
+        self.assertIsNone(cache.get('dependency_f'))
+
+    def test_cache_generation(self):
+        from djangoblog.cache_dependency import get_generation, invalidate
+        index = get_generation('blog.article')
+        tag = get_generation('blog.tag:1')
+        self.assertEqual(index, get_generation('blog.article'))
+        invalidate('blog.article')
+        self.assertNotEqual(index, get_generation('blog.article'))
+        self.assertEqual(tag, get_generation('blog.tag:1'))
+
+    def test_save_invalidates_dependent_cache(self):
+        import djangoblog.blog_signals  # noqa 注册信号
+        from accounts.models import BlogUser
+        from blog.models import Article, Category, Tag
+        from blog.tag_counts import tag_counts
+        from blog.templatetags.blog_tags import load_sidebar
+        tag_counts.clear()
+        user = BlogUser.objects.create_user(username='dependency', email='dependency@test.com')
+        category = Category.objects.create(name='dependency category')
+        tag = Tag.objects.create(name='dependency tag')
+        article = Article.objects.create(
+            title='dependency title', body='body', author=user, category=category)
+        article.tags.add(tag)
+        self.assertEqual(tag.get_article_count(), 1)
+        get_blog_setting()
+        load_sidebar(user, 'i')
+        self.assertIsNotNone(cache.get('sidebari_fresh'))
+
+        user.save()
+        self.assertIsNotNone(cache.get('sidebari_fresh'))
+        self.assertIsNotNone(cache.get('get_blog_setting'))
+
+        other = Article.objects.create(
+            title='dependency title2', body='body', author=user, category=category)
+        self.assertIsNone(cache.get('sidebari_fresh'))
+        self.assertIsNotNone(cache.get('get_blog_setting'))
+        with self.captureOnCommitCallbacks(execute=True):
+            other.tags.add(tag)
+        self.assertEqual(tag.get_article_count(), 2)
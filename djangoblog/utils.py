@@ -2,11 +2,16 @@
 # encoding: utf-8
 
 
+import functools
 import logging
+import math
 import os
 import random
 import string
+import threading
+import time
 import uuid
+from collections import Counter, OrderedDict, defaultdict
 from hashlib import sha256
 
 import bleach
@@ -14,8 +19,14 @@ import markdown
 import requests
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.cache import cache
+from django.db import models
 from django.templatetags.static import static
+from markdown.extensions.attr_list import get_attrs
+from markdown.extensions.codehilite import (
+    CodeHilite, CodeHiliteExtension, HiliteTreeprocessor, parse_hl_lines)
+from markdown.extensions.fenced_code import FencedBlockPreprocessor, FencedCodeExtension
+
+from djangoblog.cache_stats import cache
 
 logger = logging.getLogger(__name__)
 
@@ -31,42 +42,108 @@ def get_sha256(str):
     return m.hexdigest()
 
 
-def cache_decorator(expiration=3 * 60):
+CACHE_DECORATOR_STATS = defaultdict(Counter)
+CACHE_DECORATOR_LOCK_TIMEOUT = 10
+CACHE_DECORATOR_LOCK_WAIT = 1
+
+
+def _cache_key_part(value):
+    """模型实例用 label + pk 表示，保证不同进程、不同部署生成的key一致"""
+    if isinstance(value, models.Model):
+        return '{label}:{pk}'.format(label=value._meta.label_lower, pk=value.pk)
+    return repr(value)
+
+
+def make_cache_decorator_key(func, version, args, kwargs):
+    name = '{module}.{qualname}'.format(module=func.__module__, qualname=func.__qualname__)
+    parts = [name, 'v{version}'.format(version=version)]
+    parts.extend(_cache_key_part(arg) for arg in args)
+    parts.extend('{k}={v}'.format(k=k, v=_cache_key_part(v))
+                 for k, v in sorted(kwargs.items()))
+    return 'cache_decorator:{qualname}:{hash}'.format(
+        qualname=func.__qualname__, hash=get_sha256(':'.join(parts)))
+
+
+def cache_decorator(expiration=3 * 60, dependencies=None, version=1, beta=1.0):
+    """
+    缓存函数返回值
+    :param expiration: 过期时间
+    :param dependencies: 依赖标签列表，或接收被装饰函数参数并返回标签列表的函数，
+                         依赖的对象变更时自动失效
+    :param version: 版本号，函数返回值结构变化时修改，使旧缓存失效
+    :param beta: 提前刷新系数，越大越早在过期前重新计算，0 表示不提前刷新
+
+    缓存值记录计算耗时和过期时间，快过期时按概率提前由一个进程重新计算（XFetch），
+    未命中时通过 cache.add 加锁，同一时间只有一个进程计算，其他进程等待结果，避免缓存击穿。
+    """
+
     def wrapper(func):
+        name = '{module}.{qualname}'.format(module=func.__module__, qualname=func.__qualname__)
+        stats = CACHE_DECORATOR_STATS[name]
+
+        @functools.wraps(func)
         def news(*args, **kwargs):
-            try:
-                view = args[0]
-                key = view.get_cache_key()
-            except:
-                key = None
-            if not key:
-                unique_str = repr((func, args, kwargs))
-
-                m = sha256(unique_str.encode('utf-8'))
-                key = m.hexdigest()
-            value = cache.get(key)
-            if value is not None:
-                # logger.info('cache_decorator get cache:%s key:%s' % (func.__name__, key))
-                if str(value) == '__default_cache_value__':
-                    return None
-                else:
+            key = make_cache_decorator_key(func, version, args, kwargs)
+            lock_key = key + ':lock'
+            entry = cache.get(key)
+            if entry is not None:
+                value, delta, expire_at = entry
+                if not _should_refresh_early(delta, expire_at, beta) or \
+                        not cache.add(lock_key, 1, CACHE_DECORATOR_LOCK_TIMEOUT):
+                    stats['hits'] += 1
                     return value
+                stats['early_refreshes'] += 1
             else:
+                stats['misses'] += 1
+                if not cache.add(lock_key, 1, CACHE_DECORATOR_LOCK_TIMEOUT):
+                    # 其他进程正在计算则等待结果，缓存不可用（如熔断）时直接计算
+                    if cache.get(lock_key) is not None:
+                        entry = _wait_for_cache(key)
+                        if entry is not None:
+                            return entry[0]
+                    # 自行计算，但不释放别人的锁
+                    lock_key = None
+            try:
                 logger.debug(
                     'cache_decorator set cache:%s key:%s' %
                     (func.__name__, key))
+                start = time.time()
                 value = func(*args, **kwargs)
-                if value is None:
-                    cache.set(key, '__default_cache_value__', expiration)
-                else:
-                    cache.set(key, value, expiration)
-                return value
-
+                delta = time.time() - start
+                expire_at = start + expiration if expiration else None
+                cache.set(key, (value, delta, expire_at), expiration)
+                if dependencies:
+                    from djangoblog.cache_dependency import register_dependencies
+                    tags = dependencies(*args, **kwargs) if callable(
+                        dependencies) else dependencies
+                    register_dependencies(key, tags, expiration)
+            finally:
+                if lock_key:
+                    cache.delete(lock_key)
+            return value
+
+        news.cache_stats = stats
         return news
 
     return wrapper
 
 
+def _should_refresh_early(delta, expire_at, beta):
+    if not expire_at or not beta:
+        return False
+    return time.time() - delta * beta * math.log(random.random() or 1e-12) >= expire_at
+
+
+def _wait_for_cache(key):
+    deadline = time.time() + CACHE_DECORATOR_LOCK_WAIT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    return None
+
+
 def expire_view_cache(path, servername, serverport, key_prefix=None):
     '''
     刷新视图缓存
@@ -92,35 +169,244 @@ def expire_view_cache(path, servername, serverport, key_prefix=None):
     return False
 
 
-@cache_decorator()
+@cache_decorator(dependencies=['sites.site'])
 def get_current_site():
     site = Site.objects.get_current()
     return site
 
 
+class LRUCache(object):
+    """线程安全的进程内 LRU 缓存"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class CodeHighlighter(object):
+    """
+    代码块高亮缓存
+    按 (高亮选项, 代码 sha256) 缓存 Pygments 的输出，修改文章的一段文字后重新渲染时，
+    没有变化的代码块不再重新词法分析
+    """
+    CACHE_KEY = 'highlight:{digest}'
+    CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+    def __init__(self):
+        self.local_cache = LRUCache(1024)
+        self.enabled = True
+
+    @staticmethod
+    def get_cache_key(code, options):
+        return CodeHighlighter.CACHE_KEY.format(
+            digest=get_sha256(repr(options) + '\n' + code))
+
+    def highlight(self, code, options, render):
+        """
+        获得代码块高亮后的 HTML，优先从缓存读取
+        :param code: 代码
+        :param options: 影响输出的高亮选项
+        :param render: 缓存未命中时调用，返回高亮后的 HTML
+        """
+        if not self.enabled:
+            return render()
+        key = self.get_cache_key(code, options)
+        html = self.local_cache.get(key)
+        if html is None:
+            html = cache.get(key)
+            if html is None:
+                html = render()
+                cache.set(key, html, self.CACHE_TIMEOUT)
+            self.local_cache.set(key, html)
+        return html
+
+
+code_highlighter = CodeHighlighter()
+
+
+class CachedCodeHilite(CodeHilite):
+    """高亮结果经过 code_highlighter 缓存的 CodeHilite"""
+
+    def hilite(self, shebang=True):
+        formatter = self.pygments_formatter
+        if not isinstance(formatter, str):
+            formatter = '{module}.{name}'.format(module=formatter.__module__, name=formatter.__qualname__)
+        options = (self.lang, self.guess_lang, self.use_pygments, self.lang_prefix, formatter,
+                   sorted(self.options.items()), shebang)
+        return code_highlighter.highlight(
+            self.src, options, lambda: super(CachedCodeHilite, self).hilite(shebang))
+
+
+class CachedHiliteTreeprocessor(HiliteTreeprocessor):
+
+    def run(self, root):
+        for block in root.iter('pre'):
+            if len(block) == 1 and block[0].tag == 'code':
+                local_config = self.config.copy()
+                code = CachedCodeHilite(
+                    self.code_unescape(block[0].text),
+                    tab_length=self.md.tab_length,
+                    style=local_config.pop('pygments_style', 'default'),
+                    **local_config
+                )
+                placeholder = self.md.htmlStash.store(code.hilite())
+                block.clear()
+                block.tag = 'p'
+                block.text = placeholder
+
+
+class CachedCodeHiliteExtension(CodeHiliteExtension):
+    """
+    使用 CachedCodeHilite 高亮缩进代码块的 codehilite 扩展
+    只在 CommonMarkdown 中注册，不影响进程中其他 Markdown 实例
+    """
+
+    def extendMarkdown(self, md):
+        hiliter = CachedHiliteTreeprocessor(md)
+        hiliter.config = self.getConfigs()
+        md.treeprocessors.register(hiliter, 'hilite', 30)
+        md.registerExtension(self)
+
+
+class CachedFencedBlockPreprocessor(FencedBlockPreprocessor):
+    """
+    fenced_code 在模块内直接构造 CodeHilite，这里先用 CachedCodeHilite 高亮需要 Pygments 的代码块，
+    其余代码块（未启用 codehilite 或指定了 use_pygments=false）仍交给 fenced_code 处理
+    """
+
+    def run(self, lines):
+        codehilite_conf = None
+        for ext in self.md.registeredExtensions:
+            if isinstance(ext, CodeHiliteExtension):
+                codehilite_conf = ext.getConfigs()
+        if not codehilite_conf or not codehilite_conf['use_pygments']:
+            return super().run(lines)
+
+        text = '\n'.join(lines)
+        pos = 0
+        while True:
+            m = self.FENCED_BLOCK_RE.search(text, pos)
+            if not m:
+                break
+            lang, classes, config = None, [], {}
+            if m.group('attrs'):
+                _, classes, config = self.handle_attrs(get_attrs(m.group('attrs')))
+                if classes:
+                    lang = classes.pop(0)
+            else:
+                lang = m.group('lang') or None
+                if m.group('hl_lines'):
+                    config['hl_lines'] = parse_hl_lines(m.group('hl_lines'))
+            if not config.get('use_pygments', True):
+                pos = m.end()
+                continue
+            local_config = codehilite_conf.copy()
+            local_config.update(config)
+            if classes:
+                local_config['css_class'] = '{} {}'.format(' '.join(classes), local_config['css_class'])
+            code = CachedCodeHilite(
+                m.group('code'),
+                lang=lang,
+                style=local_config.pop('pygments_style', 'default'),
+                **local_config
+            ).hilite(shebang=False)
+            placeholder = self.md.htmlStash.store(code)
+            before = '{before}\n{placeholder}\n'.format(before=text[:m.start()], placeholder=placeholder)
+            text = before + text[m.end():]
+            pos = len(before)
+        return super().run(text.split('\n'))
+
+
+class CachedFencedCodeExtension(FencedCodeExtension):
+    """替换 extra 中 fenced_code 的预处理器，需要放在 extra 之后注册"""
+
+    def extendMarkdown(self, md):
+        md.registerExtension(self)
+        md.preprocessors.register(
+            CachedFencedBlockPreprocessor(md, self.getConfigs()), 'fenced_code_block', 25)
+
+
 class CommonMarkdown:
+    """
+    markdown 渲染
+    每个线程复用一个配置好的 Markdown 实例，转换前 reset()；
+    渲染结果按 (版本, 内容 sha256) 先后缓存在进程内 LRU 和共享缓存中，相同内容只转换一次
+    """
+    # 渲染结果会保存到文章中，修改扩展或渲染方式时加一，旧的渲染结果会重新生成
+    VERSION = 1
+    # 代码块高亮经过 code_highlighter 缓存，只作用于这里的 Markdown 实例
+    EXTENSIONS = [
+        'extra',
+        'djangoblog.utils:CachedFencedCodeExtension',
+        'djangoblog.utils:CachedCodeHiliteExtension',
+        'toc',
+        'tables',
+    ]
+    CACHE_KEY = 'markdown:{version}:{digest}'
+    CACHE_TIMEOUT = 60 * 60 * 24
+    local_cache = LRUCache(256)
+    _local = threading.local()
+
+    @staticmethod
+    def _get_instance():
+        md = getattr(CommonMarkdown._local, 'md', None)
+        if md is None:
+            md = CommonMarkdown._local.md = markdown.Markdown(extensions=CommonMarkdown.EXTENSIONS)
+        return md
+
     @staticmethod
     def _convert_markdown(value):
-        md = markdown.Markdown(
-            extensions=[
-                'extra',
-                'codehilite',
-                'toc',
-                'tables',
-            ]
-        )
+        md = CommonMarkdown._get_instance()
+        md.reset()
         body = md.convert(value)
         toc = md.toc
         return body, toc
 
+    @staticmethod
+    def render(value):
+        """
+        获得渲染结果，优先从缓存读取
+        :param value: markdown 内容
+        :return: (html, toc)
+        """
+        key = CommonMarkdown.CACHE_KEY.format(
+            version=CommonMarkdown.VERSION, digest=get_sha256(value))
+        result = CommonMarkdown.local_cache.get(key)
+        if result is None:
+            result = cache.get(key)
+            if result is None:
+                result = CommonMarkdown._convert_markdown(value)
+                cache.set(key, result, CommonMarkdown.CACHE_TIMEOUT)
+            CommonMarkdown.local_cache.set(key, result)
+        return result
+
     @staticmethod
     def get_markdown_with_toc(value):
-        body, toc = CommonMarkdown._convert_markdown(value)
+        body, toc = CommonMarkdown.render(value)
         return body, toc
 
     @staticmethod
     def get_markdown(value):
-        body, toc = CommonMarkdown._convert_markdown(value)
+        body, toc = CommonMarkdown.render(value)
         return body
 
 
@@ -169,7 +455,8 @@ def get_blog_setting():
             setting.save()
         value = BlogSettings.objects.first()
         logger.info('set cache get_blog_setting')
-        cache.set('get_blog_setting', value)
+        from djangoblog.cache_dependency import set_with_dependencies, model_tag
+        set_with_dependencies('get_blog_setting', value, dependencies=[model_tag(BlogSettings)])
         return value
 
 
@@ -201,12 +488,83 @@ def save_user_avatar(url):
         return static('blog/img/avatar.png')
 
 
+def get_sidebar_cache_key(linktype):
+    return 'sidebar' + linktype
+
+
 def delete_sidebar_cache():
+    """标记侧边栏过期，下次访问时先返回旧数据，由后台重新生成"""
     from blog.models import LinkShowType
-    keys = ["sidebar" + x for x in LinkShowType.values]
-    for k in keys:
-        logger.info('delete sidebar key:' + k)
-        cache.delete(k)
+    keys = [get_sidebar_cache_key(x) + '_fresh' for x in LinkShowType.values]
+    logger.info('expire sidebar keys:' + ','.join(keys))
+    cache.delete_many(keys)
+
+
+def get_stale_while_revalidate(key, builder, timeout=None, max_staleness=60 * 10, dependencies=()):
+    """
+    stale-while-revalidate 方式读取缓存
+    数据保存在 key 中，是否新鲜由 ``key_fresh`` 标记，依赖失效时只删除标记。
+    标记不存在时先返回旧数据，同时由一个后台线程重新生成；旧数据最多返回 max_staleness 秒，
+    超过后在当前请求中同步生成。
+    :param key: 缓存key
+    :param builder: 生成数据的函数
+    :param timeout: 数据过期时间
+    :param max_staleness: 最长返回旧数据的秒数
+    :param dependencies: 依赖标签
+    :return: 缓存数据
+    """
+    fresh_key = key + '_fresh'
+    stale_key = key + '_stale'
+    values = cache.get_many([key, fresh_key])
+    if key in values and fresh_key in values:
+        return values[key]
+    if key in values:
+        now = time.time()
+        # 记录第一次发现过期的时间，用于限制旧数据的最长使用时间
+        cache.add(stale_key, now, max_staleness * 2)
+        stale_since = cache.get(stale_key, now)
+        if now - stale_since < max_staleness:
+            _revalidate_in_background(key, builder, timeout, dependencies)
+            return values[key]
+    return _revalidate(key, builder, timeout, dependencies)
+
+
+def _revalidate(key, builder, timeout, dependencies):
+    from djangoblog.cache_dependency import set_with_dependencies
+    fresh_key = key + '_fresh'
+    # 先写标记再生成数据，生成期间发生的失效会删除标记，不会被覆盖
+    set_with_dependencies(fresh_key, True, timeout, dependencies)
+    try:
+        value = builder()
+        cache.set(key, value, timeout)
+    except Exception:
+        cache.delete(fresh_key)
+        raise
+    cache.delete(key + '_stale')
+    return value
+
+
+def _revalidate_in_background(key, builder, timeout, dependencies):
+    lock_key = key + '_rebuilding'
+    if not cache.add(lock_key, 1, 60):
+        return
+
+    def run():
+        try:
+            logger.info('revalidate cache in background.key:{key}'.format(key=key))
+            _revalidate(key, builder, timeout, dependencies)
+        except Exception as e:
+            logger.error(e)
+        finally:
+            cache.delete(lock_key)
+            if not settings.TESTING:
+                from django.db import connection
+                connection.close()
+
+    if settings.TESTING:
+        run()
+    else:
+        threading.Thread(target=run, daemon=True).start()
 
 
 def delete_view_cache(prefix, keys):
@@ -223,6 +581,8 @@ def get_resource_url():
         return 'http://' + site.domain + '/static/'
 
 
+# 修改允许的标签或属性时加一，已保存的评论 HTML 会按新规则重新生成
+SANITIZER_VERSION = 1
 ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul', 'h1',
                 'h2', 'p']
 ALLOWED_ATTRIBUTES = {'a': ['href', 'title'], 'abbr': ['title'], 'acronym': ['title']}
@@ -481,7 +481,7 @@ class QQOauthManager(BaseOauthManager):
         return str(datas['figureurl'])
 
 
-@cache_decorator(expiration=100 * 60)
+@cache_decorator(expiration=100 * 60, dependencies=['oauth.oauthconfig'])
 def get_oauth_apps():
     configs = OAuthConfig.objects.filter(is_enable=True).all()
     if not configs: